@@ -1,5 +1,6 @@
 import os
 import secrets
+import tempfile
 
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
@@ -12,15 +13,137 @@ login = LoginManager(app)
 login.login_view = 'login'
 
 basedir = os.path.abspath(os.path.dirname(__file__))
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'data', 'data.sqlite')
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///' + os.path.join(basedir, 'data', 'data.sqlite'))
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+# connection pool of each worker process
+app.config['DATABASE_POOL_SIZE'] = int(os.environ.get('DATABASE_POOL_SIZE', 5))
+app.config['DATABASE_MAX_OVERFLOW'] = int(os.environ.get('DATABASE_MAX_OVERFLOW', 10))
+app.config['DATABASE_POOL_TIMEOUT'] = float(os.environ.get('DATABASE_POOL_TIMEOUT', 30))
+app.config['DATABASE_POOL_RECYCLE'] = int(os.environ.get('DATABASE_POOL_RECYCLE', -1))
+
+# pragmas set on every sqlite connection, see app/database.py. busy_timeout is in milliseconds,
+# mmap_size in bytes and a negative cache_size is in KiB
+app.config['SQLITE_JOURNAL_MODE'] = os.environ.get('SQLITE_JOURNAL_MODE', 'wal')
+app.config['SQLITE_SYNCHRONOUS'] = os.environ.get('SQLITE_SYNCHRONOUS', 'normal')
+app.config['SQLITE_BUSY_TIMEOUT'] = os.environ.get('SQLITE_BUSY_TIMEOUT', '5000')
+app.config['SQLITE_MMAP_SIZE'] = os.environ.get('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024))
+app.config['SQLITE_CACHE_SIZE'] = os.environ.get('SQLITE_CACHE_SIZE', '-65536')
+
+# number of rows shown per page on the listing views, and the batch size used when a listing is streamed
+app.config['LISTING_PAGE_SIZE'] = int(os.environ.get('LISTING_PAGE_SIZE', 50))
+app.config['LISTING_MAX_PAGE_SIZE'] = int(os.environ.get('LISTING_MAX_PAGE_SIZE', 500))
+app.config['LISTING_STREAM_BATCH_SIZE'] = int(os.environ.get('LISTING_STREAM_BATCH_SIZE', 1000))
+app.config['SEARCH_PAGE_SIZE'] = int(os.environ.get('SEARCH_PAGE_SIZE', 25))
+
+# how many times a checkout or return is retried when sqlite reports the database as busy,
+# and the first delay in seconds (it doubles after every attempt)
+app.config['CHECKOUT_RETRIES'] = int(os.environ.get('CHECKOUT_RETRIES', 5))
+app.config['CHECKOUT_RETRY_DELAY'] = float(os.environ.get('CHECKOUT_RETRY_DELAY', 0.05))
+
+# seconds the available devices and available books listings are cached for in each worker
+app.config['AVAILABILITY_CACHE_TTL'] = float(os.environ.get('AVAILABILITY_CACHE_TTL', 30))
+
+# largest number of items accepted by the batch checkout and return endpoints
+app.config['BATCH_MAX_ITEMS'] = int(os.environ.get('BATCH_MAX_ITEMS', 500))
+
+# ids handled per transaction by the bulk administration commands (flask library deactivate-students etc.)
+app.config['ADMIN_CHUNK_SIZE'] = int(os.environ.get('ADMIN_CHUNK_SIZE', 500))
+
+# a copy that comes back while students are queueing for it is set aside for the next one in line,
+# who has HOLD_PICKUP_PERIOD seconds to collect it before flask library expire-holds passes it on
+app.config['HOLD_PICKUP_PERIOD'] = int(os.environ.get('HOLD_PICKUP_PERIOD', 2 * 24 * 3600))
+app.config['HOLD_EXPIRY_BATCH_SIZE'] = int(os.environ.get('HOLD_EXPIRY_BATCH_SIZE', 1000))
+
+# overdue fines are charged to open loans by a sweep, see app/accrual.py. with FINE_ACCRUAL_INTERVAL
+# above zero each worker process sweeps in a background thread every that many seconds, otherwise
+# run flask library accrue-fines on a schedule
+app.config['FINE_ACCRUAL_INTERVAL'] = float(os.environ.get('FINE_ACCRUAL_INTERVAL', 0))
+app.config['FINE_ACCRUAL_BATCH_SIZE'] = int(os.environ.get('FINE_ACCRUAL_BATCH_SIZE', 1000))
+
+# reminders for loans due back within NOTIFICATION_DUE_SOON seconds and for overdue loans, see
+# app/notifications.py. flask library scan-notifications queues them in the outbox and flask library
+# send-notifications drains it with NOTIFICATION_WORKERS threads through NOTIFICATION_SENDER: file
+# writes each message to NOTIFICATION_DIR, smtp hands it to SMTP_HOST:SMTP_PORT, and module:name is
+# any other sender. a failed message is tried again after NOTIFICATION_RETRY_DELAY seconds, doubling
+# up to NOTIFICATION_MAX_RETRY_DELAY, NOTIFICATION_MAX_ATTEMPTS times, and a claimed message a worker
+# has not finished with after NOTIFICATION_LEASE seconds is claimed again. with NOTIFICATION_INTERVAL
+# above zero each worker process scans and sends in a background thread every that many seconds
+app.config['NOTIFICATION_DUE_SOON'] = int(os.environ.get('NOTIFICATION_DUE_SOON', 24 * 3600))
+app.config['NOTIFICATION_SENDER'] = os.environ.get('NOTIFICATION_SENDER', 'file')
+app.config['NOTIFICATION_DIR'] = os.environ.get('NOTIFICATION_DIR', os.path.join(tempfile.gettempdir(), 'library-outbox'))
+app.config['NOTIFICATION_FROM'] = os.environ.get('NOTIFICATION_FROM', 'library@example.com')
+app.config['SMTP_HOST'] = os.environ.get('SMTP_HOST', 'localhost')
+app.config['SMTP_PORT'] = int(os.environ.get('SMTP_PORT', 8025))
+app.config['NOTIFICATION_BATCH_SIZE'] = int(os.environ.get('NOTIFICATION_BATCH_SIZE', 500))
+app.config['NOTIFICATION_WORKERS'] = int(os.environ.get('NOTIFICATION_WORKERS', 4))
+app.config['NOTIFICATION_RETRY_DELAY'] = float(os.environ.get('NOTIFICATION_RETRY_DELAY', 30))
+app.config['NOTIFICATION_MAX_RETRY_DELAY'] = float(os.environ.get('NOTIFICATION_MAX_RETRY_DELAY', 3600))
+app.config['NOTIFICATION_MAX_ATTEMPTS'] = int(os.environ.get('NOTIFICATION_MAX_ATTEMPTS', 8))
+app.config['NOTIFICATION_LEASE'] = float(os.environ.get('NOTIFICATION_LEASE', 300))
+app.config['NOTIFICATION_INTERVAL'] = float(os.environ.get('NOTIFICATION_INTERVAL', 0))
+
+# returned loans older than ARCHIVE_AFTER_DAYS are moved out of the loan tables by flask library
+# archive-loans, ARCHIVE_BATCH_SIZE at a time, into archive tables in the same database, or in the
+# sqlite file ARCHIVE_DATABASE when it is set (attached to every connection)
+app.config['ARCHIVE_AFTER_DAYS'] = float(os.environ.get('ARCHIVE_AFTER_DAYS', 365))
+app.config['ARCHIVE_BATCH_SIZE'] = int(os.environ.get('ARCHIVE_BATCH_SIZE', 1000))
+app.config['ARCHIVE_DATABASE'] = os.environ.get('ARCHIVE_DATABASE', '')
+
+# loan rows read into memory at a time by the finance analytics report
+app.config['ANALYTICS_CHUNK_SIZE'] = int(os.environ.get('ANALYTICS_CHUNK_SIZE', 100000))
+
+# rows fetched from the cursor and written to the response at a time by the csv and json lines exports
+app.config['EXPORT_BATCH_SIZE'] = int(os.environ.get('EXPORT_BATCH_SIZE', 2000))
+
+# password hashing, see app/passwords.py. PASSWORD_HASH_METHOD is a werkzeug method string such as
+# scrypt:32768:8:1 or pbkdf2:sha256:600000; stored hashes made with other settings are updated at login.
+# hashes are worked out in a pool of PASSWORD_HASH_WORKERS processes per worker (0 hashes in the request thread)
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+app.config['PASSWORD_SALT_LENGTH'] = int(os.environ.get('PASSWORD_SALT_LENGTH', 32))
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+
+# seconds each worker reuses the logged in user without loading it again (0 loads it on every request)
+app.config['USER_CACHE_TTL'] = float(os.environ.get('USER_CACHE_TTL', 60))
+
+# the async read-only server (app/asgi.py). it needs ASYNC_API_TOKEN, sent by clients as a bearer
+# token, and reads DATABASE_URL through aiosqlite unless ASYNC_DATABASE_URL names another async driver
+app.config['ASYNC_API_TOKEN'] = os.environ.get('ASYNC_API_TOKEN', '')
+app.config['ASYNC_DATABASE_URL'] = os.environ.get('ASYNC_DATABASE_URL', '')
+
+# statements slower than SLOW_QUERY_MS milliseconds are logged with their parameters (0 turns it off).
+# /metrics is only served when METRICS_TOKEN is set, and with PROFILER_ENABLED=1 a request with
+# ?profile=1 is sampled every PROFILER_INTERVAL_MS and its folded stacks written to PROFILE_DIR
+app.config['SLOW_QUERY_MS'] = float(os.environ.get('SLOW_QUERY_MS', 100))
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN', '')
+app.config['PROFILER_ENABLED'] = os.environ.get('PROFILER_ENABLED', '0') == '1'
+app.config['PROFILER_INTERVAL_MS'] = float(os.environ.get('PROFILER_INTERVAL_MS', 5))
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'library-profiles'))
+
+# set QUERY_PLAN_CHECK=1 to log a warning for every query a view runs that scans a whole table
+app.config['QUERY_PLAN_CHECK'] = os.environ.get('QUERY_PLAN_CHECK', '0') == '1'
+
+from app import database
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = database.engine_options(app.config)
 db = SQLAlchemy(app)
+with app.app_context():
+    database.apply_pragmas(db.engine, database.sqlite_pragmas(app.config))
+    database.attach_archive(db.engine, app.config['ARCHIVE_DATABASE'], database.sqlite_pragmas(app.config))
+
 
+from app import views, cli, instrumentation, query_plans
+from app.api import api
+app.register_blueprint(api)
 
-from app import views
+from app import accrual
+if app.config['FINE_ACCRUAL_INTERVAL'] > 0:
+    accrual.start_worker()
+from app import notifications
+if app.config['NOTIFICATION_INTERVAL'] > 0:
+    notifications.start_worker()
 from app.models import *
 
 @app.shell_context_processor
 def make_shell_context():
     return dict(db=db, User=User, Student=Student, Loan=Loan, Device=Device, datetime=datetime, LoginManager=LoginManager,
-                Book=Book, BookLoan=BookLoan, Author=Author)
+                Book=Book, BookLoan=BookLoan, Author=Author, FineTransaction=FineTransaction)
@@ -0,0 +1,115 @@
+import json
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import bindparam, func, insert, select, update
+
+from app import app, db
+from app.checkout import ITEM_KINDS, run_in_transaction
+from app.fines import calculate_fine, MAX_FINE
+from app.models import Student, FineTransaction
+
+
+# overdue fines are charged while an item is still out, not only when it comes back. the sweep reads
+# the overdue open loans in batches, works out each loan's fine so far, and charges the difference
+# from what the loan already holds, with a handful of set-based statements per batch. the loan's
+# fine column is the running total, so the sweep can run as often as needed and returns only charge
+# what is left. the loans are read before the transaction takes the write lock, so each is only
+# charged if it is still out with the fine it was read with: a return or another worker's sweep
+# committing in between wins, and that loan is left for the next sweep
+
+def _charge_loans(loan_model, fine_column):
+    read = func.json_each(bindparam('charges')).table_valued('value')
+    charges = select(func.json_extract(read.c.value, '$[0]').label('loan_id'),
+                     func.json_extract(read.c.value, '$[1]').label('fine'),
+                     func.json_extract(read.c.value, '$[2]').label('new_fine')).cte('charges')
+    return (update(loan_model)
+            .where((loan_model.loan_id == charges.c.loan_id) & loan_model.returndatetime.is_(None)
+                   & fine_column.is_not_distinct_from(charges.c.fine))
+            .values({fine_column: charges.c.new_fine})
+            .returning(loan_model.loan_id)
+            .execution_options(synchronize_session=False))
+
+
+def _accrue_batch(session, kind, after, now, batch_size):
+
+    # returns the last loan id in the batch (None when there are no more overdue loans) and the
+    # number of loans that were charged
+    loan_model = kind['loan_model']
+    fine_column = getattr(loan_model, kind['fine_column'])
+    rows = session.execute(
+        select(loan_model.loan_id, loan_model.student_id, loan_model.duedatetime, fine_column)
+        .where(loan_model.returndatetime.is_(None) & (loan_model.loan_id > after)
+               & (loan_model.duedatetime < now) & (func.coalesce(fine_column, 0) < MAX_FINE))
+        .order_by(loan_model.loan_id).limit(batch_size)).all()
+    if not rows:
+        return None, 0
+
+    charges = {}
+    for loan_id, student_id, duedatetime, fine in rows:
+        charge = calculate_fine(duedatetime, now) - (fine or 0)
+        if charge > 0:
+            charges[loan_id] = (student_id, fine, charge)
+    if not charges:
+        return rows[-1].loan_id, 0
+
+    # one compare-and-set update for the batch, returning the loans it charged. the batch is bound as
+    # a single json array of [loan id, fine read, new fine], so the statement is compiled once
+    charged = session.scalars(
+        _charge_loans(loan_model, fine_column),
+        {'charges': json.dumps([[loan_id, fine, (fine or 0) + charge]
+                                for loan_id, (student_id, fine, charge) in charges.items()])}).all()
+
+    ledger, fined = [], {}
+    for loan_id in charged:
+        student_id, fine, charge = charges[loan_id]
+        ledger.append({'student_id': student_id, 'amount': charge, 'reason': kind['reason'],
+                       'created': now, kind['ledger_column']: loan_id})
+        fined[student_id] = fined.get(student_id, 0) + charge
+
+    if ledger:
+        session.execute(insert(FineTransaction), ledger)
+        students = Student.__table__
+        session.execute(update(students).where(students.c.student_id == bindparam('charged_student_id'))
+                        .values(fines=students.c.fines + bindparam('charge')),
+                        [{'charged_student_id': student_id, 'charge': charge} for student_id, charge in fined.items()])
+    return rows[-1].loan_id, len(charged)
+
+
+def accrue_fines(session=None, now=None, batch_size=None):
+
+    # one sweep over every overdue device and book loan, each batch in its own transaction.
+    # returns the number of loans charged
+    session = session or db.session
+    now = now or datetime.now()
+    batch_size = batch_size or app.config['FINE_ACCRUAL_BATCH_SIZE']
+    charged = 0
+
+    for kind in ITEM_KINDS.values():
+        after = 0
+        while after is not None:
+            after, count = run_in_transaction(
+                lambda after=after: _accrue_batch(session, kind, after, now, batch_size), session)
+            charged += count
+    return charged
+
+
+def run_worker(interval):
+    while True:
+        time.sleep(interval)
+        with app.app_context():
+            try:
+                charged = accrue_fines()
+                app.logger.debug('fine accrual charged %d loans', charged)
+            except Exception:
+                app.logger.exception('fine accrual sweep failed')
+
+
+def start_worker(interval=None):
+
+    # sweeps in a daemon thread of this process every FINE_ACCRUAL_INTERVAL seconds
+    interval = interval or app.config['FINE_ACCRUAL_INTERVAL']
+    thread = threading.Thread(target=run_worker, args=(interval,), name='fine-accrual', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,189 @@
+import csv
+from collections import Counter
+
+from sqlalchemy import delete, func, select, update
+
+from app import app, db
+from app import archive
+from app import holds
+from app import notifications
+from app.availability import availability
+from app.checkout import run_in_transaction
+from app.models import Student, Loan, BookLoan, FineTransaction, Notification
+
+
+# bulk administration for the library cli. each task takes a list of ids and works through it in
+# chunks of ADMIN_CHUNK_SIZE, with a handful of set-based statements per chunk, each chunk in its own
+# transaction. a dry run does the same work and rolls every chunk back, so its counts are exactly
+# what a real run would change
+
+class BulkInputError(Exception):
+    pass
+
+
+def parse_ids(text):
+
+    # "1,2,5-9" (ranges are inclusive)
+    ids = []
+    for part in text.replace(' ', '').split(','):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        try:
+            ids += range(int(first), int(last or first) + 1)
+        except ValueError:
+            raise BulkInputError(f'{part!r} is not an id or a range of ids')
+    return ids
+
+
+def read_csv_ids(file, column=None):
+
+    # the ids in the named column, or in the first one. a first row that is not a number is a header
+    rows = csv.reader(file)
+    header = next(rows, None)
+    if header is None:
+        return []
+    if column is None:
+        position = 0
+    elif column in header:
+        position = header.index(column)
+    else:
+        raise BulkInputError(f'the file has no {column} column')
+
+    ids = []
+    if column is None and header and header[0].strip().isdigit():
+        ids.append(int(header[0]))
+    for line, row in enumerate(rows, start=2):
+        value = row[position].strip() if len(row) > position else ''
+        if not value:
+            continue
+        if not value.isdigit():
+            raise BulkInputError(f'line {line}: {value!r} is not an id')
+        ids.append(int(value))
+    return ids
+
+
+def _chunks(ids, size):
+    ids = sorted(set(ids))
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+
+def run_bulk(task, ids, dry_run=False, chunk_size=None, progress=None, session=None):
+
+    # returns the counts added up over every chunk
+    session = session or db.session
+    chunk_size = chunk_size or app.config['ADMIN_CHUNK_SIZE']
+    totals, done = Counter(), 0
+
+    for chunk in _chunks(ids, chunk_size):
+        if dry_run:
+            try:
+                counts = task(session, chunk)
+            finally:
+                session.rollback()
+        else:
+            counts = run_in_transaction(lambda: task(session, chunk), session)
+        totals.update(counts)
+        done += len(chunk)
+        if progress:
+            progress(done, totals)
+
+    if not dry_run:
+        availability.invalidate()
+    return totals
+
+
+def _set_active(session, student_ids, active):
+    return session.execute(update(Student).where(Student.student_id.in_(student_ids) & (Student.active.is_(not active)))
+                           .values(active=active).execution_options(synchronize_session=False)).rowcount
+
+
+def deactivate_students(session, student_ids):
+    return {'deactivated': _set_active(session, student_ids, False)}
+
+
+def activate_students(session, student_ids):
+    return {'activated': _set_active(session, student_ids, True)}
+
+
+def _delete_returned_loans(session, key, column, ids):
+
+    # deletes the returned loans (hot and archived) whose column is in ids, and the reminders queued
+    # for them, which would otherwise be left in the outbox for loans that no longer exist. returns
+    # the number deleted
+    kind = archive.ARCHIVES[key]
+    loan_ids = []
+    for model in (kind['loan_model'], kind['archive_model']):
+        loan_ids += session.scalars(delete(model).where(getattr(model, column).in_(ids) & model.returndatetime.is_not(None))
+                                    .returning(model.loan_id).execution_options(synchronize_session=False)).all()
+    if loan_ids:
+        session.execute(delete(Notification)
+                        .where(Notification.idempotency_key.in_(notifications.idempotency_keys(key, loan_ids)))
+                        .execution_options(synchronize_session=False))
+    return len(set(loan_ids))
+
+
+def _open_loan_count(session, loan_model, column, ids):
+    return session.scalar(select(func.count()).select_from(loan_model)
+                          .where(column.in_(ids) & loan_model.returndatetime.is_(None)))
+
+
+def remove_student_loan_records(session, student_ids):
+
+    # loans still out are left alone: deleting them would lose track of the copies they hold
+    return {'device loans': _delete_returned_loans(session, 'device_id', 'student_id', student_ids),
+            'book loans': _delete_returned_loans(session, 'book_id', 'student_id', student_ids),
+            'still out': (_open_loan_count(session, Loan, Loan.student_id, student_ids)
+                          + _open_loan_count(session, BookLoan, BookLoan.student_id, student_ids))}
+
+
+def remove_book_loan_records(session, book_ids):
+    return {'book loans': _delete_returned_loans(session, 'book_id', 'book_id', book_ids),
+            'still out': _open_loan_count(session, BookLoan, BookLoan.book_id, book_ids)}
+
+
+def purge_students(session, student_ids):
+
+    # deletes students with everything of theirs: loans, holds (copies set aside for them go to the next
+    # in line), reminders and fine history. students with loans still out or a fine balance are kept
+    keep = (select(Loan.student_id).where(Loan.student_id.in_(student_ids) & Loan.returndatetime.is_(None))
+            .union(select(BookLoan.student_id).where(BookLoan.student_id.in_(student_ids) & BookLoan.returndatetime.is_(None)),
+                   select(Student.student_id).where(Student.student_id.in_(student_ids) & (Student.fines != 0))))
+    kept = set(session.scalars(keep))
+    purge = session.scalars(select(Student.student_id).where(Student.student_id.in_(student_ids))).all()
+    purge = [student_id for student_id in purge if student_id not in kept]
+    if not purge:
+        return {'students': 0, 'kept': len(kept)}
+
+    holds.remove_student_holds(session, purge)
+    counts = {'device loans': _delete_returned_loans(session, 'device_id', 'student_id', purge),
+              'book loans': _delete_returned_loans(session, 'book_id', 'student_id', purge)}
+    for model in (Notification, FineTransaction):
+        session.execute(delete(model).where(model.student_id.in_(purge)).execution_options(synchronize_session=False))
+    counts['students'] = session.execute(delete(Student).where(Student.student_id.in_(purge))
+                                         .execution_options(synchronize_session=False)).rowcount
+    counts['kept'] = len(kept)
+    return counts
+
+
+TASKS = {
+    'deactivate-students': deactivate_students,
+    'activate-students': activate_students,
+    'remove-student-loans': remove_student_loan_records,
+    'remove-book-loans': remove_book_loan_records,
+    'purge-students': purge_students,
+}
+
+
+def table_counts(connection):
+    return {table.name: connection.scalar(select(func.count()).select_from(table))
+            for table in db.metadata.sorted_tables}
+
+
+def clear_tables():
+
+    # the clear tables view: every table dropped and created again, empty
+    db.drop_all()
+    db.create_all()
+    availability.invalidate()
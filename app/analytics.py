@@ -0,0 +1,136 @@
+from datetime import datetime
+
+from sqlalchemy import String, select, type_coerce
+
+from app import app, db
+from app.fines import FINE_PER_SECOND, MAX_FINE
+from app.models import Loan, BookLoan, LoanArchive, BookLoanArchive
+
+
+# finance reports over the whole loan history. loans and book loans are read in chunks of plain
+# columns straight into numpy arrays, and lateness, fines and the group-by totals are worked out a
+# chunk at a time with array operations, so memory use depends on the chunk size and the number
+# of students and devices, not on the number of loans. archived loans are read after the hot ones.
+# fines follow the same rule as fines.calculate_fine; loans still out are counted up to now.
+# numpy is an optional dependency and is only imported when a report is run
+
+LOAN_TABLES = {
+    'device': dict(models=(Loan, LoanArchive), item_column='device_id'),
+    'book': dict(models=(BookLoan, BookLoanArchive), item_column='book_id'),
+}
+
+class AnalyticsUnavailable(Exception):
+    pass
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise AnalyticsUnavailable('the loan analytics need numpy, install it with "pip install numpy"')
+    return numpy
+
+
+def _chunks(connection, table, chunk_size):
+
+    # (loan ids, item ids, student ids, due times, return times) arrays per chunk. on sqlite the
+    # datetimes are fetched as their stored text and parsed by numpy, which is much faster than
+    # building a python datetime for every value; a loan that is still out has NaT as its return time
+    np = _numpy()
+    as_text = (lambda column: type_coerce(column, String)) if connection.dialect.name == 'sqlite' else (lambda column: column)
+
+    for model in table['models']:
+        statement = select(model.loan_id, getattr(model, table['item_column']), model.student_id,
+                           as_text(model.duedatetime), as_text(model.returndatetime))
+
+        after = 0
+        while True:
+            rows = connection.execute(statement.where(model.loan_id > after).order_by(model.loan_id).limit(chunk_size)).all()
+            if not rows:
+                break
+            loan_ids, item_ids, student_ids, due, returned = zip(*rows)
+            after = loan_ids[-1]
+            yield (np.array(item_ids, dtype=np.int64), np.array(student_ids, dtype=np.int64),
+                   np.array(due, dtype='datetime64[us]'), np.array(returned, dtype='datetime64[us]'))
+
+
+def _add(totals, name, keys, weights=None):
+
+    # running group-by: totals[name][key] += weight, growing the array when a bigger key turns up
+    np = _numpy()
+    counts = np.bincount(keys, weights=weights)
+    current = totals.get(name)
+    if current is None or len(current) < len(counts):
+        grown = np.zeros(len(counts) if current is None else max(len(counts), 2 * len(current)))
+        if current is not None:
+            grown[:len(current)] = current
+        totals[name] = current = grown
+    current[:len(counts)] += counts
+
+
+def _columns(totals, *names):
+
+    # the named totals as arrays of the same length, indexed by key
+    np = _numpy()
+    length = max([len(totals[name]) for name in names if name in totals], default=0)
+    return [np.pad(totals[name], (0, length - len(totals[name]))) if name in totals else np.zeros(length)
+            for name in names]
+
+
+def loan_analytics(connection=None, now=None, chunk_size=None, fine_per_second=FINE_PER_SECOND, max_fine=MAX_FINE):
+    np = _numpy()
+    connection = connection or db.session.connection()
+    now = np.datetime64(now or datetime.now(), 'us')
+    chunk_size = chunk_size or app.config['ANALYTICS_CHUNK_SIZE']
+
+    kinds, totals = {}, {}
+    for kind, table in LOAN_TABLES.items():
+        summary = kinds[kind] = dict(loans=0, returned=0, late=0, overdue_now=0, fines=0)
+
+        for item_ids, student_ids, due, returned_at in _chunks(connection, table, chunk_size):
+            returned = ~np.isnat(returned_at)
+            end = np.where(returned, returned_at, now)
+
+            # whole seconds late, never negative, and the capped fine, as in calculate_fine
+            seconds_late = np.maximum((end - due).astype(np.int64), 0) // 1000000
+            late = seconds_late > 0
+            fines = np.minimum(seconds_late * fine_per_second, max_fine)
+
+            # a fine belongs to the month the item came back, or this month while it is still out
+            months = end.astype('datetime64[M]').astype(np.int64)
+
+            summary['loans'] += len(due)
+            summary['returned'] += int(returned.sum())
+            summary['late'] += int(late.sum())
+            summary['overdue_now'] += int((late & ~returned).sum())
+            summary['fines'] += int(fines.sum())
+
+            _add(totals, 'month loans', months)
+            _add(totals, 'month late', months, late)
+            _add(totals, 'month fines', months, fines)
+            _add(totals, 'student loans', student_ids)
+            _add(totals, 'student late', student_ids, late)
+            _add(totals, 'student seconds late', student_ids, seconds_late)
+            _add(totals, 'student fines', student_ids, fines)
+            if kind == 'device':
+                _add(totals, 'device loans', item_ids)
+                _add(totals, 'device late', item_ids, late)
+
+    loans, late, fines = _columns(totals, 'month loans', 'month late', 'month fines')
+    fines_by_month = [dict(month=str(np.datetime64(int(month), 'M')), loans=int(loans[month]),
+                           late=int(late[month]), fines=int(fines[month]))
+                      for month in np.flatnonzero(loans)]
+
+    loans, late = _columns(totals, 'device loans', 'device late')
+    devices = [dict(device_id=int(device_id), loans=int(loans[device_id]), late=int(late[device_id]),
+                    overdue_rate=round(float(late[device_id] / loans[device_id]), 4))
+               for device_id in np.flatnonzero(loans)]
+
+    loans, late, seconds_late, fines = _columns(totals, 'student loans', 'student late', 'student seconds late', 'student fines')
+    students = [dict(student_id=int(student_id), loans=int(loans[student_id]), late=int(late[student_id]),
+                     average_seconds_late=round(float(seconds_late[student_id] / loans[student_id]), 2),
+                     fines=int(fines[student_id]))
+                for student_id in np.flatnonzero(loans)]
+
+    return dict(generated=str(now.astype('datetime64[s]')), loans=kinds,
+                fines_by_month=fines_by_month, devices=devices, students=students)
@@ -0,0 +1,115 @@
+from flask import Blueprint, current_app, jsonify, request
+from flask_login import login_required
+
+from app import checkout
+from app import analytics
+from app import exports
+from app import resources
+from app.availability import availability
+
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+
+def batch_items():
+
+    # the body must be {"items": [{"student_id": 1, "device_id": 2}, {"student_id": 1, "book_id": 3}, ...]}
+    payload = request.get_json(silent=True)
+    items = payload.get('items') if isinstance(payload, dict) else None
+
+    if not isinstance(items, list) or not items:
+        return None, 'the request body must be a JSON object with a non-empty "items" list'
+    if len(items) > current_app.config['BATCH_MAX_ITEMS']:
+        return None, f'a batch can contain at most {current_app.config["BATCH_MAX_ITEMS"]} items'
+
+    for position, item in enumerate(items):
+        if not isinstance(item, dict) or len(item.keys() & checkout.ITEM_KINDS.keys()) != 1 \
+                or set(item) - {'student_id', 'device_id', 'book_id'} \
+                or not all(type(value) is int and value > 0 for value in item.values()) \
+                or 'student_id' not in item:
+            return None, f'item {position} must have a positive integer student_id and exactly one of device_id or book_id'
+
+    return items, None
+
+
+def batch_response(outcomes):
+    succeeded = sum(1 for outcome in outcomes if outcome['status'] == 'ok')
+    return jsonify(results=outcomes, succeeded=succeeded, failed=len(outcomes) - succeeded)
+
+
+@api.route('/batch/checkout', methods=['POST'])
+@login_required
+def batch_checkout():
+    items, error = batch_items()
+    if error:
+        return jsonify(error=error), 400
+
+    try:
+        return batch_response(checkout.checkout_batch(items))
+    except checkout.CheckoutError as e:
+        return jsonify(error=str(e)), 409
+
+
+@api.route('/batch/return', methods=['POST'])
+@login_required
+def batch_return():
+    items, error = batch_items()
+    if error:
+        return jsonify(error=error), 400
+
+    return batch_response(checkout.return_batch(items))
+
+
+@api.route('/cache-stats')
+@login_required
+def cache_stats():
+    return jsonify(availability=availability.stats())
+
+
+@api.route('/reports/loan-analytics')
+@login_required
+def loan_analytics():
+    try:
+        return jsonify(analytics.loan_analytics())
+    except analytics.AnalyticsUnavailable as e:
+        return jsonify(error=str(e)), 501
+
+
+@api.route('/exports/<name>.<file_format>')
+@login_required
+def export(name, file_format):
+    if name not in exports.EXPORTS or file_format not in exports.FORMATS:
+        return jsonify(error=f'unknown export, the exports are {", ".join(exports.EXPORTS)} '
+                             f'as {" or ".join(exports.FORMATS)}'), 404
+
+    statement, error = exports.export_statement(name, request.args)
+    if error:
+        return jsonify(error=error), 400
+
+    return exports.stream_export(name, statement, file_format, compress=request.args.get('gzip') == '1')
+
+
+RESOURCE_NAMES = ', '.join(f'"{name}"' for name in resources.RESOURCES)
+
+
+@api.route(f'/<any({RESOURCE_NAMES}):name>')
+@login_required
+def resource_list(name):
+    statement, columns, error = resources.list_statement(name, request.args)
+    if error:
+        return jsonify(error=error), 400
+
+    return resources.resource_page(name, statement, columns)
+
+
+@api.route(f'/<any({RESOURCE_NAMES}):name>/<int:item_id>')
+@login_required
+def resource_item(name, item_id):
+    statement, columns, error = resources.list_statement(name, request.args)
+    if error:
+        return jsonify(error=error), 400
+
+    response = resources.resource_item(name, item_id, statement, columns)
+    if response is None:
+        return jsonify(error=f'{name} has no entry with id {item_id}'), 404
+    return response
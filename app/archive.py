@@ -0,0 +1,130 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, literal, select, union
+from sqlalchemy.dialects.sqlite import insert
+
+from app import app, db
+from app.checkout import run_in_transaction
+from app.models import Loan, BookLoan, LoanArchive, BookLoanArchive
+
+
+# loan history archival. returned loans older than the horizon are moved from loans and book loans
+# into their archive tables (in the same database or an attached file), a batch per run of two short
+# transactions: the batch is copied, then deleted from the hot table only where the copy is there.
+# a crash in between (or a commit across two files, which wal mode does not make atomic) leaves
+# rows in both tables, which the next run clears, and the reports read the two with UNION, which
+# drops such duplicates. loan ids are never reused (the loan tables are autoincrement), and a hot
+# loan is only deleted when the archive holds an identical copy of it
+
+ARCHIVES = {
+    'device_id': dict(loan_model=Loan, archive_model=LoanArchive, fine_column='fine'),
+    'book_id': dict(loan_model=BookLoan, archive_model=BookLoanArchive, fine_column='fine_amount'),
+}
+
+
+def _columns(model, key):
+    return [getattr(model, name) for name in ('loan_id', key, 'student_id', 'borrowdatetime', 'duedatetime',
+                                              'returndatetime', ARCHIVES[key]['fine_column'], 'copy_id')]
+
+
+def loan_history(key, column, value):
+
+    # every loan of a device (key device_id) or book (key book_id) whose column equals value, hot or
+    # archived, as rows with the loan table's column names, in loan id order
+    kind = ARCHIVES[key]
+    hot, archived = kind['loan_model'], kind['archive_model']
+    loans = union(select(*_columns(hot, key)).where(getattr(hot, column) == value),
+                  select(*_columns(archived, key)).where(getattr(archived, column) == value)).subquery()
+    return select(loans).order_by(loans.c.loan_id)
+
+
+def has_loans(key, column, value):
+
+    # whether any loan of this kind, hot or archived, has column equal to value
+    kind = ARCHIVES[key]
+    return any(db.session.scalar(select(model.loan_id).where(getattr(model, column) == value).limit(1)) is not None
+               for model in (kind['loan_model'], kind['archive_model']))
+
+
+def archivable(key, horizon, after, batch_size):
+
+    # the next batch of loan ids returned before the horizon, in id order through the primary key.
+    # the last batch of a run reads on to the end of the table, which after archiving holds little
+    # more than the loans of the last ARCHIVE_AFTER_DAYS
+    loans = ARCHIVES[key]['loan_model']
+    return (select(loans.loan_id)
+            .where((loans.loan_id > after) & (loans.returndatetime < horizon))
+            .order_by(loans.loan_id).limit(batch_size))
+
+
+def _batch_range(loans, first, last, horizon):
+    return loans.loan_id.between(first, last) & (loans.returndatetime < horizon)
+
+
+def _copy_batch(session, key, horizon, after, batch_size, now):
+
+    # returns the first and last id of the batch copied, or None when nothing is left to archive
+    kind = ARCHIVES[key]
+    loans, archived = kind['loan_model'], kind['archive_model']
+    loan_ids = session.scalars(archivable(key, horizon, after, batch_size)).all()
+    if not loan_ids:
+        return None
+
+    first, last = loan_ids[0], loan_ids[-1]
+    columns = _columns(loans, key)
+    session.execute(insert(archived).from_select(
+        [column.key for column in columns] + ['archived'],
+        select(*columns, literal(now, archived.archived.type)).where(_batch_range(loans, first, last, horizon)))
+        .on_conflict_do_nothing(index_elements=['loan_id']))
+    return first, last
+
+
+def _delete_batch(session, key, horizon, first, last):
+
+    # deletes the loans of the batch whose archived copy has every column the same, so a row the
+    # archive already held under that id (which _copy_batch left alone) keeps the hot loan
+    kind = ARCHIVES[key]
+    loans, archived = kind['loan_model'], kind['archive_model']
+    copied = select(archived.loan_id).where(*(archived_column.is_not_distinct_from(column) for column, archived_column
+                                              in zip(_columns(loans, key), _columns(archived, key))))
+    return session.execute(
+        delete(loans).where(_batch_range(loans, first, last, horizon) & copied.exists())
+        .execution_options(synchronize_session=False)).rowcount
+
+
+def _create_tables(session):
+
+    # an ARCHIVE_DATABASE set after the upgrade that added the archive tables starts out without them
+    for kind in ARCHIVES.values():
+        kind['archive_model'].__table__.create(session.connection(), checkfirst=True)
+
+
+def archive_loans(session=None, now=None, days=None, batch_size=None, progress=None):
+
+    # one pass over both loan tables. returns the number of loans archived by key
+    session = session or db.session
+    now = now or datetime.now()
+    days = app.config['ARCHIVE_AFTER_DAYS'] if days is None else days
+    batch_size = batch_size or app.config['ARCHIVE_BATCH_SIZE']
+    horizon = now - timedelta(days=days)
+    archived = {}
+
+    run_in_transaction(lambda: _create_tables(session), session)
+    for key in ARCHIVES:
+        archived[key], after = 0, 0
+        while True:
+            batch = run_in_transaction(lambda: _copy_batch(session, key, horizon, after, batch_size, now), session)
+            if batch is None:
+                break
+            archived[key] += run_in_transaction(lambda: _delete_batch(session, key, horizon, *batch), session)
+            after = batch[1]
+            if progress:
+                progress(key, archived[key])
+    return archived
+
+
+def table_sizes(connection):
+
+    # rows in each hot and archive loan table
+    return {model.__tablename__: connection.scalar(select(func.count()).select_from(model))
+            for kind in ARCHIVES.values() for model in (kind['loan_model'], kind['archive_model'])}
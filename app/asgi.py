@@ -0,0 +1,171 @@
+import hashlib
+import hmac
+from contextlib import asynccontextmanager
+
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+from werkzeug.datastructures import MultiDict
+from werkzeug.http import http_date
+from werkzeug.sansio.http import is_resource_modified
+
+from app import app, database
+from app import resources
+from app.pagination import page_args
+from app.search import book_search_statement, student_search_statement
+
+
+# async read-only server for the kiosks and portal that poll availability, search and loan status.
+# it serves the same json resources as /api/v1 (app/resources.py) plus the book and student search,
+# from one event loop over an aiosqlite connection pool, so a few hundred open polls do not each need
+# a worker thread. it shares the models and config with the flask app but not its login sessions,
+# so every request needs the ASYNC_API_TOKEN bearer token. run it with
+#
+#     ASYNC_API_TOKEN=... uvicorn app.asgi:application --workers 4
+#
+# starlette, uvicorn and aiosqlite are only needed for this server
+
+def async_database_url(config):
+    if config['ASYNC_DATABASE_URL']:
+        return config['ASYNC_DATABASE_URL']
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    if url.get_backend_name() != 'sqlite':
+        raise RuntimeError('set ASYNC_DATABASE_URL to an async driver URL for this database')
+    return url.set(drivername='sqlite+aiosqlite')
+
+
+def make_engine(config):
+    engine = create_async_engine(async_database_url(config), **database.engine_options(config))
+    database.apply_pragmas(engine.sync_engine, database.sqlite_pragmas(config))
+    return engine
+
+
+def error(message, status):
+    return JSONResponse(dict(error=message), status_code=status)
+
+
+def conditional(request, payload, last_modified=None):
+
+    # the same validators as the flask resources: an etag over the body, and Last-Modified where
+    # the resource has one. a match is answered with 304 before the body is sent
+    body = resources.dumps(payload)
+    etag = hashlib.sha1(body).hexdigest()
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': 'private, no-cache'}
+    if last_modified is not None:
+        headers['Last-Modified'] = http_date(last_modified)
+
+    if not is_resource_modified(http_if_none_match=request.headers.get('if-none-match'),
+                                http_if_modified_since=request.headers.get('if-modified-since'),
+                                etag=etag, last_modified=last_modified):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type='application/json', headers=headers)
+
+
+def query_args(request):
+    return MultiDict(request.query_params.multi_items())
+
+
+async def resource_list(request):
+    name = request.path_params['name']
+    if name not in resources.RESOURCES:
+        return error(f'unknown resource, the resources are {", ".join(resources.RESOURCES)}', 404)
+
+    args = query_args(request)
+    statement, columns, message = resources.list_statement(name, args)
+    if message:
+        return error(message, 400)
+
+    after, limit = page_args(args, app.config)
+    async with request.app.state.sessions() as session:
+        rows = (await session.execute(resources.page_statement(name, statement, after, limit))).all()
+    return conditional(request, *resources.page_payload(name, rows, columns, limit))
+
+
+async def resource_item(request):
+    name, item_id = request.path_params['name'], request.path_params['item_id']
+    if name not in resources.RESOURCES:
+        return error(f'unknown resource, the resources are {", ".join(resources.RESOURCES)}', 404)
+
+    statement, columns, message = resources.list_statement(name, query_args(request))
+    if message:
+        return error(message, 400)
+
+    async with request.app.state.sessions() as session:
+        row = (await session.execute(resources.item_statement(name, statement, item_id))).first()
+    if row is None:
+        return error(f'{name} has no entry with id {item_id}', 404)
+    return conditional(request, *resources.item_payload(name, row, columns))
+
+
+async def search(request, name, statement):
+
+    # one page of search results as the resource's columns, page= numbered as on the search pages
+    page = max(query_args(request).get('page', 1, type=int), 1)
+    per_page = app.config['SEARCH_PAGE_SIZE']
+    rows = []
+    if statement is not None:
+        async with request.app.state.sessions() as session:
+            rows = (await session.scalars(statement.limit(per_page + 1).offset((page - 1) * per_page))).all()
+
+    names = [column.key for column in resources.RESOURCES[name]['columns']]
+    return conditional(request, dict(data=[{key: getattr(row, key) for key in names} for row in rows[:per_page]],
+                                     next_page=page + 1 if len(rows) > per_page else None))
+
+
+async def search_books(request):
+    params = request.query_params
+    return await search(request, 'books', book_search_statement(params.get('title'), params.get('author'), params.get('genre'),
+                                                                request.app.state.dialect))
+
+
+async def search_students(request):
+    return await search(request, 'students', student_search_statement(request.query_params.get('q'), request.app.state.dialect))
+
+
+class BearerToken:
+
+    # plain asgi middleware, so a rejected request never reaches the routing
+    def __init__(self, asgi_app, token):
+        self.asgi_app = asgi_app
+        self.expected = f'Bearer {token}'.encode()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            supplied = dict(scope['headers']).get(b'authorization', b'')
+            if not hmac.compare_digest(supplied, self.expected):
+                return await error('a valid bearer token is required', 401)(scope, receive, send)
+        await self.asgi_app(scope, receive, send)
+
+
+def create_app(config=None):
+    config = config or app.config
+    if not config['ASYNC_API_TOKEN']:
+        raise RuntimeError('set ASYNC_API_TOKEN before starting the async server')
+
+    @asynccontextmanager
+    async def lifespan(server):
+        engine = make_engine(config)
+        server.state.dialect = engine.dialect.name
+        server.state.sessions = async_sessionmaker(engine, expire_on_commit=False)
+        yield
+        await engine.dispose()
+
+    server = Starlette(routes=[
+        Route('/api/v1/search/books', search_books),
+        Route('/api/v1/search/students', search_students),
+        Route('/api/v1/{name}', resource_list),
+        Route('/api/v1/{name}/{item_id:int}', resource_item),
+    ], lifespan=lifespan)
+    server.add_middleware(BearerToken, token=config['ASYNC_API_TOKEN'])
+    return server
+
+
+def __getattr__(name):
+
+    # uvicorn app.asgi:application builds the server on first use, so importing this module (the
+    # load test does) works without a token
+    if name == 'application':
+        return create_app()
+    raise AttributeError(name)
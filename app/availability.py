@@ -0,0 +1,93 @@
+import hashlib
+import threading
+import time
+
+from flask import make_response, render_template, request
+from flask_login import current_user
+from sqlalchemy import select
+
+from app import app, db
+from app.models import Author, Device, Book
+
+
+# in-process cache of the available devices and books listings, the most viewed pages on the kiosks.
+# entries expire after AVAILABILITY_CACHE_TTL seconds and are dropped straight away whenever this
+# worker adds, lends or takes back a device or book. other workers only notice when their own copy
+# expires, so the ttl is the longest a listing can be out of date
+
+class CachedListing:
+    def __init__(self, rows, ttl):
+        self.rows = rows
+        self.expires = time.monotonic() + ttl
+        self.etag = hashlib.sha1(repr(rows).encode()).hexdigest()
+
+
+class AvailabilityCache:
+    def __init__(self, loaders):
+        self.loaders = loaders
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.invalidations = self.not_modified = 0
+
+    def get(self, name):
+        entry = self.entries.get(name)
+        if entry and entry.expires > time.monotonic():
+            with self.lock:
+                self.hits += 1
+            return entry
+
+        entry = CachedListing(self.loaders[name](), app.config['AVAILABILITY_CACHE_TTL'])
+        with self.lock:
+            self.misses += 1
+            self.entries[name] = entry
+        return entry
+
+    def invalidate(self, *names):
+        with self.lock:
+            for name in names or list(self.loaders):
+                if self.entries.pop(name, None):
+                    self.invalidations += 1
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, invalidations=self.invalidations,
+                    not_modified=self.not_modified, ttl=app.config['AVAILABILITY_CACHE_TTL'])
+
+
+AVAILABLE_DEVICES = (
+    select(Device.device_id, Device.device_name, Device.device_quantity, Device.loan_period)
+    .where(Device.device_quantity >= 1).order_by(Device.device_id))
+
+AVAILABLE_BOOKS = (
+    select(Book.book_id, Book.book_title, Author.author_firstname, Author.author_lastname, Book.genre,
+           Book.number_of_pages, Book.quantity, Book.loan_period)
+    .join(Book.author).where(Book.quantity > 0).order_by(Book.book_id))
+
+
+def load_available_devices():
+    return [row._asdict() for row in db.session.execute(AVAILABLE_DEVICES)]
+
+
+def load_available_books():
+    return [row._asdict() for row in db.session.execute(AVAILABLE_BOOKS)]
+
+
+availability = AvailabilityCache({'devices': load_available_devices, 'books': load_available_books})
+
+
+def render_listing(name, template_name, rows_name):
+
+    # the etag covers the cached rows and the logged in user (the navigation bar shows their name).
+    # when the browser already has this version it gets a 304 before any query or template render
+    entry = availability.get(name)
+    etag = f'{entry.etag}-{current_user.get_id()}'
+
+    if request.if_none_match.contains_weak(etag):
+        with availability.lock:
+            availability.not_modified += 1
+        response = make_response('', 304)
+    else:
+        response = make_response(render_template(template_name, **{rows_name: entry.rows}))
+
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
@@ -0,0 +1,526 @@
+import random
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, insert, select, update
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import aliased
+
+from app import app, db
+from app import inventory
+from app.models import Device, Book, Loan, BookLoan, Student, FineTransaction, Hold, Copy
+from app.fines import calculate_fine
+from app.availability import availability
+
+
+# checkout and return of devices and books. stock is reserved with a single conditional UPDATE
+# (quantity = quantity - 1 ... AND quantity > 0), so two workers can never both take the last copy,
+# and the copy that goes out is marked and the loan created in the same transaction. once that
+# UPDATE has run this transaction holds sqlite's write lock, so the per-student loan limit checked
+# afterwards cannot change underneath it. a returned copy goes to the next student queueing for its
+# item (see shelve) before it goes back on the shelf, and that student later collects it without
+# touching the counter
+
+MAX_OPEN_DEVICE_LOANS = 1
+MAX_OPEN_BOOK_LOANS = 2
+DEFAULT_LOAN_PERIOD = 30
+
+
+class CheckoutError(Exception):
+    pass
+
+
+def _take_copy(session, key, item_id, barcode=None):
+
+    # the copy lent out. the counter has just said one is free, so finding none means the counter
+    # and the copies disagree (or the barcode is wrong), and the transaction is rolled back
+    copy_ids = inventory.take_copies(session, key, item_id, barcode=barcode)
+    if not copy_ids:
+        raise CheckoutError(f'no copy with the barcode {barcode} is on the shelf' if barcode else
+                            'the stock count is out of step with the copies, run flask library reconcile-inventory')
+    return copy_ids[0]
+
+
+def is_busy(error):
+    return 'database is locked' in str(error.orig) or 'database is busy' in str(error.orig)
+
+
+def run_in_transaction(work, session=None):
+
+    # run work() and commit. if sqlite reports the database as busy the whole transaction is rolled
+    # back and retried with exponential backoff (with jitter so competing workers spread out)
+    session = session or db.session
+    retries = app.config['CHECKOUT_RETRIES']
+
+    for attempt in range(retries):
+        try:
+            result = work()
+            session.commit()
+            return result
+        except OperationalError as e:
+            session.rollback()
+            if not is_busy(e) or attempt == retries - 1:
+                raise
+            time.sleep(app.config['CHECKOUT_RETRY_DELAY'] * 2 ** attempt * random.uniform(0.5, 1.5))
+        except Exception:
+            session.rollback()
+            raise
+
+
+def _reserve(session, model, id_column, quantity_column, item_id):
+
+    # take one copy if any are left, returning the loan period, or None when out of stock
+    row = session.execute(
+        update(model)
+        .where((id_column == item_id) & (quantity_column > 0))
+        .values({quantity_column: quantity_column - 1})
+        .returning(model.loan_period)
+        .execution_options(synchronize_session=False)
+    ).first()
+
+    if row is None:
+        return None
+    return row.loan_period or DEFAULT_LOAN_PERIOD
+
+
+def _loan_period(session, model, id_column, item_id):
+    return session.scalar(select(model.loan_period).where(id_column == item_id)) or DEFAULT_LOAN_PERIOD
+
+
+def _collect_hold(session, key, item_id, student_id, barcode=None):
+
+    # a student collecting the copy set aside for them takes it without touching the shelf count.
+    # the hold is claimed with one update that only matches it while it is still ready, so a hold
+    # that expired or was cancelled in the meantime (its copy passed on) is not collected. returns
+    # that copy's id, or None when they have no ready hold for the item (or it is another copy)
+    ready = select(Hold.hold_id).where((Hold.student_id == student_id) & (getattr(Hold, key) == item_id)
+                                       & (Hold.status == 'ready'))
+    if barcode:
+        ready = ready.join(Copy, Copy.copy_id == Hold.copy_id).where(Copy.barcode == barcode)
+    return session.scalar(update(Hold).where((Hold.hold_id == ready.limit(1).scalar_subquery()) & (Hold.status == 'ready'))
+                          .values(status='collected')
+                          .returning(Hold.copy_id)
+                          .execution_options(synchronize_session=False))
+
+
+def _open_loans(session, loan_model, student_id):
+    return session.scalar(select(func.count()).select_from(loan_model).where(
+        (loan_model.student_id == student_id) & (loan_model.returndatetime.is_(None))))
+
+
+def checkout_device(student_id, device_id, session=None, barcode=None):
+    session = session or db.session
+
+    def work():
+        copy_id = _collect_hold(session, 'device_id', device_id, student_id, barcode)
+        if copy_id:
+            loan_period = _loan_period(session, Device, Device.device_id, device_id)
+        else:
+            loan_period = _reserve(session, Device, Device.device_id, Device.device_quantity, device_id)
+        if loan_period is None:
+            raise CheckoutError('There are no more of these devices available to loan. Please wait unitl one is returned')
+
+        if _open_loans(session, Loan, student_id) >= MAX_OPEN_DEVICE_LOANS:
+            raise CheckoutError('This student cannot borrow another item until the previous loan has been returned')
+
+        now = datetime.now()
+        loan = Loan(device_id=device_id, student_id=student_id, borrowdatetime=now,
+                    duedatetime=now + timedelta(seconds=loan_period),
+                    copy_id=copy_id or _take_copy(session, 'device_id', device_id, barcode))
+        session.add(loan)
+        return loan
+
+    loan = run_in_transaction(work, session)
+    availability.invalidate('devices')
+    return loan
+
+
+def checkout_book(student_id, book_id, session=None, barcode=None):
+    session = session or db.session
+
+    def work():
+        copy_id = _collect_hold(session, 'book_id', book_id, student_id, barcode)
+        if copy_id:
+            loan_period = _loan_period(session, Book, Book.book_id, book_id)
+        else:
+            loan_period = _reserve(session, Book, Book.book_id, Book.quantity, book_id)
+        if loan_period is None:
+            raise CheckoutError('There are no more copies of this book available to loan. Please wait unitl one is returned')
+
+        if _open_loans(session, BookLoan, student_id) >= MAX_OPEN_BOOK_LOANS:
+            raise CheckoutError('This student has reached their maximum loan limit. Please return a book before attempting to loan another one')
+
+        now = datetime.now()
+        loan = BookLoan(book_id=book_id, student_id=student_id, borrowdatetime=now,
+                        duedatetime=now + timedelta(seconds=loan_period),
+                        copy_id=copy_id or _take_copy(session, 'book_id', book_id, barcode))
+        session.add(loan)
+        return loan
+
+    loan = run_in_transaction(work, session)
+    availability.invalidate('books')
+    return loan
+
+
+def hand_over(key, item_id, copy_id, now):
+
+    # the update that sets a copy aside for the next student queueing for the item who could borrow
+    # it now: active, and below the loan limit counting the copies already set aside for them. the
+    # queue is read through its partial index, so this is one seek however long the queue is
+    kind = ITEM_KINDS[key]
+    loan_model, queued, set_aside = kind['loan_model'], aliased(Hold), aliased(Hold)
+    holding = (select(func.count()).select_from(loan_model)
+               .where((loan_model.student_id == queued.student_id) & loan_model.returndatetime.is_(None))
+               .scalar_subquery()
+               + select(func.count()).select_from(set_aside)
+               .where((set_aside.student_id == queued.student_id) & (set_aside.status == 'ready')
+                      & getattr(set_aside, key).isnot(None))
+               .scalar_subquery())
+    next_in_line = (select(queued.hold_id).join(Student, Student.student_id == queued.student_id)
+                    .where((getattr(queued, key) == item_id) & (queued.status == 'waiting')
+                           & Student.active.is_(True) & (holding < kind['limit']))
+                    .order_by(queued.hold_id).limit(1).scalar_subquery())
+    return (update(Hold).where(Hold.hold_id == next_in_line)
+            .values(status='ready', copy_id=copy_id, expires=now + timedelta(seconds=app.config['HOLD_PICKUP_PERIOD']))
+            .returning(Hold.student_id)
+            .execution_options(synchronize_session=False))
+
+
+def _hand_to_holds(session, key, item_id, copy_ids, now):
+
+    # returns {copy id: student id} for the copies set aside, stopping at the first that finds nobody
+    handed = {}
+    for copy_id in copy_ids:
+        row = session.execute(hand_over(key, item_id, copy_id, now)).first()
+        if row is None:
+            break
+        handed[copy_id] = row.student_id
+    return handed
+
+
+def shelve(session, key, item_id, copy_ids, now=None):
+
+    # copies of an item coming back (returned, or released by a hold). they go to the students
+    # queueing for it first and the rest back on the shelf, which moves the counter. a loan from
+    # before copies were tracked has no copy and only moves the counter. returns {copy id: student id}
+    # of the copies set aside
+    kind = ITEM_KINDS[key]
+    handed = _hand_to_holds(session, key, item_id, [copy_id for copy_id in copy_ids if copy_id is not None],
+                            now or datetime.now())
+    if len(copy_ids) > len(handed):
+        session.execute(update(kind['model']).where(kind['id_column'] == item_id)
+                        .values({kind['quantity_column']: kind['quantity_column'] + len(copy_ids) - len(handed)})
+                        .execution_options(synchronize_session=False))
+        inventory.put_back(session, [copy_id for copy_id in copy_ids if copy_id not in handed])
+    return handed
+
+
+def _close_loans(key, loan_ids, now):
+
+    # the update that marks those of the loans still out as returned, returning their ids and their
+    # fines so far. it runs under the write lock, so the fines are those the accrual sweep last
+    # committed rather than what was read when the loan was loaded
+    kind = ITEM_KINDS[key]
+    loan_model = kind['loan_model']
+    return (update(loan_model).where(loan_model.loan_id.in_(loan_ids) & loan_model.returndatetime.is_(None))
+            .values(returndatetime=now)
+            .returning(loan_model.loan_id, getattr(loan_model, kind['fine_column']))
+            .execution_options(synchronize_session=False))
+
+
+def _check_in(session, loan, key):
+
+    # close the loan, hand the copy to the next student queueing for it or put it back on the shelf,
+    # and charge any fine. returns the fine in pence, how late the item was and the student the copy
+    # was set aside for, if any (the loan is expired once committed)
+    kind = ITEM_KINDS[key]
+    now = datetime.now()
+
+    # the loan is closed only if it is still out, so of two clerks returning it at once the second
+    # gets an error instead of shelving the copy again. this update also takes the write lock
+    closed = session.execute(_close_loans(key, [loan.loan_id], now)).first()
+    if closed is None:
+        raise CheckoutError(f'this {key[:-3]} has already been returned')
+    late_by = now - loan.duedatetime
+    held_for = shelve(session, key, getattr(loan, key), [loan.copy_id], now).get(loan.copy_id)
+
+    # the accrual sweep may already have charged part of the fine while the loan was overdue,
+    # so only the rest of it is charged now
+    fine = closed[1] or 0
+    charge = calculate_fine(loan.duedatetime, now) - fine
+    if charge > 0:
+        fine += charge
+        setattr(loan, kind['fine_column'], fine)
+        session.get(Student, loan.student_id).charge_fine(charge, kind['reason'], **{kind['ledger_column']: loan.loan_id})
+    return fine, late_by, held_for
+
+
+def return_device(loan, session=None):
+    session = session or db.session
+    result = run_in_transaction(lambda: _check_in(session, loan, 'device_id'), session)
+    availability.invalidate('devices')
+    return result
+
+
+def return_book(loan, session=None):
+    session = session or db.session
+    result = run_in_transaction(lambda: _check_in(session, loan, 'book_id'), session)
+    availability.invalidate('books')
+    return result
+
+
+# batch checkout and return. every item in the batch is validated against a handful of set-based
+# queries (one per table rather than one per item), then all the valid items are applied in a single
+# transaction. each item gets its own outcome, so one bad row does not fail the rest of the batch
+
+ITEM_KINDS = {
+    'device_id': dict(model=Device, id_column=Device.device_id, quantity_column=Device.device_quantity,
+                      loan_model=Loan, limit=MAX_OPEN_DEVICE_LOANS, fine_column='fine', ledger_column='loan_id',
+                      reason='device loan',
+                      out_of_stock='There are no more of these devices available to loan. Please wait unitl one is returned',
+                      over_limit='This student cannot borrow another item until the previous loan has been returned'),
+    'book_id': dict(model=Book, id_column=Book.book_id, quantity_column=Book.quantity,
+                    loan_model=BookLoan, limit=MAX_OPEN_BOOK_LOANS, fine_column='fine_amount', ledger_column='book_loan_id',
+                    reason='book loan',
+                    out_of_stock='There are no more copies of this book available to loan. Please wait unitl one is returned',
+                    over_limit='This student has reached their maximum loan limit. Please return a book before attempting to loan another one'),
+}
+
+
+class StockChanged(Exception):
+    pass
+
+
+def item_kind(item):
+    return 'device_id' if 'device_id' in item else 'book_id'
+
+
+def _open_loan_counts(session, loan_model, student_ids):
+    return dict(session.execute(
+        select(loan_model.student_id, func.count())
+        .where(loan_model.student_id.in_(student_ids) & loan_model.returndatetime.is_(None))
+        .group_by(loan_model.student_id)).all())
+
+
+def _plan_checkout(session, items):
+
+    # decide which items can be checked out, without writing anything yet
+    student_ids = {item['student_id'] for item in items}
+    students = {student.student_id: student for student in
+                session.scalars(select(Student).where(Student.student_id.in_(student_ids)))}
+
+    stock, loan_periods, loan_counts, ready = {}, {}, {}, {}
+    for key, kind in ITEM_KINDS.items():
+        item_ids = {item[key] for item in items if item_kind(item) == key}
+        if not item_ids:
+            continue
+        for item_id, quantity, loan_period in session.execute(
+                select(kind['id_column'], kind['quantity_column'], kind['model'].loan_period)
+                .where(kind['id_column'].in_(item_ids))):
+            stock[key, item_id] = quantity
+            loan_periods[key, item_id] = loan_period or DEFAULT_LOAN_PERIOD
+        for student_id, count in _open_loan_counts(session, kind['loan_model'], student_ids).items():
+            loan_counts[key, student_id] = count
+
+        # copies set aside for students in the batch, which they collect instead of taking stock
+        for hold_id, item_id, student_id, copy_id in session.execute(
+                select(Hold.hold_id, getattr(Hold, key), Hold.student_id, Hold.copy_id)
+                .where(getattr(Hold, key).in_(item_ids) & Hold.student_id.in_(student_ids) & (Hold.status == 'ready'))
+                .order_by(Hold.hold_id)):
+            ready.setdefault((key, item_id, student_id), []).append((hold_id, copy_id))
+
+    outcomes, accepted, collected = [], [], {}
+    for item in items:
+        key = item_kind(item)
+        kind = ITEM_KINDS[key]
+        student = students.get(item['student_id'])
+
+        if not student:
+            error = 'There is no student with this id in the system'
+        elif not student.active:
+            error = 'This student has been deactivated and cannot borrow'
+        elif (key, item[key]) not in stock:
+            error = f'this {key[:-3]} does not exist'
+        elif stock[key, item[key]] <= 0 and not ready.get((key, item[key], item['student_id'])):
+            error = kind['out_of_stock']
+        elif loan_counts.get((key, item['student_id']), 0) >= kind['limit']:
+            error = kind['over_limit']
+        else:
+            error = None
+            if ready.get((key, item[key], item['student_id'])):
+                hold_id, collected[hold_id] = ready[key, item[key], item['student_id']].pop(0)
+                item['hold_id'] = hold_id
+            else:
+                stock[key, item[key]] -= 1
+            loan_counts[key, item['student_id']] = loan_counts.get((key, item['student_id']), 0) + 1
+            accepted.append(item)
+
+        if error:
+            item.update(status='error', error=error)
+        else:
+            item.update(status='ok')
+        outcomes.append(item)
+
+    return outcomes, accepted, loan_periods, collected
+
+
+def _take_stock(session, key, accepted):
+
+    # one guarded UPDATE per distinct device or book, returning the copies taken for each. if another
+    # worker took copies since the batch was planned, the guard fails and the whole batch is planned again
+    kind = ITEM_KINDS[key]
+    wanted = {}
+    for item in accepted:
+        if item_kind(item) == key and 'hold_id' not in item:
+            wanted[item[key]] = wanted.get(item[key], 0) + 1
+
+    copies = {}
+    for item_id, count in wanted.items():
+        result = session.execute(
+            update(kind['model'])
+            .where((kind['id_column'] == item_id) & (kind['quantity_column'] >= count))
+            .values({kind['quantity_column']: kind['quantity_column'] - count})
+            .execution_options(synchronize_session=False))
+        if result.rowcount != 1:
+            raise StockChanged()
+
+        # the copies going out, handed to the item's loans in order
+        copies[key, item_id] = inventory.take_copies(session, key, item_id, count)
+        if len(copies[key, item_id]) != count:
+            raise CheckoutError('the stock count is out of step with the copies, run flask library reconcile-inventory')
+    return copies
+
+
+def checkout_batch(items, session=None):
+
+    # items are dicts with a student_id and either a device_id or a book_id
+    session = session or db.session
+
+    def work(items):
+        outcomes, accepted, loan_periods, collected = _plan_checkout(session, items)
+
+        copies = {}
+        for key in ITEM_KINDS:
+            copies.update(_take_stock(session, key, accepted))
+        # a hold that expired or was cancelled since the batch was planned has had its copy passed
+        # on, so the batch is planned again without it
+        if collected and session.execute(update(Hold).where(Hold.hold_id.in_(collected) & (Hold.status == 'ready'))
+                                         .values(status='collected')
+                                         .execution_options(synchronize_session=False)).rowcount != len(collected):
+            raise StockChanged()
+
+        # this transaction now holds the write lock, so the loan counts can be checked once more
+        student_ids = {item['student_id'] for item in accepted}
+        for key, kind in ITEM_KINDS.items():
+            for student_id, count in _open_loan_counts(session, kind['loan_model'], student_ids).items():
+                planned = sum(1 for item in accepted if item_kind(item) == key and item['student_id'] == student_id)
+                if count + planned > kind['limit']:
+                    raise StockChanged()
+
+        # the loans of each kind are written with one executemany insert and their ids read back in one
+        # query. nothing else can insert loans while this transaction holds the lock, so the new ids
+        # are exactly those above the previous maximum, in insert order
+        now = datetime.now()
+        for key, kind in ITEM_KINDS.items():
+            loan_model = kind['loan_model']
+            batch = [item for item in accepted if item_kind(item) == key]
+            if not batch:
+                continue
+
+            last_loan_id = session.scalar(select(func.coalesce(func.max(loan_model.loan_id), 0)))
+            session.execute(insert(loan_model), [
+                {'student_id': item['student_id'], key: item[key], 'borrowdatetime': now,
+                 'duedatetime': now + timedelta(seconds=loan_periods[key, item[key]]),
+                 'copy_id': collected[item['hold_id']] if 'hold_id' in item else copies[key, item[key]].pop(0)}
+                for item in batch])
+            new_loans = session.execute(select(loan_model.loan_id, loan_model.duedatetime)
+                                        .where(loan_model.loan_id > last_loan_id).order_by(loan_model.loan_id))
+
+            for item, (loan_id, duedatetime) in zip(batch, new_loans):
+                item.update(loan_id=loan_id, duedatetime=duedatetime.isoformat())
+        return outcomes
+
+    # every attempt starts from fresh copies of the items, as the outcomes are written into them
+    for attempt in range(app.config['CHECKOUT_RETRIES']):
+        try:
+            outcomes = run_in_transaction(lambda: work([dict(item) for item in items]), session)
+        except StockChanged:
+            continue
+        availability.invalidate()
+        return outcomes
+    raise CheckoutError('the batch could not be applied because stock kept changing, please try again')
+
+
+def return_batch(items, session=None):
+    session = session or db.session
+
+    def work(items):
+        now = datetime.now()
+        outcomes = []
+        open_loans = {}
+        ledger = []
+
+        for key, kind in ITEM_KINDS.items():
+            item_ids = {item[key] for item in items if item_kind(item) == key}
+            if item_ids:
+                loan_model = kind['loan_model']
+                for loan in session.scalars(select(loan_model).where(
+                        getattr(loan_model, key).in_(item_ids) & loan_model.returndatetime.is_(None))
+                        .order_by(loan_model.loan_id)):
+                    open_loans.setdefault((key, getattr(loan, key), loan.student_id), []).append(loan)
+
+        # the loans were read before this transaction took the write lock, so they are closed with one
+        # update per loan table that only matches those still out, and reads back their fines under
+        # the lock. a loan another worker returned in the meantime is reported as not on loan, and
+        # its copy is not shelved twice
+        chosen = []
+        for item in items:
+            key = item_kind(item)
+            loans = open_loans.get((key, item[key], item['student_id']))
+            chosen.append(loans.pop(0) if loans else None)
+        closed = {}
+        for key in ITEM_KINDS:
+            loan_ids = [loan.loan_id for item, loan in zip(items, chosen) if loan and item_kind(item) == key]
+            if loan_ids:
+                closed.update(((key, loan_id), fine) for loan_id, fine in
+                              session.execute(_close_loans(key, loan_ids, now)))
+
+        returned, fined, returned_copies = {key: {} for key in ITEM_KINDS}, {}, {}
+        for item, loan in zip(items, chosen):
+            key = item_kind(item)
+            if not loan or (key, loan.loan_id) not in closed:
+                outcomes.append(dict(item, status='error', error=f'this {key[:-3]} is not on loan to this student'))
+                continue
+
+            # fines for the whole batch are worked out in this one pass, less whatever the accrual
+            # sweep has already charged
+            kind = ITEM_KINDS[key]
+            fine = closed[key, loan.loan_id] or 0
+            charge = calculate_fine(loan.duedatetime, now) - fine
+            if charge > 0:
+                fine += charge
+                setattr(loan, kind['fine_column'], fine)
+                ledger.append({'student_id': loan.student_id, 'amount': charge, 'reason': kind['reason'],
+                               'created': now, kind['ledger_column']: loan.loan_id})
+                fined[loan.student_id] = fined.get(loan.student_id, 0) + charge
+
+            returned[key].setdefault(item[key], []).append(loan.copy_id)
+            outcomes.append(dict(item, status='ok', loan_id=loan.loan_id, fine=fine))
+            returned_copies[loan.copy_id] = outcomes[-1]
+
+        # each item's copies go to its queue first and the rest back on the shelf, one counter update per item
+        for key, copies in returned.items():
+            for item_id, copy_ids in copies.items():
+                for copy_id, student_id in shelve(session, key, item_id, copy_ids, now).items():
+                    returned_copies[copy_id]['held_for'] = student_id
+
+        if ledger:
+            session.execute(insert(FineTransaction), ledger)
+        for student_id, amount in fined.items():
+            session.execute(update(Student).where(Student.student_id == student_id)
+                            .values(fines=Student.fines + amount).execution_options(synchronize_session=False))
+        return outcomes
+
+    outcomes = run_in_transaction(lambda: work([dict(item) for item in items]), session)
+    availability.invalidate()
+    return outcomes
@@ -0,0 +1,227 @@
+import json
+import time
+
+import click
+from flask.cli import AppGroup
+
+from app import app
+from app import migrations
+from app import importer
+from app import fines
+from app import accrual
+from app import analytics
+from app import db
+from app import query_plans
+from app import instrumentation
+from app import inventory
+from app import holds
+from app import checkout
+from app import notifications
+from app import admin
+from app import archive
+from app.availability import availability
+
+
+library_cli = AppGroup('library', help='Library administration commands.')
+
+
+@library_cli.command('upgrade-db')
+def upgrade_db():
+    """Bring an existing database up to the current schema."""
+    applied = migrations.upgrade()
+    for name in applied:
+        click.echo(f'applied {name}')
+    click.echo('database is up to date' if not applied else f'{len(applied)} migration(s) applied')
+
+
+@library_cli.command('import-books')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'file_format', type=click.Choice(sorted(importer.READERS)),
+              help='File format, guessed from the extension when not given.')
+@click.option('--batch-size', default=5000, show_default=True, help='Books inserted per transaction.')
+def import_books(path, file_format, batch_size):
+    """Bulk load books from a books.txt style file, CSV or JSON Lines."""
+    books, authors = importer.import_books(path, file_format, batch_size,
+                                           progress=lambda count: click.echo(f'{count} books imported'))
+    click.echo(f'done: {books} books and {authors} new authors added')
+
+
+@library_cli.command('rebuild-fines')
+def rebuild_fines():
+    """Recompute every student's fine balance from the fine transaction ledger."""
+    with db.engine.begin() as connection:
+        corrected = fines.rebuild_balances(connection)
+    click.echo(f'{corrected} balance(s) corrected')
+
+
+@library_cli.command('reconcile-inventory')
+@click.option('--dry-run', is_flag=True, help='Only report what is out of step.')
+def reconcile_inventory(dry_run):
+    """Check every copy's on loan flag and every stock count against the open loans and holds, and fix them."""
+    with db.engine.begin() as connection:
+        results = inventory.reconcile(connection, repair=not dry_run)
+    for key, (copies, counters) in results.items():
+        kind = key[:-3]
+        click.echo(f'{kind}s: {copies} copy flag(s) and {counters} stock count(s) '
+                   + ('out of step' if dry_run else 'corrected'))
+    if not dry_run:
+        availability.invalidate()
+
+
+@library_cli.command('expire-holds')
+@click.option('--batch-size', type=int, help='Holds expired per transaction (HOLD_EXPIRY_BATCH_SIZE by default).')
+def expire_holds(batch_size):
+    """Expire the holds not collected in time and pass their copies to the next students in line."""
+    expired = holds.expire_holds(batch_size=batch_size)
+    click.echo(f'{expired} hold(s) expired')
+
+
+@library_cli.command('accrue-fines')
+@click.option('--batch-size', type=int, help='Loans charged per transaction (FINE_ACCRUAL_BATCH_SIZE by default).')
+def accrue_fines(batch_size):
+    """Charge the fines building up on overdue loans that are still out."""
+    charged = accrual.accrue_fines(batch_size=batch_size)
+    click.echo(f'{charged} overdue loan(s) charged')
+
+
+@library_cli.command('scan-notifications')
+@click.option('--batch-size', type=int, help='Messages queued per transaction (NOTIFICATION_BATCH_SIZE by default).')
+def scan_notifications(batch_size):
+    """Queue reminders for the loans due back soon and the overdue loans not reminded yet."""
+    queued = notifications.scan_notifications(batch_size=batch_size)
+    for key in checkout.ITEM_KINDS:
+        for window in notifications.WINDOWS:
+            kind = notifications.notification_kind(key, window)
+            click.echo(f'{kind}: {queued[kind]} queued')
+
+
+@library_cli.command('send-notifications')
+@click.option('--workers', type=int, help='Sender threads (NOTIFICATION_WORKERS by default).')
+@click.option('--batch-size', type=int, help='Messages claimed at a time by a thread (NOTIFICATION_BATCH_SIZE by default).')
+@click.option('--sender', help='file, smtp or module:callable (NOTIFICATION_SENDER by default).')
+def send_notifications(workers, batch_size, sender):
+    """Send the queued reminders that are due for an attempt."""
+    start = time.perf_counter()
+    try:
+        sender = notifications.get_sender(sender)
+    except (ValueError, ImportError, AttributeError) as e:
+        raise click.ClickException(str(e))
+    totals = notifications.send_notifications(workers, batch_size, sender)
+    seconds = time.perf_counter() - start
+    click.echo(f'{totals["sent"]} sent, {totals["retried"]} to retry and {totals["failed"]} failed '
+               f'in {seconds:.1f}s ({totals["sent"] / seconds if seconds else 0:.0f} messages/s)')
+
+
+def bulk_command(name, kind, help_text):
+
+    # a command running admin.TASKS[name] over the ids given with --ids and/or --csv
+    def run(ids, csv_file, column, dry_run, chunk_size):
+        try:
+            selected = admin.parse_ids(ids or '') + (admin.read_csv_ids(csv_file, column) if csv_file else [])
+        except admin.BulkInputError as e:
+            raise click.BadParameter(str(e))
+        if not selected:
+            raise click.UsageError(f'give the {kind} ids with --ids or --csv')
+
+        total = len(set(selected))
+        start = time.perf_counter()
+        totals = admin.run_bulk(admin.TASKS[name], selected, dry_run=dry_run, chunk_size=chunk_size,
+                                progress=lambda done, counts: click.echo(
+                                    f'{done}/{total} {kind}s: ' + ', '.join(f'{count} {what}' for what, count in counts.items())))
+        summary = ', '.join(f'{count} {what}' for what, count in totals.items())
+        click.echo(f'{"dry run, nothing changed" if dry_run else "done"} in {time.perf_counter() - start:.1f}s: {summary}')
+
+    run.__doc__ = help_text
+    command = click.option('--chunk-size', type=int, help='Ids per transaction (ADMIN_CHUNK_SIZE by default).')(run)
+    command = click.option('--dry-run', is_flag=True, help='Count what would change, then roll it back.')(command)
+    command = click.option('--column', help='CSV column holding the ids (the first one by default).')(command)
+    command = click.option('--csv', 'csv_file', type=click.File(), help=f'CSV file of {kind} ids, - for stdin.')(command)
+    command = click.option('--ids', help=f'{kind.capitalize()} ids, for example 1,2,10-250.')(command)
+    return library_cli.command(name)(command)
+
+
+bulk_command('deactivate-students', 'student', 'Deactivate students in bulk.')
+bulk_command('activate-students', 'student', 'Activate students in bulk.')
+bulk_command('remove-student-loans', 'student', 'Delete the returned device and book loans of students in bulk.')
+bulk_command('remove-book-loans', 'book', 'Delete the returned loans of books in bulk.')
+bulk_command('purge-students', 'student',
+             'Delete students with their loans, holds, reminders and fine history, keeping any with loans out or a balance.')
+
+
+@library_cli.command('clear-tables')
+@click.option('--dry-run', is_flag=True, help='Only show how many rows each table has.')
+@click.option('--yes', is_flag=True, help='Do not ask for confirmation.')
+def clear_tables(dry_run, yes):
+    """Empty every table, as the clear tables page does."""
+    with db.engine.connect() as connection:
+        counts = admin.table_counts(connection)
+    for table, count in counts.items():
+        click.echo(f'{table}: {count} row(s)')
+    if not dry_run:
+        if not yes:
+            click.confirm('This deletes every row of every table, users included. Continue?', abort=True)
+        admin.clear_tables()
+        click.echo(f'{sum(counts.values())} row(s) deleted')
+
+
+@library_cli.command('archive-loans')
+@click.option('--days', type=float, help='Archive loans returned more than this many days ago (ARCHIVE_AFTER_DAYS by default).')
+@click.option('--batch-size', type=int, help='Loans moved per batch (ARCHIVE_BATCH_SIZE by default).')
+def archive_loans(days, batch_size):
+    """Move old returned loans out of the loan tables into the archive."""
+    start = time.perf_counter()
+    archived = archive.archive_loans(days=days, batch_size=batch_size,
+                                     progress=lambda key, count: click.echo(f'{count} {key[:-3]} loans archived'))
+    with db.engine.connect() as connection:
+        sizes = archive.table_sizes(connection)
+    click.echo(f'done in {time.perf_counter() - start:.1f}s: {archived["device_id"]} device and '
+               f'{archived["book_id"]} book loans archived')
+    for table, count in sizes.items():
+        click.echo(f'{table}: {count} row(s)')
+
+
+@library_cli.command('loan-analytics')
+@click.option('--output', type=click.File('w'), default='-', help='Write the JSON report to this file instead of stdout.')
+@click.option('--chunk-size', type=int, help='Loan rows read at a time (ANALYTICS_CHUNK_SIZE by default).')
+def loan_analytics(output, chunk_size):
+    """Fines by month, overdue rate per device and lateness per student over every loan."""
+    try:
+        report = analytics.loan_analytics(chunk_size=chunk_size)
+    except analytics.AnalyticsUnavailable as e:
+        raise click.ClickException(str(e))
+    json.dump(report, output, indent=2)
+    output.write('\n')
+
+
+@library_cli.command('check-query-plans')
+@click.option('--verbose', is_flag=True, help='Print the plan of every query, not only the ones that fail.')
+def check_query_plans(verbose):
+    """Fail if any of the queries behind the main views scans a whole table."""
+    failed = 0
+    for name, plans in query_plans.check_hot_queries():
+        scans = [detail for statement, plan, full_scans in plans for detail in full_scans]
+        if scans:
+            failed += 1
+        if scans or verbose:
+            click.echo(f"{'FAIL' if scans else 'ok'}  {name}")
+            for statement, plan, full_scans in plans:
+                for detail in plan:
+                    click.echo(f'      {detail}')
+    if failed:
+        raise click.ClickException(f'{failed} query plan(s) scan a whole table')
+    click.echo('every query plan uses an index')
+
+
+@library_cli.command('check-query-counts')
+def check_query_counts():
+    """Fail if a listing or report view runs more queries than its budget."""
+    failed = 0
+    for endpoint, count, budget, status in instrumentation.check_query_budgets():
+        if count > budget:
+            failed += 1
+        click.echo(f"{'FAIL' if count > budget else 'ok'}  {endpoint}: {count} queries (budget {budget}, status {status})")
+    if failed:
+        raise click.ClickException(f'{failed} view(s) went over their query budget')
+
+
+app.cli.add_command(library_cli)
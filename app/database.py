@@ -0,0 +1,67 @@
+import os
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+
+# engine settings taken from the app config. sqlite gets its pragmas on every new connection:
+# WAL lets readers carry on while a borrow or return commits, synchronous=NORMAL only syncs at
+# checkpoints (safe in WAL mode), and busy_timeout makes a connection wait for the write lock
+# instead of failing straight away with "database is locked"
+
+def is_memory_database(uri):
+    url = make_url(uri)
+    return url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')
+
+
+def engine_options(config):
+
+    # pool sizing does not apply to in-memory sqlite, which keeps a single connection
+    if is_memory_database(config['SQLALCHEMY_DATABASE_URI']):
+        return {}
+    return dict(pool_size=config['DATABASE_POOL_SIZE'],
+                max_overflow=config['DATABASE_MAX_OVERFLOW'],
+                pool_timeout=config['DATABASE_POOL_TIMEOUT'],
+                pool_recycle=config['DATABASE_POOL_RECYCLE'])
+
+
+def sqlite_pragmas(config):
+
+    # a setting left empty in the environment keeps sqlite's own default
+    pragmas = dict(journal_mode=config['SQLITE_JOURNAL_MODE'],
+                   synchronous=config['SQLITE_SYNCHRONOUS'],
+                   busy_timeout=config['SQLITE_BUSY_TIMEOUT'],
+                   mmap_size=config['SQLITE_MMAP_SIZE'],
+                   cache_size=config['SQLITE_CACHE_SIZE'])
+    return {name: value for name, value in pragmas.items() if value not in (None, '')}
+
+
+def apply_pragmas(engine, pragmas):
+    if engine.dialect.name != 'sqlite' or not pragmas:
+        return
+    if is_memory_database(engine.url):
+        pragmas = {name: value for name, value in pragmas.items() if name != 'journal_mode'}
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+        cursor.close()
+
+
+def attach_archive(engine, path, pragmas):
+
+    # the loan archive file is attached to every connection as "archive", in the same journal mode
+    # as the main database. it is created on first use
+    if engine.dialect.name != 'sqlite' or not path:
+        return
+    settings = {name: value for name, value in pragmas.items() if name in ('journal_mode', 'synchronous')}
+
+    @event.listens_for(engine, 'connect')
+    def attach(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('ATTACH DATABASE ? AS archive', (os.path.abspath(path),))
+        for name, value in settings.items():
+            cursor.execute(f'PRAGMA archive.{name} = {value}')
+        cursor.close()
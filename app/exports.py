@@ -0,0 +1,153 @@
+import csv
+import io
+import json
+import operator
+import zlib
+from datetime import datetime
+
+from flask import Response, current_app, stream_with_context
+from sqlalchemy import select, union
+
+from app import db
+from app import archive
+from app.models import Loan, BookLoan, Student, FineTransaction
+
+
+# csv and json lines exports of the loan and fine records, for auditors. rows are selected as plain
+# columns (no orm objects in the session) and read from the cursor yield_per rows at a time, and
+# each batch is written to the response as soon as it is formatted, so a worker's memory use stays
+# the same however many rows are exported. the loan exports read the archive along with the loan
+# tables, as the reports do
+
+EXPORTS = {
+    'loans': dict(columns=[Loan.loan_id, Loan.device_id, Loan.student_id, Loan.borrowdatetime, Loan.duedatetime,
+                           Loan.returndatetime, Loan.fine],
+                  date_column=Loan.borrowdatetime,
+                  filters=dict(student_id=Loan.student_id, device_id=Loan.device_id),
+                  archive='device_id'),
+    'book-loans': dict(columns=[BookLoan.loan_id, BookLoan.book_id, BookLoan.student_id, BookLoan.borrowdatetime,
+                                BookLoan.duedatetime, BookLoan.returndatetime, BookLoan.fine_amount],
+                       date_column=BookLoan.borrowdatetime,
+                       filters=dict(student_id=BookLoan.student_id, book_id=BookLoan.book_id),
+                       archive='book_id'),
+    'outstanding-fines': dict(columns=[Student.student_id, Student.username, Student.firstname, Student.lastname,
+                                       Student.fines],
+                              where=Student.fines > 0,
+                              filters=dict(student_id=Student.student_id)),
+    'fine-transactions': dict(columns=[FineTransaction.transaction_id, FineTransaction.student_id, FineTransaction.amount,
+                                       FineTransaction.reason, FineTransaction.loan_id, FineTransaction.book_loan_id,
+                                       FineTransaction.created],
+                              date_column=FineTransaction.created,
+                              filters=dict(student_id=FineTransaction.student_id)),
+}
+
+FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
+
+
+def _parse_time(value):
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+
+def export_statement(name, args):
+
+    # returns the statement for the export and an error message, one of them None. from and to
+    # (an iso date or date and time, to is exclusive) filter on the borrow or transaction time,
+    # and the export's id columns filter on equality
+    export = EXPORTS[name]
+    conditions = []
+
+    for key, column in export['filters'].items():
+        if key in args:
+            value = args.get(key, type=int)
+            if value is None:
+                return None, f'{key} must be an integer'
+            conditions.append((column, operator.eq, value))
+
+    for key, compare in (('from', operator.ge), ('to', operator.lt)):
+        if key in args:
+            if 'date_column' not in export:
+                return None, f'the {name} export cannot be filtered by date'
+            value = _parse_time(args[key])
+            if value is None:
+                return None, f'{key} must be an ISO date such as 2024-09-01 or 2024-09-01T13:30'
+            conditions.append((export['date_column'], compare, value))
+
+    statement = _filtered(export['columns'], conditions)
+    if 'where' in export:
+        statement = statement.where(export['where'])
+    if 'archive' not in export:
+        return statement.order_by(export['columns'][0]), None
+
+    # the archived rows under the loan table's column names. UNION drops a loan that a stopped
+    # archive run left in both tables
+    archived = archive.ARCHIVES[export['archive']]['archive_model']
+    loans = union(statement, _filtered(export['columns'], conditions, archived)).subquery()
+    return select(loans).order_by(loans.c[export['columns'][0].key]), None
+
+
+def _filtered(columns, conditions, model=None):
+
+    # select columns where each (column, compare, value) condition holds. with a model, its columns
+    # of the same names are used instead
+    def column_of(column):
+        return column if model is None else getattr(model, column.key)
+
+    return select(*map(column_of, columns)).where(*(compare(column_of(column), value)
+                                                    for column, compare, value in conditions))
+
+
+def _format_value(value):
+    return value.isoformat(sep=' ') if isinstance(value, datetime) else value
+
+
+def csv_chunks(names, batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(names)
+    for rows in batches:
+        writer.writerows([_format_value(value) for value in row] for row in rows)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def jsonl_chunks(names, batches):
+    for rows in batches:
+        yield ''.join(json.dumps(dict(zip(names, map(_format_value, row)))) + '\n' for row in rows).encode()
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def stream_export(name, statement, file_format, compress=False):
+    names = [column.key for column in EXPORTS[name]['columns']]
+    batch_size = current_app.config['EXPORT_BATCH_SIZE']
+
+    def batches():
+        result = db.session.execute(statement, execution_options={'yield_per': batch_size})
+        yield from result.partitions()
+
+    chunks = (csv_chunks if file_format == 'csv' else jsonl_chunks)(names, batches())
+    filename = f'{name}.{file_format}'
+    mimetype = FORMATS[file_format]
+    if compress:
+        chunks = gzip_chunks(chunks)
+        filename, mimetype = filename + '.gz', 'application/gzip'
+
+    response = Response(stream_with_context(chunks), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
@@ -0,0 +1,46 @@
+from decimal import Decimal, ROUND_HALF_UP
+
+from app import app
+
+
+# fines are stored as whole pence. these helpers convert to and from the pounds shown to users
+
+def to_pence(pounds):
+    return int((Decimal(str(pounds)) * 100).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+
+
+@app.template_filter('pounds')
+def format_pounds(pence):
+    pence = pence or 0
+    sign = '-' if pence < 0 else ''
+    return f'{sign}{abs(pence) // 100}.{abs(pence) % 100:02d}'
+
+
+# 50p for every second late, up to £50 (seconds rather than days, for testing purposes)
+FINE_PER_SECOND = 50
+MAX_FINE = 5000
+
+
+def calculate_fine(due_time, return_time, fine_per_second=FINE_PER_SECOND, max_fine=MAX_FINE):
+
+    # fines are in pence
+    # calculate how late the device/book has been returned. total_seconds() rather than .seconds,
+    # which only holds the part of the difference smaller than a day
+    seconds_late = max(int((return_time - due_time).total_seconds()), 0)
+
+    # multiply the number of seconds late by the fine rate
+    fine_amount = fine_per_second * seconds_late
+
+    if fine_amount > max_fine:
+        fine_amount = max_fine
+
+    return fine_amount
+
+
+def rebuild_balances(connection):
+
+    # recompute every student's balance from the ledger in one statement, returning how many were wrong
+    ledger_balance = """COALESCE((SELECT SUM(amount) FROM fine_transactions
+                                  WHERE fine_transactions.student_id = students.student_id), 0)"""
+    return connection.exec_driver_sql(
+        f'UPDATE students SET fines = {ledger_balance} WHERE fines != {ledger_balance}').rowcount
@@ -1,8 +1,18 @@
+import math
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, SubmitField, IntegerField, BooleanField, FloatField
-from wtforms.validators import DataRequired, EqualTo, Email, ValidationError, optional
+from wtforms.validators import DataRequired, EqualTo, Email, Length, ValidationError, optional
 from app.models import Student, Loan, Device, BookLoan, Book
 from sqlalchemy import and_
+from app.fines import to_pence
+from app.request_cache import (get_student, get_device, get_book, get_copy, open_device_loans, open_book_loans,
+                               open_loan_of_copy, student_open_device_loan, student_open_book_loan_count,
+                               loan_for_student, get_hold, student_hold)
+
+
+def _has_ready_hold(student_id, key, item_id):
+    hold = student_hold(student_id, key, item_id) if student_id.isnumeric() else None
+    return hold is not None and hold.status == 'ready'
 
 
 class LoginForm(FlaskForm):
@@ -39,36 +49,38 @@ class AddStudentForm(FlaskForm):
 class BorrowForm(FlaskForm):
     student_id = StringField('Student ID', validators=[DataRequired()])
     device_id = StringField('Device ID', validators=[DataRequired()])
+    barcode = StringField('Barcode of the copy (leave empty for any copy)', validators=[optional(), Length(max=32)])
     submit = SubmitField('Borrow Device')
 
     def validate_student_id(self, student_id):
         if not student_id.data.isnumeric():
             raise ValidationError('This must be a positive integer')
-        student = Student.query.get(student_id.data)
+        student = get_student(student_id.data)
         if not (student):
             raise ValidationError('There is no student with this id in the system')
         if not student.active:
             raise ValidationError('This student has been dactivated and cannot borrow devices')
-        if Loan.query.filter(
-                    (Loan.student_id == student_id.data)
-                    &
-                    # (Loan.returndatetime.is_(None))
-                    (Loan.returndatetime.is_(None))
-                ).first():
+        if student_open_device_loan(student_id.data):
             raise ValidationError('This student cannot borrow another item until the previous loan has been returned')
 
     def validate_device_id(self, device_id):
         if not device_id.data.isnumeric():
             raise ValidationError('This must be a positive integer')
-        if Device.query.filter(
-                    (Device.device_id == device_id.data)
-                    &
-                    (Device.device_quantity <= 0)
-                ).first():
-            raise ValidationError(f'There are no more of these devices available to loan. Please wait unitl one is returned')
-        if not Device.query.filter_by(device_id=device_id.data).first():
+        device = get_device(device_id.data)
+        if device and device.device_quantity <= 0 and not _has_ready_hold(self.student_id.data, 'device_id', device_id.data):
+            raise ValidationError(f'There are no more of these devices available to loan. Place a hold to join the queue for the next one returned')
+        if not device:
             raise ValidationError('this device does not exist')
 
+    def validate_barcode(self, barcode):
+        if barcode.data:
+            copy = get_copy(barcode.data)
+            if not copy or str(copy.device_id) != self.device_id.data:
+                raise ValidationError('this barcode is not a copy of this device')
+            hold = student_hold(self.student_id.data, 'device_id', copy.device_id) if self.student_id.data.isnumeric() else None
+            if copy.on_loan and not (hold and hold.copy_id == copy.copy_id):
+                raise ValidationError('this copy is already on loan or set aside for a hold')
+
 class DeactivateStudentForm(FlaskForm):
     student_id = StringField('Student ID', validators=[DataRequired()])
     submit = SubmitField('Deactivate Student')
@@ -76,7 +88,7 @@ class DeactivateStudentForm(FlaskForm):
     def validate_student_id(self, student_id):
         if not student_id.data.isnumeric():
             raise ValidationError('This must be a positive integer')
-        student = Student.query.get(student_id.data)
+        student = get_student(student_id.data)
         if not student:
             raise ValidationError('There is no student with this id in the system')
         if not student.active:
@@ -87,32 +99,47 @@ class AddDeviceForm(FlaskForm):
     device_name = StringField('enter the device name', validators=[DataRequired()])
     loan_period = IntegerField('enter number of days this device can be loaned for'
                                ' (if this device already exists in the table leave this empty)', validators=[optional()])
+    barcode = StringField('enter the asset tag of this copy (leave empty to generate one)', validators=[optional(), Length(max=32)])
     submit = SubmitField('add device')
 
+    def validate_barcode(self, barcode):
+        if barcode.data and get_copy(barcode.data):
+            raise ValidationError('this barcode is already in use')
+
 
 class ReturnForm(FlaskForm):
     device_id = IntegerField('enter the device ID of the device that you want to return')
     student_id = IntegerField('enter your student ID')
+    barcode = StringField('scan the barcode of the device (optional)', validators=[optional(), Length(max=32)])
     submit = SubmitField('submit')
 
     def validate_student_id(self, student_id):
-        if not Student.query.filter_by(student_id=student_id.data).first():
+        if student_id.data is None or not get_student(student_id.data):
             raise ValidationError('this student does not exist')
 
 
 
     def validate_device_id(self, device_id):
 
-        if not Device.query.filter_by(device_id=device_id.data).first():
+        if device_id.data is None or not get_device(device_id.data):
             raise ValidationError('this device does not exist')
 
-        if not Loan.query.filter(
-                (Loan.device_id==device_id.data)
-            &
-                (Loan.returndatetime.is_(None)
-        )).first():
+        loans = open_device_loans(device_id.data)
+        if not loans:
             raise ValidationError('this device is not currently on loan')
 
+        if self.student_id.data is not None and not loan_for_student(loans, self.student_id.data):
+            raise ValidationError('this device is not on loan to this student')
+
+    def validate_barcode(self, barcode):
+        if barcode.data:
+            copy = get_copy(barcode.data)
+            if not copy or copy.device_id != self.device_id.data:
+                raise ValidationError('this barcode is not a copy of this device')
+            loan = open_loan_of_copy(Loan, copy.copy_id)
+            if not loan or loan.student_id != self.student_id.data:
+                raise ValidationError('this copy is not on loan to this student')
+
 
 
 class AddBookForm(FlaskForm):
@@ -120,8 +147,13 @@ class AddBookForm(FlaskForm):
     author_firstname = StringField('Enter the authors first name', validators=[DataRequired()])
     author_lastname = StringField('Enter the authors last name', validators=[DataRequired()])
     number_of_pages = IntegerField('Enter the number of pages the book has', validators=[DataRequired()])
+    barcode = StringField('Enter the barcode of this copy (leave empty to generate one)', validators=[optional(), Length(max=32)])
     submit = SubmitField('add book')
 
+    def validate_barcode(self, barcode):
+        if barcode.data and get_copy(barcode.data):
+            raise ValidationError('this barcode is already in use')
+
 
 
 
@@ -135,25 +167,32 @@ class PayFineForm(FlaskForm):
     def validate_student_id(self, student_id):
 
         # find the student associated with the entered student ID
-        student = Student.query.filter_by(student_id=student_id.data).first()
+        student = get_student(student_id.data) if student_id.data.isnumeric() else None
 
         # if there is no student associated with the entered student ID then raise an error
         if not student:
             raise ValidationError('This student does not exist in the students table')
 
         # if the student associated with the entered student ID has no outstanding fines raise an error
-        if student.fines == 0:
+        if student.fines <= 0:
             raise ValidationError('This student has no outstanding fines')
 
     def validate_amount(self, amount):
 
         # find the student associated with the entered student ID
-        student = Student.query.filter_by(student_id=self.student_id.data).first()
+        student = get_student(self.student_id.data) if self.student_id.data.isnumeric() else None
+
+        # inf and nan parse as floats but have no amount in pence
+        if not math.isfinite(amount.data):
+            raise ValidationError('the amount must be a number')
+
+        if to_pence(amount.data) <= 0:
+            raise ValidationError('the amount must be at least £0.01')
 
-        # if the amount entered is greater than the amount the student owes raise an error
+        # if the amount entered is greater than the amount the student owes raise an error (fines are in pence)
         if student:
-            if student.fines != '0.0':
-                if float(self.amount.data) > float(student.fines):
+            if student.fines > 0:
+                if to_pence(amount.data) > student.fines:
                     raise ValidationError('this student owes less than the amount entered')
 
 
@@ -167,7 +206,7 @@ class DeleteStudentForm(FlaskForm):
     submit = SubmitField('Delete Student')
 
     def validate_student_id(self, student_id):
-        student = Student.query.filter_by(student_id=student_id.data).first()
+        student = get_student(student_id.data)
 
         if not student:
             raise ValidationError('this student does not exist')
@@ -179,7 +218,7 @@ class StudentLoanReportForm(FlaskForm):
     submit = SubmitField('Generate Report')
 
     def validate_student_id(self, student_id):
-        if not Student.query.filter_by(student_id=student_id.data).first():
+        if not get_student(student_id.data):
             raise ValidationError('this student does not exist')
         elif not (Loan.query.filter_by(student_id=student_id.data).first() or BookLoan.query.filter_by(student_id=student_id.data).first()):
             raise ValidationError('this student has no loan records')
@@ -190,7 +229,7 @@ class DeviceLoanReportForm(FlaskForm):
     submit = SubmitField('Generate Report')
 
     def validate_device_id(self, device_id):
-        if not Device.query.filter_by(device_id=device_id.data).first():
+        if not get_device(device_id.data):
             raise ValidationError('this device does not exist')
         elif not Loan.query.filter_by(device_id=device_id.data).first():
             raise ValidationError('this device has no loan history')
@@ -201,7 +240,7 @@ class RemoveStudentLoansForm(FlaskForm):
     submit = SubmitField('confirm')
 
     def validate_student_id(self, student_id):
-        if not Student.query.filter_by(student_id=student_id.data).first():
+        if student_id.data is None or not get_student(student_id.data):
             raise ValidationError('this student does not exist')
 
         if not Loan.query.filter_by(student_id=student_id.data).first():
@@ -213,69 +252,83 @@ class ActivateStudent(FlaskForm):
     submit = SubmitField('activate student')
 
     def validate_student_id(self, student_id):
-        if not Student.query.filter_by(student_id=student_id.data).first():
+        student = get_student(student_id.data)
+        if not student:
             raise ValidationError('this student does not exist')
 
-        if Student.query.filter((Student.student_id == student_id.data) & (Student.active == True)).first():
+        if student.active:
             raise ValidationError('this student is already an active student')
 
 
 class BorrowBookForm(FlaskForm):
     student_id = StringField('Student ID', validators=[DataRequired()])
     book_id = StringField('Book ID', validators=[DataRequired()])
+    barcode = StringField('Barcode of the copy (leave empty for any copy)', validators=[optional(), Length(max=32)])
     submit = SubmitField('Borrow Book')
 
     def validate_student_id(self, student_id):
         if not student_id.data.isnumeric():
             raise ValidationError('This must be a positive integer')
-        student = Student.query.get(student_id.data)
+        student = get_student(student_id.data)
         if not (student):
             raise ValidationError('There is no student with this id in the system')
         if not student.active:
             raise ValidationError('This student has been deactivated and cannot borrow')
-        if len(BookLoan.query.filter(
-                    (BookLoan.student_id == student_id.data)
-                    &
-                    (BookLoan.returndatetime.is_(None))
-                ).all()) >= 2:
+        if student_open_book_loan_count(student_id.data) >= 2:
             raise ValidationError('This student has reached their maximum loan limit. Please return a book before attempting to loan another one')
 
     def validate_book_id(self, book_id):
         if not book_id.data.isnumeric():
             raise ValidationError('This must be a positive integer')
-        if Book.query.filter(
-                    (Book.book_id == book_id.data)
-                    &
-                    (Book.quantity <= 0)
-                ).first():
-            raise ValidationError(f'There are no more copies of this book available to loan. Please wait unitl one is returned')
-        if not Book.query.filter_by(book_id=book_id.data).first():
+        book = get_book(book_id.data)
+        if book and book.quantity <= 0 and not _has_ready_hold(self.student_id.data, 'book_id', book_id.data):
+            raise ValidationError(f'There are no more copies of this book available to loan. Place a hold to join the queue for the next one returned')
+        if not book:
             raise ValidationError('this book does not exist')
 
+    def validate_barcode(self, barcode):
+        if barcode.data:
+            copy = get_copy(barcode.data)
+            if not copy or str(copy.book_id) != self.book_id.data:
+                raise ValidationError('this barcode is not a copy of this book')
+            hold = student_hold(self.student_id.data, 'book_id', copy.book_id) if self.student_id.data.isnumeric() else None
+            if copy.on_loan and not (hold and hold.copy_id == copy.copy_id):
+                raise ValidationError('this copy is already on loan or set aside for a hold')
+
 
 
 class BookReturnForm(FlaskForm):
     book_id = IntegerField('enter the book ID of the book that you want to return')
     student_id = IntegerField('enter your student ID')
+    barcode = StringField('scan the barcode of the book (optional)', validators=[optional(), Length(max=32)])
     submit = SubmitField('submit')
 
     def validate_student_id(self, student_id):
-        if not Student.query.filter_by(student_id=student_id.data).first():
+        if student_id.data is None or not get_student(student_id.data):
             raise ValidationError('this student does not exist')
 
 
     def validate_book_id(self, book_id):
 
-        if not Book.query.filter_by(book_id=book_id.data).first():
+        if book_id.data is None or not get_book(book_id.data):
             raise ValidationError('this book does not exist')
 
-        if not BookLoan.query.filter(
-                (BookLoan.book_id==book_id.data)
-            &
-                (BookLoan.returndatetime.is_(None)
-        )).first():
+        loans = open_book_loans(book_id.data)
+        if not loans:
             raise ValidationError('this book is not currently on loan')
 
+        if self.student_id.data is not None and not loan_for_student(loans, self.student_id.data):
+            raise ValidationError('this book is not on loan to this student')
+
+    def validate_barcode(self, barcode):
+        if barcode.data:
+            copy = get_copy(barcode.data)
+            if not copy or copy.book_id != self.book_id.data:
+                raise ValidationError('this barcode is not a copy of this book')
+            loan = open_loan_of_copy(BookLoan, copy.copy_id)
+            if not loan or loan.student_id != self.student_id.data:
+                raise ValidationError('this copy is not on loan to this student')
+
 class BookSearchForm(FlaskForm):
     title = StringField('Title')
     author = StringField('Author')
@@ -289,7 +342,7 @@ class RemoveBookForm(FlaskForm):
     submit = SubmitField('DELETE')
 
     def validate_book_id(self, book_id):
-        if not Book.query.filter_by(book_id=book_id.data).first():
+        if book_id.data is None or not get_book(book_id.data):
             raise ValidationError('This book does not exist in the book database')
 
 
@@ -298,7 +351,63 @@ class RemoveBookLoanForm(FlaskForm):
     submit = SubmitField('Remove')
 
     def validate_book_id(self, book_id):
-        if not Book.query.filter_by(book_id=book_id.data).first():
+        if book_id.data is None or not get_book(book_id.data):
             raise ValidationError('This book does not exist in the book database')
 
 
+
+
+class HoldForm(FlaskForm):
+    student_id = IntegerField('Student ID')
+    device_id = IntegerField('Device ID')
+    submit = SubmitField('Place Hold')
+
+    def validate_student_id(self, student_id):
+        student = get_student(student_id.data) if student_id.data is not None else None
+        if not student:
+            raise ValidationError('There is no student with this id in the system')
+        if not student.active:
+            raise ValidationError('This student has been deactivated and cannot place holds')
+
+    def validate_device_id(self, device_id):
+        device = get_device(device_id.data) if device_id.data is not None else None
+        if not device:
+            raise ValidationError('this device does not exist')
+        if device.device_quantity > 0:
+            raise ValidationError('this device is on the shelf, borrow it instead')
+        if self.student_id.data is not None and student_hold(self.student_id.data, 'device_id', device_id.data):
+            raise ValidationError('this student is already queueing for this device')
+
+
+class BookHoldForm(FlaskForm):
+    student_id = IntegerField('Student ID')
+    book_id = IntegerField('Book ID')
+    submit = SubmitField('Place Hold')
+
+    def validate_student_id(self, student_id):
+        student = get_student(student_id.data) if student_id.data is not None else None
+        if not student:
+            raise ValidationError('There is no student with this id in the system')
+        if not student.active:
+            raise ValidationError('This student has been deactivated and cannot place holds')
+
+    def validate_book_id(self, book_id):
+        book = get_book(book_id.data) if book_id.data is not None else None
+        if not book:
+            raise ValidationError('this book does not exist')
+        if book.quantity > 0:
+            raise ValidationError('there are copies of this book on the shelf, borrow one instead')
+        if self.student_id.data is not None and student_hold(self.student_id.data, 'book_id', book_id.data):
+            raise ValidationError('this student is already queueing for this book')
+
+
+class CancelHoldForm(FlaskForm):
+    hold_id = IntegerField('Hold ID')
+    submit = SubmitField('Cancel Hold')
+
+    def validate_hold_id(self, hold_id):
+        hold = get_hold(hold_id.data) if hold_id.data is not None else None
+        if not hold:
+            raise ValidationError('this hold does not exist')
+        if hold.status not in ('waiting', 'ready'):
+            raise ValidationError(f'this hold is already {hold.status}')
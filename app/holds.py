@@ -0,0 +1,136 @@
+from datetime import datetime
+
+from sqlalchemy import delete, func, select, update
+
+from app import app, db
+from app import inventory
+from app.availability import availability
+from app.checkout import ITEM_KINDS, run_in_transaction, shelve
+from app.models import Hold
+
+
+# the hold queue. a student asks for a device or book with none on the shelf and joins the item's
+# queue. when a copy comes back the return hands it to the next student in line who can borrow it
+# (checkout.shelve), in the same transaction, and that hold is ready until its pickup time runs out.
+# expire_holds passes uncollected copies on down the queue, and cancelling a ready hold does the same
+
+class HoldError(Exception):
+    pass
+
+
+def item_key(hold):
+    return 'device_id' if hold.device_id is not None else 'book_id'
+
+
+def place_hold(student_id, key, item_id, session=None):
+    session = session or db.session
+
+    def work():
+        if session.scalar(select(Hold.hold_id).where((Hold.student_id == student_id) & (getattr(Hold, key) == item_id)
+                                                     & Hold.status.in_(['waiting', 'ready'])).limit(1)):
+            raise HoldError(f'this student is already queueing for this {key[:-3]}')
+        hold = Hold(student_id=student_id, placed=datetime.now(), **{key: item_id})
+        session.add(hold)
+        return hold
+
+    return run_in_transaction(work, session)
+
+
+def queue_position(hold):
+
+    # 1 for the next student in line. counts the waiting holds ahead of this one in the queue's index
+    item_column = getattr(Hold, item_key(hold))
+    return db.session.scalar(select(func.count()).select_from(Hold).where(
+        (item_column == getattr(hold, item_key(hold))) & (Hold.status == 'waiting') & (Hold.hold_id <= hold.hold_id)))
+
+
+def _release(session, holds, status, now):
+
+    # close holds and pass any copies they had set aside on to the next in line (or the shelf). the
+    # holds were read before this transaction took the write lock, so each is closed only if it is
+    # still waiting or ready, and only the copies of those still ready when closed are passed on.
+    # returns the number of holds closed
+    by_id = {hold.hold_id: hold for hold in holds}
+    released, closed = {}, 0
+    for hold_id, copy_id in session.execute(
+            update(Hold).where(Hold.hold_id.in_(by_id) & (Hold.status == 'ready')).values(status=status)
+            .returning(Hold.hold_id, Hold.copy_id).execution_options(synchronize_session=False)):
+        hold = by_id[hold_id]
+        released.setdefault((item_key(hold), getattr(hold, item_key(hold))), []).append(copy_id)
+        closed += 1
+
+    # a hold read as ready is never waiting again, so only those read as waiting can still be
+    waiting = [hold.hold_id for hold in holds if hold.status == 'waiting']
+    if waiting:
+        closed += session.execute(update(Hold).where(Hold.hold_id.in_(waiting) & (Hold.status == 'waiting'))
+                                  .values(status=status).execution_options(synchronize_session=False)).rowcount
+
+    for (key, item_id), copy_ids in released.items():
+        shelve(session, key, item_id, copy_ids, now)
+    return closed
+
+
+def cancel_hold(hold, session=None):
+    session = session or db.session
+    if hold.status not in ('waiting', 'ready'):
+        raise HoldError(f'this hold is already {hold.status}')
+
+    def work():
+        if not _release(session, [hold], 'cancelled', datetime.now()):
+            raise HoldError('this hold was closed in the meantime')
+
+    run_in_transaction(work, session)
+    availability.invalidate()
+
+
+def remove_student_holds(session, student_ids):
+
+    # before students are deleted: the copies set aside for them go to the next in line, and every
+    # hold of theirs is removed. runs in the caller's transaction
+    _release(session, session.scalars(select(Hold).where(Hold.student_id.in_(student_ids)
+                                                         & Hold.status.in_(['waiting', 'ready']))).all(),
+             'cancelled', datetime.now())
+    session.execute(delete(Hold).where(Hold.student_id.in_(student_ids)).execution_options(synchronize_session=False))
+
+
+def _expire_batch(session, now, batch_size):
+    holds = session.scalars(select(Hold).where((Hold.status == 'ready') & (Hold.expires < now))
+                            .order_by(Hold.expires).limit(batch_size)).all()
+    if not holds:
+        return None
+    return _release(session, holds, 'expired', now)
+
+
+def expire_holds(session=None, now=None, batch_size=None):
+
+    # one sweep over the ready holds whose pickup time has passed, through the index on their expiry
+    # time, each batch in its own transaction. returns the number of holds expired
+    session = session or db.session
+    now = now or datetime.now()
+    batch_size = batch_size or app.config['HOLD_EXPIRY_BATCH_SIZE']
+    expired = 0
+
+    while True:
+        count = run_in_transaction(lambda: _expire_batch(session, now, batch_size), session)
+        if count is None:
+            break
+        expired += count
+    if expired:
+        availability.invalidate()
+    return expired
+
+
+def serve_queue(session, key, item_id, count):
+
+    # copies just added to an item are offered to its queue before anyone can take them off the shelf:
+    # up to count of them are taken off again and shelved, which sets them aside for the students
+    # waiting. runs in the caller's transaction and returns {copy id: student id} of those set aside
+    if not session.scalar(select(Hold.hold_id).where((getattr(Hold, key) == item_id) & (Hold.status == 'waiting')).limit(1)):
+        return {}
+
+    kind = ITEM_KINDS[key]
+    copy_ids = inventory.take_copies(session, key, item_id, count)
+    session.execute(update(kind['model']).where(kind['id_column'] == item_id)
+                    .values({kind['quantity_column']: kind['quantity_column'] - len(copy_ids)})
+                    .execution_options(synchronize_session=False))
+    return shelve(session, key, item_id, copy_ids)
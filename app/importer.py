@@ -0,0 +1,140 @@
+import csv
+import json
+import os
+
+from sqlalchemy import func, insert, select
+
+from app import db
+from app import search
+from app import inventory
+from app.availability import availability
+from app.models import Book, Author, author_key
+
+
+# bulk loader for the book catalogue. records are parsed lazily from the file, authors are resolved
+# to their ids through an in-memory dictionary of normalised names and books are written with
+# executemany inserts, one transaction per batch, so memory use does not grow with the size of the file
+
+def split_author(full_name):
+
+    # same rule the original populate_books_db used: "First Last" is split in two,
+    # anything else is kept whole as the first name
+    full_name = (full_name or '').strip()
+    names = full_name.split()
+    if len(names) == 2:
+        return names[0], names[1]
+    return full_name, ''
+
+
+def _book_record(fields):
+    if fields.get('author_firstname') is not None or fields.get('author_lastname') is not None:
+        firstname, lastname = fields.get('author_firstname') or '', fields.get('author_lastname') or ''
+    else:
+        firstname, lastname = split_author(fields.get('author'))
+
+    return dict(book_title=fields['title'].strip(),
+                author_firstname=firstname.strip(),
+                author_lastname=lastname.strip(),
+                genre=(fields.get('genre') or '').strip() or None,
+                number_of_pages=int(fields['pages']),
+                quantity=int(fields.get('quantity') or 1))
+
+
+def read_text_records(file):
+
+    # the books.txt format: "Key: value" lines, one block per book, blocks separated by a blank line
+    fields = {}
+    for line in file:
+        line = line.strip()
+        if not line:
+            if fields:
+                yield _book_record(fields)
+                fields = {}
+            continue
+        key, _, value = line.partition(': ')
+        fields[key.strip().lower()] = value
+
+    if fields:
+        yield _book_record(fields)
+
+
+def read_csv_records(file):
+    for row in csv.DictReader(file):
+        yield _book_record({key.strip().lower(): value for key, value in row.items() if key})
+
+
+def read_jsonl_records(file):
+    for line in file:
+        if line.strip():
+            yield _book_record({key.lower(): value for key, value in json.loads(line).items()})
+
+
+READERS = {
+    'txt': read_text_records,
+    'csv': read_csv_records,
+    'jsonl': read_jsonl_records,
+}
+
+
+def detect_format(path):
+    extension = os.path.splitext(path)[1].lower().lstrip('.')
+    return {'json': 'jsonl', 'ndjson': 'jsonl'}.get(extension, extension if extension in READERS else 'txt')
+
+
+def _batches(records, size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def import_books(path, file_format=None, batch_size=5000, progress=None, engine=None):
+
+    # returns the number of books and the number of new authors that were inserted
+    engine = engine or db.engine
+    file_format = file_format or detect_format(path)
+    books_added = authors_added = 0
+
+    with engine.connect() as connection:
+        authors = dict(connection.execute(select(Author.name_key, Author.author_id)).all())
+
+    with open(path, newline='', encoding='utf-8') as file:
+        for batch in _batches(READERS[file_format](file), batch_size):
+            with engine.begin() as connection:
+
+                # the search index is filled with one statement per batch rather than by the per-row trigger
+                search.pause_book_index(connection)
+                last_book_id = connection.scalar(select(func.coalesce(func.max(Book.book_id), 0)))
+
+                # authors seen for the first time in this batch are inserted before their books, and
+                # their new ids come back from the same statement
+                new_authors = {}
+                for book in batch:
+                    key = author_key(book['author_firstname'], book['author_lastname'])
+                    if key not in authors:
+                        new_authors.setdefault(key, dict(author_firstname=' '.join(book['author_firstname'].split()),
+                                                         author_lastname=' '.join(book['author_lastname'].split()),
+                                                         name_key=key))
+                if new_authors:
+                    authors.update(connection.execute(insert(Author).returning(Author.name_key, Author.author_id),
+                                                      list(new_authors.values())).all())
+                    authors_added += len(new_authors)
+
+                for book in batch:
+                    book['author_id'] = authors[author_key(book.pop('author_firstname'), book.pop('author_lastname'))]
+                connection.execute(insert(Book), batch)
+                search.resume_book_index(connection, last_book_id)
+
+                # each copy of the new books gets a generated barcode
+                inventory.add_missing_copies(connection, 'book_id', last_book_id)
+
+            books_added += len(batch)
+            availability.invalidate('books')
+            if progress:
+                progress(books_added)
+
+    return books_added, authors_added
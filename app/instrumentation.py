@@ -0,0 +1,280 @@
+import collections
+import hmac
+import inspect
+import os
+import sys
+import threading
+import time
+
+from flask import Response, abort, g, has_request_context, request
+from sqlalchemy import event, func, select
+from sqlalchemy.engine import Engine
+
+from app import app, db
+from app.models import Student, Loan
+
+
+# per-request instrumentation. every sql statement is counted and timed, and the totals are returned
+# with the request time in the X-Query-Count and Server-Timing response headers (browser dev tools
+# show the latter on the timing tab). a statement slower than SLOW_QUERY_MS is logged as a warning
+# with its parameters and the line of the view that ran it. each worker also keeps per-endpoint
+# latency histograms and query totals, served in the prometheus text format on /metrics, and with
+# PROFILER_ENABLED a request with ?profile=1 is sampled and its stacks written out for a flame graph
+
+# the most queries these views should run (including loading the logged in user), however many
+# rows they show. going over means a relationship is being loaded row by row, so it is logged as
+# a warning, and flask library check-query-counts fails
+QUERY_BUDGETS = {
+    'listStudents': 2,
+    'all_loans': 2,
+    'active_loans': 2,
+    'all_book_loan_records': 2,
+    'show_outstanding_fines': 2,
+    'search_students': 3,
+    'student_loan_report': 5,
+    'device_loan_history': 4,
+    'api.resource_list': 2,
+}
+
+# upper bounds in seconds of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Metrics:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.latency = {}
+        self.requests = collections.Counter()
+        self.queries = collections.Counter()
+        self.query_seconds = collections.Counter()
+        self.slow_queries = collections.Counter()
+        self.notifications = collections.Counter()
+        self.notification_seconds = collections.Counter()
+
+    def observe(self, endpoint, status, seconds, queries, query_seconds):
+        with self.lock:
+            counts, total = self.latency.get(endpoint, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[next((i for i, bound in enumerate(self.buckets) if seconds <= bound), len(self.buckets))] += 1
+            self.latency[endpoint] = (counts, total + seconds)
+            self.requests[endpoint, status] += 1
+            self.queries[endpoint] += queries
+            self.query_seconds[endpoint] += query_seconds
+
+    def slow_query(self, endpoint):
+        with self.lock:
+            self.slow_queries[endpoint] += 1
+
+    def notification_events(self, sender=None, seconds=0, **counts):
+        with self.lock:
+            self.notifications.update(counts)
+            if sender:
+                self.notification_seconds[sender] += seconds
+
+    def render(self):
+        lines = ['# HELP library_request_duration_seconds Time from the start of a request to its response.',
+                 '# TYPE library_request_duration_seconds histogram']
+        with self.lock:
+            for endpoint, (counts, total) in sorted(self.latency.items()):
+                cumulative = 0
+                for bound, count in zip([*map(str, self.buckets), '+Inf'], counts):
+                    cumulative += count
+                    lines.append(f'library_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{bound}"}} {cumulative}')
+                lines.append(f'library_request_duration_seconds_sum{{endpoint="{endpoint}"}} {total}')
+                lines.append(f'library_request_duration_seconds_count{{endpoint="{endpoint}"}} {cumulative}')
+
+            for name, kind, help_text, values, labels in (
+                    ('library_requests_total', 'counter', 'Requests answered, by endpoint and status code.',
+                     self.requests, lambda key: f'endpoint="{key[0]}",status="{key[1]}"'),
+                    ('library_db_queries_total', 'counter', 'SQL statements run by requests.',
+                     self.queries, lambda key: f'endpoint="{key}"'),
+                    ('library_db_query_seconds_total', 'counter', 'Time spent in SQL statements run by requests.',
+                     self.query_seconds, lambda key: f'endpoint="{key}"'),
+                    ('library_slow_queries_total', 'counter', 'SQL statements slower than SLOW_QUERY_MS.',
+                     self.slow_queries, lambda key: f'endpoint="{key}"'),
+                    ('library_notifications_total', 'counter', 'Notifications queued, sent, retried and given up on.',
+                     self.notifications, lambda key: f'event="{key}"'),
+                    ('library_notification_send_seconds_total', 'counter', 'Time spent handing notifications to the sender.',
+                     self.notification_seconds, lambda key: f'sender="{key}"')):
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+                lines += [f'{name}{{{labels(key)}}} {value}' for key, value in sorted(values.items())]
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics(LATENCY_BUCKETS)
+
+
+class SamplingProfiler:
+
+    # samples the stack of one thread every interval seconds from a background thread and counts each
+    # distinct stack, in the folded format ("outer;inner count" per line) read by flamegraph.pl,
+    # speedscope and inferno
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='request-profiler', daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def folded(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.samples.most_common())
+
+
+def query_location():
+
+    # file:line of the view function running the statement, or failing that of the innermost frame
+    # in the app, for the slow query log
+    view = app.view_functions.get(request.endpoint) if has_request_context() else None
+    view_code = inspect.unwrap(view).__code__ if view else None
+    fallback = None
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if frame.f_code is view_code:
+            return f'{os.path.relpath(filename, app.root_path)}:{frame.f_lineno}'
+        if fallback is None and filename.startswith(app.root_path) and filename != __file__:
+            fallback = f'{os.path.relpath(filename, app.root_path)}:{frame.f_lineno}'
+        frame = frame.f_back
+    return fallback or 'outside the app'
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+    if has_request_context():
+        g.query_count = g.get('query_count', 0) + 1
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def time_query(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_started'].pop()
+    endpoint = request.endpoint if has_request_context() else None
+    if has_request_context():
+        g.query_time = g.get('query_time', 0) + elapsed
+
+    # an executemany is a bulk write (imports, sweeps) and is expected to take a while
+    slow_query_ms = app.config['SLOW_QUERY_MS']
+    if not executemany and 0 < slow_query_ms <= elapsed * 1000:
+        metrics.slow_query(endpoint or 'none')
+        app.logger.warning('slow query, %.1f ms in %s at %s: %s with %.500r', elapsed * 1000, endpoint or 'no request',
+                           query_location(), ' '.join(statement.split()), parameters)
+
+
+@event.listens_for(Engine, 'handle_error')
+def forget_failed_query(context):
+
+    # a statement that raises never reaches after_cursor_execute
+    if context.connection is not None and context.connection.info.get('query_started'):
+        context.connection.info['query_started'].pop()
+
+
+@app.before_request
+def reset_query_count():
+    g.query_count = 0
+    g.query_time = 0
+    g.request_started = time.perf_counter()
+
+    if app.config['PROFILER_ENABLED'] and request.args.get('profile') == '1':
+        g.profiler = SamplingProfiler(threading.get_ident(), app.config['PROFILER_INTERVAL_MS'] / 1000)
+        g.profiler.start()
+
+
+@app.after_request
+def add_query_count(response):
+    elapsed = time.perf_counter() - g.get('request_started', time.perf_counter())
+    query_count, query_time = g.get('query_count', 0), g.get('query_time', 0)
+    response.headers['X-Query-Count'] = str(query_count)
+    response.headers['Server-Timing'] = (f'db;dur={query_time * 1000:.1f};desc="{query_count} queries", '
+                                         f'app;dur={(elapsed - query_time) * 1000:.1f}, total;dur={elapsed * 1000:.1f}')
+    app.logger.debug('%s ran %d queries in %.1f ms, %.1f ms in all', request.endpoint, query_count,
+                     query_time * 1000, elapsed * 1000)
+    if request.endpoint != 'metrics':
+        metrics.observe(request.endpoint or 'none', response.status_code, elapsed, query_count, query_time)
+
+    budget = QUERY_BUDGETS.get(request.endpoint)
+    if budget is not None and query_count > budget:
+        app.logger.warning('%s ran %d queries, more than its budget of %d', request.endpoint, query_count, budget)
+
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.stop()
+        os.makedirs(app.config['PROFILE_DIR'], exist_ok=True)
+        path = os.path.join(app.config['PROFILE_DIR'], f'{request.endpoint or "none"}-{time.time_ns()}.folded')
+        with open(path, 'w') as f:
+            f.write(profiler.folded())
+        response.headers['X-Profile'] = path
+        app.logger.info('profile of %s written to %s', request.path, path)
+    return response
+
+
+@app.route('/metrics', endpoint='metrics')
+def metrics_endpoint():
+
+    # only served when METRICS_TOKEN is set, to a scraper sending it as a bearer token
+    token = app.config['METRICS_TOKEN']
+    if not token:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        abort(401)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+def budget_requests():
+
+    # a request for every view with a budget. the reports are run for the student and the device
+    # with the most loans, so any per-row loading shows up
+    student_id = db.session.scalar(select(Loan.student_id).group_by(Loan.student_id)
+                                   .order_by(func.count().desc()).limit(1)) or 1
+    device_id = db.session.scalar(select(Loan.device_id).group_by(Loan.device_id)
+                                  .order_by(func.count().desc()).limit(1)) or 1
+    username = db.session.scalar(select(Student.username).where(Student.student_id == student_id)) or 'a'
+    return [
+        ('listStudents', 'GET', '/listStudents', None),
+        ('all_loans', 'GET', '/all_loans', None),
+        ('active_loans', 'GET', '/active_loans', None),
+        ('all_book_loan_records', 'GET', '/book_loan_records', None),
+        ('show_outstanding_fines', 'GET', '/show_outstanding_fines', None),
+        ('search_students', 'POST', '/search_students', dict(query=username)),
+        ('student_loan_report', 'POST', '/student_loan_report', dict(student_id=student_id)),
+        ('device_loan_history', 'POST', '/device_loan_history', dict(device_id=device_id)),
+        ('api.resource_list', 'GET', f'/api/v1/loans?student_id={student_id}', None),
+    ]
+
+
+def check_query_budgets():
+
+    # runs each request against the current database without logging in or csrf tokens (they only
+    # read) and returns (endpoint, queries run, budget, status code) for each
+    results = []
+    settings = {key: app.config.get(key) for key in ('LOGIN_DISABLED', 'WTF_CSRF_ENABLED')}
+    app.config.update(LOGIN_DISABLED=True, WTF_CSRF_ENABLED=False)
+    try:
+        client = app.test_client()
+        for endpoint, method, path, data in budget_requests():
+
+            # start every request with an empty session, as a real request would
+            db.session.remove()
+            response = client.open(path, method=method, data=data)
+            results.append((endpoint, int(response.headers['X-Query-Count']), QUERY_BUDGETS[endpoint],
+                            response.status_code))
+    finally:
+        app.config.update(settings)
+    return results
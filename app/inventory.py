@@ -0,0 +1,118 @@
+from sqlalchemy import func, insert, select, update
+
+from app.models import Device, Book, Loan, BookLoan, Copy
+
+
+# per-copy inventory. every physical device and book is a row in copies with its own barcode, and a
+# loan records the copy that went out (a ready hold, the copy set aside for it). device_quantity and
+# quantity stay as the materialised count of each item's copies on the shelf: the checkout service
+# moves the counter and the copy's on_loan flag in the same transaction as the loan, so availability
+# is still one column read however many copies there are. reconcile finds and repairs drift between
+# the two (hand edits, a restored backup) with one UPDATE per table
+
+KINDS = {
+    'device_id': dict(prefix='D', model=Device, quantity_column=Device.device_quantity, loan_model=Loan),
+    'book_id': dict(prefix='B', model=Book, quantity_column=Book.quantity, loan_model=BookLoan),
+}
+
+
+def make_barcode(key, item_id, number):
+
+    # generated barcodes are the kind, the item and the copy's number within the item: D000012-003
+    return f"{KINDS[key]['prefix']}{item_id:06d}-{number:03d}"
+
+
+def _barcode_sql(key, item_column, number_column):
+    return f"printf('{KINDS[key]['prefix']}%06d-%03d', {item_column}, {number_column})"
+
+
+def add_copies(session, key, item_id, count=1, barcodes=None):
+
+    # put new copies of an existing device or book on the shelf and return their barcodes. given
+    # barcodes are used as they are, otherwise they are numbered on from the item's existing copies
+    kind = KINDS[key]
+    if not barcodes:
+        existing = session.scalar(select(func.count()).select_from(Copy).where(getattr(Copy, key) == item_id))
+        barcodes = [make_barcode(key, item_id, existing + number) for number in range(1, count + 1)]
+
+    session.execute(insert(Copy), [{key: item_id, 'barcode': barcode} for barcode in barcodes])
+    session.execute(update(kind['model']).where(getattr(kind['model'], key) == item_id)
+                    .values({kind['quantity_column']: func.coalesce(kind['quantity_column'], 0) + len(barcodes)})
+                    .execution_options(synchronize_session=False))
+    return barcodes
+
+
+def take_copies(session, key, item_id, count=1, barcode=None):
+
+    # mark copies of the item as lent, the one with this barcode or else the lowest numbered ones on
+    # the shelf, and return their ids (fewer than count when not enough are free). the caller has
+    # already taken them off the item's counter in the same transaction
+    free = select(Copy.copy_id).where((getattr(Copy, key) == item_id) & Copy.on_loan.is_(False))
+    if barcode:
+        free = free.where(Copy.barcode == barcode)
+    return session.scalars(
+        update(Copy).where(Copy.copy_id.in_(free.order_by(Copy.copy_id).limit(count)))
+        .values(on_loan=True).returning(Copy.copy_id)
+        .execution_options(synchronize_session=False)).all()
+
+
+def put_back(session, copy_ids):
+    copy_ids = [copy_id for copy_id in copy_ids if copy_id is not None]
+    if copy_ids:
+        session.execute(update(Copy).where(Copy.copy_id.in_(copy_ids)).values(on_loan=False)
+                        .execution_options(synchronize_session=False))
+
+
+def add_missing_copies(connection, key=None, after_id=0):
+
+    # items above after_id with no copies yet get one per unit, that is one for each copy on the shelf
+    # (the counter) and one for each open loan, and those open loans are linked to the copies marked
+    # as lent. used when copies were introduced, and for items inserted in bulk (imports, generators)
+    for key in ([key] if key else KINDS):
+        kind = KINDS[key]
+        table, quantity = kind['model'].__tablename__, kind['quantity_column'].key
+        loans = f'"{kind["loan_model"].__tablename__}"'
+        connection.exec_driver_sql(
+            f"""WITH RECURSIVE units AS (
+                    SELECT {table}.{key} AS item_id, MAX(COALESCE({table}.{quantity}, 0), 0) AS free,
+                           (SELECT COUNT(*) FROM {loans} WHERE {loans}.{key} = {table}.{key}
+                            AND {loans}.returndatetime IS NULL) AS lent
+                    FROM {table}
+                    WHERE {table}.{key} > ? AND NOT EXISTS (SELECT 1 FROM copies WHERE copies.{key} = {table}.{key})),
+                numbers(number) AS (
+                    SELECT 1 UNION ALL SELECT number + 1 FROM numbers WHERE number < (SELECT MAX(free + lent) FROM units))
+                INSERT INTO copies (barcode, {key}, on_loan)
+                SELECT {_barcode_sql(key, 'item_id', 'number')}, item_id, number <= lent
+                FROM units JOIN numbers ON number <= free + lent""", (after_id,))
+
+        # the nth open loan of an item, by loan id, gets the item's nth copy
+        connection.exec_driver_sql(
+            f"""UPDATE {loans} SET copy_id = copies.copy_id
+                FROM (SELECT loan_id, {key}, ROW_NUMBER() OVER (PARTITION BY {key} ORDER BY loan_id) AS number
+                      FROM {loans} WHERE returndatetime IS NULL AND copy_id IS NULL AND {key} > ?) AS open_loans
+                JOIN copies ON copies.barcode = {_barcode_sql(key, f'open_loans.{key}', 'open_loans.number')}
+                WHERE {loans}.loan_id = open_loans.loan_id""", (after_id,))
+
+
+def reconcile(connection, repair=True):
+
+    # a copy is off the shelf exactly when an open loan or a ready hold points at it, and an item's
+    # counter is its number of copies that are not. returns {key: (copies wrong, counters wrong)}, after fixing them when repair
+    results = {}
+    for key, kind in KINDS.items():
+        table, quantity = kind['model'].__tablename__, kind['quantity_column'].key
+        loans = f'"{kind["loan_model"].__tablename__}"'
+        lent = f"""(EXISTS (SELECT 1 FROM {loans} WHERE {loans}.copy_id = copies.copy_id
+                            AND {loans}.returndatetime IS NULL)
+                    OR EXISTS (SELECT 1 FROM holds WHERE holds.copy_id = copies.copy_id AND holds.status = 'ready'))"""
+        free = f'(SELECT COUNT(*) FROM copies WHERE copies.{key} = {table}.{key} AND NOT {lent})'
+        wrong_copies = f'copies.{key} IS NOT NULL AND copies.on_loan != {lent}'
+        wrong_counters = f'{table}.{quantity} IS NOT {free}'
+
+        if repair:
+            results[key] = (connection.exec_driver_sql(f'UPDATE copies SET on_loan = {lent} WHERE {wrong_copies}').rowcount,
+                            connection.exec_driver_sql(f'UPDATE {table} SET {quantity} = {free} WHERE {wrong_counters}').rowcount)
+        else:
+            results[key] = (connection.exec_driver_sql(f'SELECT COUNT(*) FROM copies WHERE {wrong_copies}').scalar(),
+                            connection.exec_driver_sql(f'SELECT COUNT(*) FROM {table} WHERE {wrong_counters}').scalar())
+    return results
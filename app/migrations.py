@@ -0,0 +1,226 @@
+from datetime import datetime
+
+from sqlalchemy import event, func, select
+
+from app import db
+from app import search
+from app import inventory
+from app.models import Student, FineTransaction, Loan, BookLoan, Device, Book, Author, Copy, Hold, Notification, LoanArchive, BookLoanArchive, author_key
+
+
+# schema upgrades for existing databases, applied in order. the number of upgrades already applied
+# is kept in sqlite's user_version pragma. a database built from scratch by db.create_all() already
+# has the latest schema, so it is stamped with the latest version instead of being migrated
+
+def add_search_index(connection):
+    search.create_search_index(connection)
+    search.rebuild_search_index(connection)
+
+
+def pausable_book_index(connection):
+
+    # recreate the books insert trigger with the condition that lets bulk imports pause it
+    connection.exec_driver_sql('DROP TRIGGER IF EXISTS books_fts_insert')
+    search.create_search_index(connection)
+
+
+def column_type(connection, table, column):
+    for row in connection.exec_driver_sql(f'PRAGMA table_info("{table}")'):
+        if row[1] == column:
+            return row[2].upper()
+
+
+def create_indexes(connection, *models):
+
+    # an index on a column a later migration adds is left for that migration to create
+    for model in models:
+        for index in model.__table__.indexes:
+            if all(column_type(connection, model.__tablename__, column.name) for column in index.columns):
+                index.create(connection, checkfirst=True)
+
+
+def integer_fines(connection):
+
+    # fines were strings of pounds ('2.5'). each column is replaced by an integer column holding pence
+    for table, column, not_null in [('students', 'fines', True), ('loans', 'fine', True), ('book loans', 'fine_amount', False)]:
+        if column_type(connection, table, column) == 'INTEGER':
+            continue
+        connection.exec_driver_sql(f'ALTER TABLE "{table}" ADD COLUMN {column}_pence INTEGER '
+                                   + ('NOT NULL DEFAULT 0' if not_null else 'DEFAULT 0'))
+        connection.exec_driver_sql(f'UPDATE "{table}" SET {column}_pence = '
+                                   f'CAST(ROUND(COALESCE(CAST({column} AS REAL), 0) * 100) AS INTEGER)')
+        connection.exec_driver_sql(f'ALTER TABLE "{table}" DROP COLUMN {column}')
+        connection.exec_driver_sql(f'ALTER TABLE "{table}" RENAME COLUMN {column}_pence TO {column}')
+
+    FineTransaction.__table__.create(connection, checkfirst=True)
+    create_indexes(connection, Student)
+
+    # the ledger starts from each student's current balance
+    if not connection.exec_driver_sql('SELECT 1 FROM fine_transactions LIMIT 1').first():
+        connection.exec_driver_sql(
+            """INSERT INTO fine_transactions (student_id, amount, reason, created)
+               SELECT student_id, fines, 'opening balance', ? FROM students WHERE fines != 0""", (str(datetime.now()),))
+
+
+def open_loan_indexes(connection):
+
+    # indexes for the open loan lookups, the active loans page and the availability listings. the
+    # books index is created when normalise_authors rebuilds that table
+    create_indexes(connection, Loan, BookLoan, Device)
+
+
+def normalise_authors(connection):
+
+    # books named their author with two strings pointing at non-unique author columns, and every
+    # book added on the form added another author row. authors are merged on their normalised names,
+    # keeping the lowest id, and books is rebuilt with an integer author_id instead of the names
+    if column_type(connection, 'books', 'author_id'):
+        return
+
+    authors = {}
+    for author_id, firstname, lastname in connection.exec_driver_sql(
+            'SELECT author_id, author_firstname, author_lastname FROM authors ORDER BY author_id'):
+        authors.setdefault(author_key(firstname, lastname), (author_id, firstname or '', lastname or ''))
+
+    # names only ever seen on a book become authors too
+    next_id = max((author[0] for author in authors.values()), default=0) + 1
+    book_names = connection.exec_driver_sql('SELECT DISTINCT author_firstname, author_lastname FROM books').all()
+    for firstname, lastname in book_names:
+        key = author_key(firstname, lastname)
+        if key not in authors:
+            authors[key] = (next_id, firstname or '', lastname or '')
+            next_id += 1
+
+    connection.exec_driver_sql('CREATE TEMP TABLE author_names (firstname TEXT, lastname TEXT, author_id INTEGER)')
+    connection.exec_driver_sql('INSERT INTO temp.author_names VALUES (?, ?, ?)',
+                               [(firstname, lastname, authors[author_key(firstname, lastname)][0])
+                                for firstname, lastname in book_names])
+
+    # the old tables are renamed out of the way and the new ones created from the models, which
+    # also creates their indexes and full-text indexes
+    search.drop_catalogue_index(connection)
+    for table, model in (('books', Book), ('authors', Author)):
+        connection.exec_driver_sql(f'ALTER TABLE {table} RENAME TO {table}_old')
+        for index in model.__table__.indexes:
+            connection.exec_driver_sql(f'DROP INDEX IF EXISTS {index.name}')
+    Author.__table__.create(connection)
+    Book.__table__.create(connection)
+
+    connection.exec_driver_sql('INSERT INTO authors (author_id, author_firstname, author_lastname, name_key) VALUES (?, ?, ?, ?)',
+                               [(author_id, ' '.join(firstname.split()), ' '.join(lastname.split()), key)
+                                for key, (author_id, firstname, lastname) in authors.items()])
+    search.pause_book_index(connection)
+    connection.exec_driver_sql(
+        """INSERT INTO books (book_id, book_title, author_id, number_of_pages, quantity, loan_period, genre)
+           SELECT b.book_id, b.book_title, n.author_id, b.number_of_pages, b.quantity, b.loan_period, b.genre
+           FROM books_old b JOIN temp.author_names n
+           ON n.firstname IS b.author_firstname AND n.lastname IS b.author_lastname""")
+    search.resume_book_index(connection, 0)
+
+    for statement in ('DROP TABLE books_old', 'DROP TABLE authors_old', 'DROP TABLE temp.author_names'):
+        connection.exec_driver_sql(statement)
+
+
+def copy_inventory(connection):
+
+    # every device and book gets a copy per unit it has (on the shelf or out on loan), and each open
+    # loan is linked to one of its item's copies
+    Copy.__table__.create(connection, checkfirst=True)
+    for table in ('loans', 'book loans'):
+        if not column_type(connection, table, 'copy_id'):
+            connection.exec_driver_sql(f'ALTER TABLE "{table}" ADD COLUMN copy_id INTEGER REFERENCES copies (copy_id)')
+    create_indexes(connection, Loan, BookLoan)
+    inventory.add_missing_copies(connection)
+
+
+def hold_queue(connection):
+    Hold.__table__.create(connection, checkfirst=True)
+
+
+def notification_outbox(connection):
+
+    # the outbox, and the indexes the scanner reads the open loans by due date through
+    Notification.__table__.create(connection, checkfirst=True)
+    create_indexes(connection, Loan, BookLoan)
+
+
+def loan_archive(connection):
+
+    # the archive tables, in the main database or the attached ARCHIVE_DATABASE
+    for model in (LoanArchive, BookLoanArchive):
+        model.__table__.create(connection, checkfirst=True)
+
+
+def autoincrement_loan_ids(connection):
+
+    # loans and book loans are rebuilt with AUTOINCREMENT, so sqlite no longer hands out again the id
+    # of a deleted or archived loan. the sequence starts above every id used so far, archived or not
+    for model, archive_model in ((Loan, LoanArchive), (BookLoan, BookLoanArchive)):
+        table = model.__tablename__
+        if 'AUTOINCREMENT' in connection.exec_driver_sql(
+                "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).scalar().upper():
+            continue
+
+        connection.exec_driver_sql(f'ALTER TABLE "{table}" RENAME TO "{table}_old"')
+        for index in model.__table__.indexes:
+            connection.exec_driver_sql(f'DROP INDEX IF EXISTS {index.name}')
+        model.__table__.create(connection)
+        columns = ', '.join(column.name for column in model.__table__.columns)
+        connection.exec_driver_sql(f'INSERT INTO "{table}" ({columns}) SELECT {columns} FROM "{table}_old"')
+        connection.exec_driver_sql(f'DROP TABLE "{table}_old"')
+
+        last_id = max(connection.scalar(select(func.coalesce(func.max(model.loan_id), 0))),
+                      connection.scalar(select(func.coalesce(func.max(archive_model.loan_id), 0))))
+        connection.exec_driver_sql('DELETE FROM sqlite_sequence WHERE name = ?', (table,))
+        connection.exec_driver_sql('INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)', (table, last_id))
+
+
+MIGRATIONS = [
+    add_search_index,
+    pausable_book_index,
+    integer_fines,
+    open_loan_indexes,
+    normalise_authors,
+    copy_inventory,
+    hold_queue,
+    notification_outbox,
+    loan_archive,
+    autoincrement_loan_ids,
+]
+
+
+def schema_version(connection):
+    return connection.exec_driver_sql('PRAGMA user_version').scalar()
+
+
+def stamp(connection, version=len(MIGRATIONS)):
+    connection.exec_driver_sql(f'PRAGMA user_version = {int(version)}')
+
+
+def upgrade(engine=None):
+
+    # apply every migration newer than the database, each one in its own transaction
+    engine = engine or db.engine
+    applied = []
+
+    with engine.connect() as connection:
+        version = schema_version(connection)
+
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        with engine.begin() as connection:
+            migration(connection)
+            stamp(connection, number)
+        applied.append(migration.__name__)
+
+    return applied
+
+
+@event.listens_for(db.metadata, 'before_create')
+def _check_new_database(target, connection, **kw):
+    connection.info['new_database'] = not connection.dialect.has_table(connection, 'students')
+
+
+@event.listens_for(db.metadata, 'after_create')
+def _stamp_new_database(target, connection, **kw):
+    if connection.info.pop('new_database', False) and connection.dialect.name == 'sqlite':
+        stamp(connection)
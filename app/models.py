@@ -1,6 +1,12 @@
-from app import db, login
-from werkzeug.security import generate_password_hash, check_password_hash
+import threading
+import time
+from datetime import datetime
+
+from app import app, db, login
+from app import passwords
 from flask_login import UserMixin
+from sqlalchemy import event
+from sqlalchemy.orm import make_transient_to_detached, object_session
 
 
 class User(UserMixin, db.Model):
@@ -11,10 +17,10 @@ class User(UserMixin, db.Model):
     password_hash = db.Column(db.String(256), nullable=False)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password, salt_length=32)
+        self.password_hash = passwords.hash_password(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return passwords.check_password(self.password_hash, password)
 
     
     def get_id(self):
@@ -23,9 +29,36 @@ class User(UserMixin, db.Model):
     def __repr__(self):
         return f"user(id='{self.user_id}', '{self.username}', '{self.email}')"
 
+
+# the logged in user is loaded on every request, so each worker keeps a detached copy of recently
+# seen users for USER_CACHE_TTL seconds and merges it into the request's session without a query.
+# a copy is dropped as soon as this worker changes or deletes the user; other workers keep theirs
+# until it expires
+_user_cache = {}
+_user_cache_lock = threading.Lock()
+
+
 @login.user_loader
 def load_user(id):
-    return User.query.get(int(id))
+    user_id = int(id)
+    entry = _user_cache.get(user_id)
+    if entry and entry[0] > time.monotonic():
+        return db.session.merge(entry[1], load=False)
+
+    user = db.session.get(User, user_id)
+    if user is not None and app.config['USER_CACHE_TTL'] > 0:
+        copy = User(**{column.key: getattr(user, column.key) for column in User.__table__.columns})
+        make_transient_to_detached(copy)
+        with _user_cache_lock:
+            _user_cache[user_id] = (time.monotonic() + app.config['USER_CACHE_TTL'], copy)
+    return user
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def forget_cached_user(mapper, connection, user):
+    with _user_cache_lock:
+        _user_cache.pop(user.user_id, None)
 
 class Student(db.Model):
     __tablename__ = 'students'
@@ -35,12 +68,32 @@ class Student(db.Model):
     lastname = db.Column(db.String(32), nullable=False, index=True)
     email = db.Column(db.String(64), nullable=False, unique=True, index=True)
     active = db.Column(db.Boolean, nullable=False, default=True)
-    fines = db.Column(db.String(32), nullable=False, default='0.0')
-    loans = db.relationship('Loan', backref='student', lazy='dynamic')
+    fines = db.Column(db.Integer, nullable=False, default=0)
+    loans = db.relationship('Loan', backref='student', order_by='Loan.loan_id')
 
-    @property
-    def active_loans(self):
-        return Loan.query.filter_by(student_id=self.student_id, returndatetime=None).all()
+    # the loans not returned yet. being a relationship rather than a query it can be loaded for a
+    # whole page of students at once with selectinload(Student.active_loans)
+    active_loans = db.relationship('Loan', primaryjoin='and_(Student.student_id == Loan.student_id, '
+                                                      'Loan.returndatetime.is_(None))',
+                                   order_by='Loan.loan_id', viewonly=True)
+
+    # fines are stored in pence. the partial index only holds students who owe money, so the
+    # outstanding fines page (Student.fines > 0) reads a handful of rows however many students there are
+    __table_args__ = (
+        db.Index('ix_students_owing', 'student_id', sqlite_where=db.text('fines > 0')),
+    )
+
+    def charge_fine(self, amount, reason, loan_id=None, book_loan_id=None):
+
+        # record the charge in the ledger and update the balance in sql, so two returns
+        # committing at the same time cannot overwrite each other's fine
+        object_session(self).add(FineTransaction(student_id=self.student_id, amount=amount, reason=reason,
+                                                 loan_id=loan_id, book_loan_id=book_loan_id))
+        self.fines = Student.fines + amount
+
+    def pay_fine(self, amount):
+        object_session(self).add(FineTransaction(student_id=self.student_id, amount=-amount, reason='payment'))
+        self.fines = Student.fines - amount
 
     def __repr__(self):
         return f"student(id='{self.student_id}', '{self.username}', '{self.lastname}', '{self.firstname}' , '{self.email}', active='{self.active}')"
@@ -54,10 +107,25 @@ class Loan(db.Model):
     duedatetime = db.Column(db.DateTime, nullable=False)
     returndatetime = db.Column(db.DateTime, nullable=True)
     student_id = db.Column(db.Integer, db.ForeignKey('students.student_id'), nullable=False)
-    fine = db.Column(db.String(32), nullable=False, default='0.0')
+    fine = db.Column(db.Integer, nullable=False, default=0)
+    copy_id = db.Column(db.Integer, db.ForeignKey('copies.copy_id'), nullable=True)
+
+    # the open loans of a student or a device are found through the composite indexes (sqlite can
+    # use returndatetime IS NULL as an equality match on the second column), and the partial indexes
+    # only hold loans that are still out, for the active loans page and the due date range scans of
+    # the notification scanner. loan ids are never handed out again (autoincrement), as the archive,
+    # the fine ledger and the reminders' idempotency keys refer to loans that may no longer be here
+    __table_args__ = (
+        db.Index('ix_loans_student_returned', 'student_id', 'returndatetime'),
+        db.Index('ix_loans_device_returned', 'device_id', 'returndatetime'),
+        db.Index('ix_loans_open', 'loan_id', sqlite_where=db.text('returndatetime IS NULL')),
+        db.Index('ix_loans_open_due', 'duedatetime', 'loan_id', sqlite_where=db.text('returndatetime IS NULL')),
+        db.Index('ix_loans_copy_returned', 'copy_id', 'returndatetime'),
+        {'sqlite_autoincrement': True},
+    )
 
     def __repr__(self):
-        return f"loan(loan_id='{self.loan_id}', device_id='{self.device_id}', borrowdatetime='{self.borrowdatetime}', returndatetime='{self.returndatetime}', '{self.student}')"
+        return f"loan(loan_id='{self.loan_id}', device_id='{self.device_id}', borrowdatetime='{self.borrowdatetime}', returndatetime='{self.returndatetime}', student_id='{self.student_id}')"
 
 
 class Device(db.Model):
@@ -67,6 +135,10 @@ class Device(db.Model):
     device_quantity = db.Column(db.Integer, nullable=False, default=1)
     loan_period = db.Column(db.Integer, nullable=True, default=30)
 
+    # the available devices listing reads this partial index instead of the whole table
+    __table_args__ = (
+        db.Index('ix_devices_in_stock', 'device_id', sqlite_where=db.text('device_quantity >= 1')),
+    )
 
     def __repr__(self):
         return f"device(device_id='{self.device_id}', device_name='{self.device_name}', device_quantity='{self.device_quantity}"
@@ -75,22 +147,57 @@ class Device(db.Model):
 class Book(db.Model):
     __tablename__ = 'books'
     book_id = db.Column(db.Integer, primary_key=True, unique=True, nullable=False)
-    book_title = db.Column(db.String, nullable=False)
-    author_firstname = db.Column(db.String(32), db.ForeignKey('authors.author_firstname'), nullable=False)
-    author_lastname = db.Column(db.String(32), db.ForeignKey('authors.author_lastname'), nullable=False)
+    book_title = db.Column(db.String, nullable=False, index=True)
+    author_id = db.Column(db.Integer, db.ForeignKey('authors.author_id'), nullable=False, index=True)
     number_of_pages = db.Column(db.Integer, nullable=False)
     quantity = db.Column(db.Integer, default=1)
     loan_period = db.Column(db.Integer, nullable=True, default=30)
     genre = db.Column(db.String(32), nullable=True)
+    author = db.relationship('Author', backref='books')
+
+    __table_args__ = (
+        db.Index('ix_books_in_stock', 'book_id', sqlite_where=db.text('quantity > 0')),
+    )
+
+    # the author's names, for the pages and json that show a book with its author. load a list of
+    # books with their author joined (see search.book_search_statement) to avoid a query per book
+    @property
+    def author_firstname(self):
+        return self.author.author_firstname
+
+    @property
+    def author_lastname(self):
+        return self.author.author_lastname
 
     def __repr__(self):
-        return f"book('{self.book_title}', '{self.book_author}', '{self.number_of_pages}', '{self.quantity}')"
+        return f"book('{self.book_title}', '{self.author_id}', '{self.number_of_pages}', '{self.quantity}')"
+
+
+def author_key(firstname, lastname):
+
+    # authors are told apart by their names with case and spacing ignored, so "Ursula K. Le Guin"
+    # typed on the add book form and "ursula k.  le guin" from an import are the same author
+    return '|'.join(' '.join((name or '').split()).casefold() for name in (firstname, lastname))
+
 
 class Author(db.Model):
     __tablename__ = 'authors'
     author_id = db.Column(db.Integer, primary_key=True, unique=True, nullable=False)
-    author_firstname = db.Column(db.String(16))
-    author_lastname = db.Column(db.String(16))
+    author_firstname = db.Column(db.String(32), nullable=False)
+    author_lastname = db.Column(db.String(32), nullable=False)
+    name_key = db.Column(db.String(80), nullable=False, unique=True, index=True)
+
+    @classmethod
+    def get_or_add(cls, session, firstname, lastname):
+
+        # the author with these names, added to the session when there is none yet
+        key = author_key(firstname, lastname)
+        author = session.scalar(db.select(cls).where(cls.name_key == key))
+        if author is None:
+            author = cls(author_firstname=' '.join(firstname.split()), author_lastname=' '.join(lastname.split()),
+                         name_key=key)
+            session.add(author)
+        return author
 
     def __repr__(self):
         return f"author('{self.author_firstname}', '{self.author_lastname}')"
@@ -103,8 +210,175 @@ class BookLoan(db.Model):
     duedatetime = db.Column(db.DateTime, nullable=False)
     returndatetime = db.Column(db.DateTime, nullable=True)
     student_id = db.Column(db.Integer, db.ForeignKey('students.student_id'), nullable=False)
-    fine_amount = db.Column(db.String(32), nullable=True, default='0.0')
+    fine_amount = db.Column(db.Integer, nullable=True, default=0)
+    copy_id = db.Column(db.Integer, db.ForeignKey('copies.copy_id'), nullable=True)
     student = db.relationship("Student", backref="book_loans")
 
+    # same indexes as loans
+    __table_args__ = (
+        db.Index('ix_book_loans_student_returned', 'student_id', 'returndatetime'),
+        db.Index('ix_book_loans_book_returned', 'book_id', 'returndatetime'),
+        db.Index('ix_book_loans_open', 'loan_id', sqlite_where=db.text('returndatetime IS NULL')),
+        db.Index('ix_book_loans_open_due', 'duedatetime', 'loan_id', sqlite_where=db.text('returndatetime IS NULL')),
+        db.Index('ix_book_loans_copy_returned', 'copy_id', 'returndatetime'),
+        {'sqlite_autoincrement': True},
+    )
+
     def __repr__(self):
         return f"book loan('{self.book_id}', '{self.borrowdatetime}' , '{self.returndatetime}', '{self.student_id}')"
+
+
+# returned loans older than ARCHIVE_AFTER_DAYS are moved out of loans and book loans into these
+# tables by flask library archive-loans (see app/archive.py), keeping their ids. with
+# ARCHIVE_DATABASE set they live in that file, attached to every connection as "archive"
+ARCHIVE_SCHEMA = 'archive' if app.config['ARCHIVE_DATABASE'] else None
+
+
+class LoanArchive(db.Model):
+    __tablename__ = 'loans_archive'
+    loan_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    device_id = db.Column(db.Integer, nullable=False)
+    borrowdatetime = db.Column(db.DateTime, nullable=False)
+    duedatetime = db.Column(db.DateTime, nullable=False)
+    returndatetime = db.Column(db.DateTime, nullable=False)
+    student_id = db.Column(db.Integer, nullable=False)
+    fine = db.Column(db.Integer, nullable=False, default=0)
+    copy_id = db.Column(db.Integer, nullable=True)
+    archived = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+    __table_args__ = (
+        db.Index('ix_loans_archive_student', 'student_id'),
+        db.Index('ix_loans_archive_device', 'device_id'),
+        {'schema': ARCHIVE_SCHEMA},
+    )
+
+    def __repr__(self):
+        return f"archived loan(loan_id='{self.loan_id}', device_id='{self.device_id}', student_id='{self.student_id}', returndatetime='{self.returndatetime}')"
+
+
+class BookLoanArchive(db.Model):
+    __tablename__ = 'book_loans_archive'
+    loan_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    book_id = db.Column(db.Integer, nullable=False)
+    borrowdatetime = db.Column(db.DateTime, nullable=False)
+    duedatetime = db.Column(db.DateTime, nullable=False)
+    returndatetime = db.Column(db.DateTime, nullable=False)
+    student_id = db.Column(db.Integer, nullable=False)
+    fine_amount = db.Column(db.Integer, nullable=True, default=0)
+    copy_id = db.Column(db.Integer, nullable=True)
+    archived = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+    __table_args__ = (
+        db.Index('ix_book_loans_archive_student', 'student_id'),
+        db.Index('ix_book_loans_archive_book', 'book_id'),
+        {'schema': ARCHIVE_SCHEMA},
+    )
+
+    def __repr__(self):
+        return f"archived book loan('{self.loan_id}', '{self.book_id}', '{self.student_id}', '{self.returndatetime}')"
+
+
+class Copy(db.Model):
+    __tablename__ = 'copies'
+
+    # one row per physical device or book, labelled with its barcode or asset tag. a copy is on loan
+    # while an open loan points at it, or a ready hold has it set aside. device_quantity and quantity
+    # count each item's copies that are neither, so availability stays a single column read; see
+    # inventory.py for how the two are kept in step
+    copy_id = db.Column(db.Integer, primary_key=True, unique=True, nullable=False)
+    barcode = db.Column(db.String(32), nullable=False, unique=True, index=True)
+    device_id = db.Column(db.Integer, db.ForeignKey('devices.device_id'), nullable=True)
+    book_id = db.Column(db.Integer, db.ForeignKey('books.book_id'), nullable=True)
+    on_loan = db.Column(db.Boolean, nullable=False, default=False)
+
+    # a free copy of an item is found by seeking to (item, on_loan = 0)
+    __table_args__ = (
+        db.Index('ix_copies_device_on_loan', 'device_id', 'on_loan'),
+        db.Index('ix_copies_book_on_loan', 'book_id', 'on_loan'),
+        db.CheckConstraint('(device_id IS NULL) != (book_id IS NULL)', name='ck_copies_one_item'),
+    )
+
+    def __repr__(self):
+        return f"copy('{self.barcode}', device_id='{self.device_id}', book_id='{self.book_id}', on_loan='{self.on_loan}')"
+
+
+class Hold(db.Model):
+    __tablename__ = 'holds'
+
+    # a student's place in the queue for a device or book with none on the shelf. a hold is waiting
+    # until a copy comes back, then ready, with that copy set aside until expires, and finally
+    # collected, expired or cancelled
+    hold_id = db.Column(db.Integer, primary_key=True, unique=True, nullable=False)
+    student_id = db.Column(db.Integer, db.ForeignKey('students.student_id'), nullable=False)
+    device_id = db.Column(db.Integer, db.ForeignKey('devices.device_id'), nullable=True)
+    book_id = db.Column(db.Integer, db.ForeignKey('books.book_id'), nullable=True)
+    placed = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    status = db.Column(db.String(16), nullable=False, default='waiting')
+    copy_id = db.Column(db.Integer, db.ForeignKey('copies.copy_id'), nullable=True)
+    expires = db.Column(db.DateTime, nullable=True)
+
+    # the queue of an item is its waiting holds in hold id order, so the next in line is one seek into
+    # a partial index holding only waiting holds, however long the queue has grown
+    __table_args__ = (
+        db.Index('ix_holds_device_queue', 'device_id', 'hold_id', sqlite_where=db.text("status = 'waiting'")),
+        db.Index('ix_holds_book_queue', 'book_id', 'hold_id', sqlite_where=db.text("status = 'waiting'")),
+        db.Index('ix_holds_ready_expires', 'expires', sqlite_where=db.text("status = 'ready'")),
+        db.Index('ix_holds_ready_copy', 'copy_id', sqlite_where=db.text("status = 'ready'")),
+        db.Index('ix_holds_student_status', 'student_id', 'status'),
+        db.CheckConstraint('(device_id IS NULL) != (book_id IS NULL)', name='ck_holds_one_item'),
+    )
+
+    def __repr__(self):
+        return f"hold('{self.hold_id}', student_id='{self.student_id}', device_id='{self.device_id}', book_id='{self.book_id}', status='{self.status}')"
+
+
+class FineTransaction(db.Model):
+    __tablename__ = 'fine_transactions'
+
+    # append-only ledger of every fine and payment in pence (charges positive, payments negative).
+    # a student's fines column is always the sum of their transactions, see fines.rebuild_balances
+    transaction_id = db.Column(db.Integer, primary_key=True, unique=True, nullable=False)
+    student_id = db.Column(db.Integer, db.ForeignKey('students.student_id'), nullable=False, index=True)
+    amount = db.Column(db.Integer, nullable=False)
+    reason = db.Column(db.String(16), nullable=False)
+    loan_id = db.Column(db.Integer, nullable=True)
+    book_loan_id = db.Column(db.Integer, nullable=True)
+    created = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+    def __repr__(self):
+        return f"fine transaction('{self.transaction_id}', '{self.student_id}', '{self.amount}', '{self.reason}', '{self.created}')"
+
+
+class Notification(db.Model):
+    __tablename__ = 'notifications'
+
+    # the outbox. the scanner writes a message here for each loan that is due soon or overdue, once,
+    # as the idempotency key is unique, and the senders drain it. a message is pending until a worker
+    # claims it, which makes it sending until next_attempt (the lease), then sent, or pending again
+    # with a later next_attempt after a failure, and failed once it has run out of attempts
+    notification_id = db.Column(db.Integer, primary_key=True, unique=True, nullable=False)
+    idempotency_key = db.Column(db.String(64), nullable=False, unique=True)
+    kind = db.Column(db.String(20), nullable=False)
+    student_id = db.Column(db.Integer, db.ForeignKey('students.student_id'), nullable=False, index=True)
+    loan_id = db.Column(db.Integer, nullable=True)
+    book_loan_id = db.Column(db.Integer, nullable=True)
+    due = db.Column(db.DateTime, nullable=False)
+    recipient = db.Column(db.String(120), nullable=False)
+    subject = db.Column(db.String(200), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    created = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    status = db.Column(db.String(16), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    sent = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.String(200), nullable=True)
+
+    # workers claim the messages due for an attempt in next_attempt order from a partial index of the
+    # ones not yet done, and the scanner finds where its last overdue sweep got to with (kind, due)
+    __table_args__ = (
+        db.Index('ix_notifications_to_send', 'next_attempt', sqlite_where=db.text("status IN ('pending', 'sending')")),
+        db.Index('ix_notifications_kind_due', 'kind', 'due'),
+    )
+
+    def __repr__(self):
+        return f"notification('{self.idempotency_key}', '{self.recipient}', status='{self.status}', attempts='{self.attempts}')"
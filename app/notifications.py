@@ -0,0 +1,342 @@
+import importlib
+import os
+import random
+import smtplib
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from email.mime.text import MIMEText
+
+from sqlalchemy import String, bindparam, cast, exists, func, literal, select, text, tuple_, update
+from sqlalchemy.dialects.sqlite import insert
+
+from app import app, db
+from app.checkout import ITEM_KINDS, run_in_transaction
+from app.instrumentation import metrics
+from app.models import Book, Device, Notification, Student
+
+
+# reminders for loans that are due back soon and for overdue loans, through a transactional outbox.
+# the scanner range scans the open loans by due date and writes a message per loan to the
+# notifications table, a batch per short transaction, each with an idempotency key so a loan is only
+# ever queued once per kind. a pool of workers drains the table: a worker claims a batch (leasing it,
+# so a worker that dies only delays its messages), hands it to the sender outside any transaction
+# and records the outcome, retrying failures with exponential backoff until they run out of attempts
+
+WINDOWS = ('due soon', 'overdue')
+
+NAME_COLUMNS = {
+    'device_id': Device.device_name,
+    'book_id': Book.book_title,
+}
+
+
+def notification_kind(key, window):
+    return f'{key[:-3]} {window}'
+
+
+def idempotency_key(kind, loan_id):
+    return f'{kind.replace(" ", "-")}-{loan_id}'
+
+
+def idempotency_keys(key, loan_ids):
+
+    # every key a loan of the kind can have been queued with
+    return [idempotency_key(notification_kind(key, window), loan_id) for window in WINDOWS for loan_id in loan_ids]
+
+
+def _message(kind, window, row):
+    name = row.item_name or f'{kind} {row.loan_id}'
+    due = f'{row.duedatetime:%d %B %Y at %H:%M}'
+    if window == 'due soon':
+        return (f'{name} is due back soon',
+                f'Hello {row.firstname or "there"},\n\n{name} is due back on {due}. Please return it by then '
+                f'to avoid a fine.\n')
+    return (f'{name} is overdue',
+            f'Hello {row.firstname or "there"},\n\n{name} was due back on {due}. A fine is building up until '
+            f'it is returned, so please bring it back as soon as you can.\n')
+
+
+def due_loans(key, window, start, end, after, batch_size):
+
+    # the next batch of open loans due in [start, end) after the (due, loan id) position after, in
+    # due date order through the partial index of open loans, leaving out the ones already queued
+    kind = ITEM_KINDS[key]
+    loans = kind['loan_model']
+    prefix = idempotency_key(notification_kind(key, window), '')
+    return (select(loans.loan_id, loans.duedatetime, loans.student_id, Student.firstname, Student.email,
+                   NAME_COLUMNS[key].label('item_name'))
+            .join(Student, Student.student_id == loans.student_id)
+            .outerjoin(kind['model'], kind['id_column'] == getattr(loans, key))
+            .where(loans.returndatetime.is_(None) & (loans.duedatetime >= start) & (loans.duedatetime < end)
+                   & (tuple_(loans.duedatetime, loans.loan_id) > tuple_(*after)))
+            .where(~exists().where(Notification.idempotency_key == literal(prefix) + cast(loans.loan_id, String)))
+            .order_by(loans.duedatetime, loans.loan_id).limit(batch_size))
+
+
+def _scan_batch(session, key, window, start, end, after, now, batch_size):
+
+    # queues a batch of due_loans. returns the position of the last loan read (None when there are
+    # no more) and the number of messages queued
+    kind = ITEM_KINDS[key]
+    name = notification_kind(key, window)
+    rows = session.execute(due_loans(key, window, start, end, after, batch_size)).all()
+    if not rows:
+        return None, 0
+
+    messages = []
+    for row in rows:
+        subject, body = _message(key[:-3], window, row)
+        messages.append({'idempotency_key': idempotency_key(name, row.loan_id), 'kind': name,
+                         'student_id': row.student_id, kind['ledger_column']: row.loan_id, 'due': row.duedatetime,
+                         'recipient': row.email, 'subject': subject, 'body': body, 'created': now,
+                         'status': 'pending', 'attempts': 0, 'next_attempt': now})
+
+    # a message queued by another scanner since the read is left as it is
+    queued = session.execute(insert(Notification.__table__)
+                             .on_conflict_do_nothing(index_elements=['idempotency_key']), messages).rowcount
+    return (rows[-1].duedatetime, rows[-1].loan_id), queued
+
+
+def scan_notifications(session=None, now=None, batch_size=None):
+
+    # one sweep over the device and book loans. the due soon window is read again on every sweep, as
+    # a short loan can fall into it after the last one, but overdue loans are read from the due date
+    # of the last one queued, as no loan still out can become overdue before that. returns the
+    # number of messages queued by kind
+    session = session or db.session
+    now = now or datetime.now()
+    batch_size = batch_size or app.config['NOTIFICATION_BATCH_SIZE']
+    queued = Counter()
+
+    for key in ITEM_KINDS:
+        for window in WINDOWS:
+            name = notification_kind(key, window)
+            if window == 'due soon':
+                start, end = now, now + timedelta(seconds=app.config['NOTIFICATION_DUE_SOON'])
+            else:
+                start = session.scalar(last_overdue(name)) or datetime.min
+                end = now
+
+            after = (start, 0)
+            while after is not None:
+                after, count = run_in_transaction(
+                    lambda after=after: _scan_batch(session, key, window, start, end, after, now, batch_size), session)
+                queued[name] += count
+
+    metrics.notification_events(queued=sum(queued.values()))
+    return queued
+
+
+def email_message(message, sender_address):
+
+    # built with the compat32 classes, as the default email policy spends milliseconds parsing the
+    # headers of every message
+    email = MIMEText(message.body, 'plain', 'utf-8')
+    email['From'] = sender_address
+    email['To'] = message.recipient
+    email['Subject'] = message.subject
+
+    # the same message sent twice (after a lease ran out mid-send) carries the same id, so the
+    # receiving end can drop the copy
+    email['Message-ID'] = f'<{message.idempotency_key}@{sender_address.partition("@")[2] or "library"}>'
+    email['X-Idempotency-Key'] = message.idempotency_key
+    return email
+
+
+class Sender:
+
+    # hands messages to whatever delivers them. send_batch returns {notification id: error} of the
+    # messages that could not be sent; the rest count as sent
+    name = 'sender'
+
+    def send(self, message):
+        raise NotImplementedError
+
+    def send_batch(self, messages):
+        failures = {}
+        for message in messages:
+            try:
+                self.send(message)
+            except Exception as e:
+                failures[message.notification_id] = str(e) or type(e).__name__
+        return failures
+
+
+class FileSender(Sender):
+
+    # writes each message to directory/<idempotency key>.eml, for testing. a message sent again
+    # replaces its file
+    name = 'file'
+
+    def __init__(self, directory, sender_address):
+        self.directory = directory
+        self.sender_address = sender_address
+        os.makedirs(directory, exist_ok=True)
+
+    def send(self, message):
+        path = os.path.join(self.directory, f'{message.idempotency_key}.eml')
+        partial = f'{path}.{threading.get_ident()}.tmp'
+        with open(partial, 'wb') as f:
+            f.write(email_message(message, self.sender_address).as_bytes())
+        os.replace(partial, path)
+
+
+class SmtpSender(Sender):
+
+    # sends a batch over one connection to an smtp server, such as a local debugging server
+    # (python -m aiosmtpd -n -l localhost:8025) for testing
+    name = 'smtp'
+
+    def __init__(self, host, port, sender_address, timeout=10):
+        self.host = host
+        self.port = port
+        self.sender_address = sender_address
+        self.timeout = timeout
+
+    def send_batch(self, messages):
+
+        # the workers share the sender, so each batch has a connection of its own
+        failures, done = {}, set()
+        try:
+            with smtplib.SMTP(self.host, self.port, timeout=self.timeout) as connection:
+                for message in messages:
+                    try:
+                        connection.send_message(email_message(message, self.sender_address))
+                    except smtplib.SMTPRecipientsRefused as e:
+                        failures[message.notification_id] = str(e)
+                    done.add(message.notification_id)
+        except (OSError, smtplib.SMTPException) as e:
+
+            # a lost connection fails the rest of the batch, not what was already handed over
+            failures.update({message.notification_id: f'{self.host}:{self.port}: {e}' for message in messages
+                             if message.notification_id not in done})
+        return failures
+
+
+def get_sender(name=None):
+
+    # file, smtp, or module:callable returning a Sender
+    name = name or app.config['NOTIFICATION_SENDER']
+    if name == 'file':
+        return FileSender(app.config['NOTIFICATION_DIR'], app.config['NOTIFICATION_FROM'])
+    if name == 'smtp':
+        return SmtpSender(app.config['SMTP_HOST'], app.config['SMTP_PORT'], app.config['NOTIFICATION_FROM'])
+    module, _, attribute = name.partition(':')
+    if not attribute:
+        raise ValueError(f'unknown notification sender {name!r}')
+    return getattr(importlib.import_module(module), attribute)()
+
+
+def retry_delay(attempts):
+    delay = app.config['NOTIFICATION_RETRY_DELAY'] * 2 ** (attempts - 1) * random.uniform(0.5, 1.5)
+    return timedelta(seconds=min(delay, app.config['NOTIFICATION_MAX_RETRY_DELAY']))
+
+
+def claim(batch_size, now):
+
+    # takes the next batch due for an attempt: pending messages, and ones whose worker let their lease
+    # run out. each attempt gets a new number, which the outcome is recorded against
+    lease = now + timedelta(seconds=app.config['NOTIFICATION_LEASE'])
+    # the status test is written out as in the partial index, which sqlite cannot match with bound values
+    due = (select(Notification.notification_id)
+           .where(text("status IN ('pending', 'sending')") & (Notification.next_attempt <= now))
+           .order_by(Notification.next_attempt).limit(batch_size))
+    return (update(Notification).where(Notification.notification_id.in_(due))
+            .values(status='sending', attempts=Notification.attempts + 1, next_attempt=lease)
+            .returning(Notification.notification_id, Notification.idempotency_key, Notification.recipient,
+                       Notification.subject, Notification.body, Notification.attempts)
+            .execution_options(synchronize_session=False))
+
+
+def last_overdue(kind):
+    return select(func.max(Notification.due)).where(Notification.kind == kind)
+
+
+def _record(session, messages, failures, now):
+
+    # returns the number of messages sent, to be retried and given up on
+    outcome = Counter()
+    sent = [message.notification_id for message in messages if message.notification_id not in failures]
+    if sent:
+        session.execute(update(Notification).where(Notification.notification_id.in_(sent))
+                        .values(status='sent', sent=now, last_error=None)
+                        .execution_options(synchronize_session=False))
+        outcome['sent'] = len(sent)
+
+    retries = []
+    for message in messages:
+        if message.notification_id in failures:
+            give_up = message.attempts >= app.config['NOTIFICATION_MAX_ATTEMPTS']
+            retries.append({'failed_id': message.notification_id, 'attempt': message.attempts,
+                            'new_status': 'failed' if give_up else 'pending',
+                            'retry_at': now + retry_delay(message.attempts),
+                            'error': failures[message.notification_id][:200]})
+            outcome['failed' if give_up else 'retried'] += 1
+    if retries:
+
+        # a message claimed again by another worker since (its lease ran out) belongs to that attempt
+        notifications = Notification.__table__
+        session.execute(update(notifications)
+                        .where((notifications.c.notification_id == bindparam('failed_id'))
+                               & (notifications.c.attempts == bindparam('attempt')))
+                        .values(status=bindparam('new_status'), next_attempt=bindparam('retry_at'),
+                                last_error=bindparam('error')), retries)
+    return outcome
+
+
+def _drain(sender, batch_size, totals, lock):
+    with app.app_context():
+        session = db.session
+        while True:
+            claimed = run_in_transaction(lambda: session.execute(claim(batch_size, datetime.now())).all(), session)
+            if not claimed:
+                return
+
+            started = time.perf_counter()
+            failures = sender.send_batch(claimed)
+            seconds = time.perf_counter() - started
+            outcome = run_in_transaction(lambda: _record(session, claimed, failures, datetime.now()), session)
+
+            metrics.notification_events(sender.name, seconds=seconds, **outcome)
+            with lock:
+                totals.update(outcome)
+
+
+def send_notifications(workers=None, batch_size=None, sender=None):
+
+    # drains the outbox with a pool of worker threads, each with its own session, until nothing is
+    # due for an attempt. returns the number of messages sent, to be retried and failed
+    workers = workers or app.config['NOTIFICATION_WORKERS']
+    batch_size = batch_size or app.config['NOTIFICATION_BATCH_SIZE']
+    sender = sender or get_sender()
+    totals, lock = Counter(), threading.Lock()
+
+    with ThreadPoolExecutor(workers, thread_name_prefix='notification-sender') as pool:
+        for future in [pool.submit(_drain, sender, batch_size, totals, lock) for _ in range(workers)]:
+            future.result()
+    return totals
+
+
+def run_worker(interval):
+    while True:
+        time.sleep(interval)
+        with app.app_context():
+            try:
+                queued = scan_notifications()
+                sent = send_notifications()
+                app.logger.debug('notifications: %d queued, %d sent, %d to retry, %d failed', sum(queued.values()),
+                                 sent['sent'], sent['retried'], sent['failed'])
+            except Exception:
+                app.logger.exception('notification sweep failed')
+
+
+def start_worker(interval=None):
+
+    # scans and sends in a daemon thread of this process every NOTIFICATION_INTERVAL seconds
+    interval = interval or app.config['NOTIFICATION_INTERVAL']
+    thread = threading.Thread(target=run_worker, args=(interval,), name='notifications', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,64 @@
+import itertools
+
+from flask import Response, current_app, request, stream_with_context
+
+
+def page_args(args=None, config=None):
+
+    # read the keyset cursor and page size from the query string, ignoring anything that is not a positive integer
+    args = request.args if args is None else args
+    config = current_app.config if config is None else config
+    after = args.get('after', type=int)
+    limit = args.get('limit', type=int) or config['LISTING_PAGE_SIZE']
+
+    if after is not None and after < 0:
+        after = None
+
+    limit = max(1, min(limit, config['LISTING_MAX_PAGE_SIZE']))
+
+    return after, limit
+
+
+def keyset_page(query, key_column, after=None, limit=50):
+
+    # only rows after the last key of the previous page are fetched, so the cost of a page
+    # does not depend on how far into the table it is (unlike OFFSET)
+    if after is not None:
+        query = query.filter(key_column > after)
+
+    # fetch one extra row to find out whether there is another page
+    rows = query.order_by(key_column).limit(limit + 1).all()
+
+    next_after = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_after = getattr(rows[-1], key_column.key)
+
+    return rows, next_after
+
+
+def iter_keyset(query, key_column, batch_size):
+
+    # walk the whole query one keyset page at a time so only one batch is held in memory
+    after = None
+    while True:
+        rows, after = keyset_page(query, key_column, after, batch_size)
+        yield from rows
+        if after is None:
+            return
+
+
+def stream_listing(template_name, rows_name, query, key_column, **context):
+
+    # render the template lazily, pulling table rows from the database as the response is written.
+    # the first row is read up front, so a listing with no rows gets an empty list and the
+    # template's {% if rows %} still shows its "no records" message (a generator is always true)
+    rows = iter_keyset(query, key_column, current_app.config['LISTING_STREAM_BATCH_SIZE'])
+    first = next(rows, None)
+    context[rows_name] = [] if first is None else itertools.chain([first], rows)
+    context.setdefault('next_after', None)
+
+    template = current_app.jinja_env.get_template(template_name)
+    current_app.update_template_context(context)
+
+    return Response(stream_with_context(template.generate(context)))
@@ -0,0 +1,54 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from app import app
+
+
+# password hashing with the cost set in the config (PASSWORD_HASH_METHOD, werkzeug's method string,
+# and PASSWORD_SALT_LENGTH). a hash made with other settings still checks, and is replaced by one with
+# the current settings the next time its user logs in, see needs_rehash. hashing is deliberately slow,
+# so with PASSWORD_HASH_WORKERS above zero it runs in a pool of that many processes: a login waits for
+# its own hash without holding the interpreter, and a burst of logins queues in the pool instead of
+# taking every request thread. the pool starts its processes from a forkserver: forking a threaded
+# server would copy whatever locks its other threads (and the database connections) held at that moment
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _run(function, *args):
+    global _pool
+    workers = app.config['PASSWORD_HASH_WORKERS']
+    if workers <= 0:
+        return function(*args)
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver'))
+    return _pool.submit(function, *args).result()
+
+
+def hash_password(password):
+    return _run(generate_password_hash, password, app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_SALT_LENGTH'])
+
+
+def check_password(password_hash, password):
+    return _run(check_password_hash, password_hash, password)
+
+
+@lru_cache
+def _method_prefix(method):
+
+    # werkzeug writes defaults into the stored method ("scrypt" is stored as "scrypt:32768:8:1"),
+    # so compare against what the configured method actually produces
+    return generate_password_hash('', method, 1).split('$')[0]
+
+
+def needs_rehash(password_hash):
+    method, _, rest = password_hash.partition('$')
+    salt = rest.partition('$')[0]
+    return method != _method_prefix(app.config['PASSWORD_HASH_METHOD']) or len(salt) != app.config['PASSWORD_SALT_LENGTH']
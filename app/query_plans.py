@@ -0,0 +1,152 @@
+import re
+from datetime import datetime
+
+from flask import g, has_app_context, has_request_context, request
+from sqlalchemy import delete, event, func, select, update
+from sqlalchemy.engine import Engine
+
+from app import app, db
+from app import search
+from app import checkout
+from app import notifications
+from app import archive
+from app.availability import AVAILABLE_DEVICES, AVAILABLE_BOOKS
+from app.models import User, Student, Device, Book, Author, Copy, Hold, Loan, BookLoan
+
+
+# checks that queries are answered from indexes rather than by reading whole tables. with
+# QUERY_PLAN_CHECK turned on, every select, update and delete a view sends to sqlite is run again
+# under EXPLAIN QUERY PLAN and each full table scan is logged as a warning. the check-query-plans
+# command does the same for the statements behind the busiest views and fails if any of them scans
+
+CHECKED_STATEMENTS = ('SELECT', 'UPDATE', 'DELETE')
+SCAN = re.compile(r'^SCAN (?P<table>.+?)(?: USING (?:COVERING )?INDEX (?P<index>\S+))?$')
+SUBQUERY = re.compile(r'^anon_\d+$')
+
+
+def explain(cursor, statement, parameters):
+    return [row[3] for row in cursor.connection.execute('EXPLAIN QUERY PLAN ' + statement, parameters)]
+
+
+def partial_indexes(cursor, table):
+    return {row[1] for row in cursor.connection.execute(f'PRAGMA index_list("{table}")') if row[4]}
+
+
+def full_scans(cursor, statement, plan):
+
+    # a scan is fine on a full-text table, through a partial index, of a subquery's rows (its own
+    # plan is checked in the same listing), or when an unfiltered statement with a LIMIT reads rows
+    # in index order without sorting them, like the first page of a listing
+    bounded = (re.search(r'\bLIMIT\b', statement, re.IGNORECASE) and not re.search(r'\bWHERE\b', statement, re.IGNORECASE)
+               and not any('TEMP B-TREE' in detail for detail in plan))
+    scans = []
+    for detail in plan:
+        match = SCAN.match(detail)
+        if not match or bounded or 'VIRTUAL TABLE' in detail or match['table'] == 'CONSTANT ROW' \
+                or match['table'].startswith('(') or SUBQUERY.match(match['table']):
+            continue
+        if match['index'] and match['index'] in partial_indexes(cursor, match['table']):
+            continue
+        scans.append(detail)
+    return scans
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def check_query_plan(conn, cursor, statement, parameters, context, executemany):
+    if executemany or conn.dialect.name != 'sqlite' or not statement.lstrip().upper().startswith(CHECKED_STATEMENTS):
+        return
+
+    if has_app_context() and 'query_plans' in g:
+        plan = explain(cursor, statement, parameters)
+        g.query_plans.append((statement, plan, full_scans(cursor, statement, plan)))
+    elif has_request_context() and app.config['QUERY_PLAN_CHECK']:
+        for detail in full_scans(cursor, statement, explain(cursor, statement, parameters)):
+            app.logger.warning('%s: %s in %s', request.endpoint, detail, ' '.join(statement.split()))
+
+
+def hot_queries():
+
+    # the statements the views, forms and checkout service send most often, with placeholder values
+    open_loan, open_book_loan = Loan.returndatetime.is_(None), BookLoan.returndatetime.is_(None)
+    return [
+        ('login', select(User).where(User.username == 'username')),
+        ('load user', select(User).where(User.user_id == 1)),
+        ('student by username', select(Student).where(Student.username == 'username')),
+        ('student by email', select(Student).where(Student.email == 'email')),
+        ('list students', select(Student).order_by(Student.student_id).limit(51)),
+        ('list students, next page', select(Student).where(Student.student_id > 1).order_by(Student.student_id).limit(51)),
+        ('outstanding fines', select(Student).where(Student.fines > 0).order_by(Student.student_id)),
+        ('search students', search.student_search_statement('smith').limit(26)),
+        ('device by name', select(Device).where(Device.device_name == 'name')),
+        ('available devices', AVAILABLE_DEVICES),
+        ('book by title', select(Book).where(Book.book_title == 'title')),
+        ('available books', AVAILABLE_BOOKS),
+        ('search books', search.book_search_statement('title', 'author', 'genre').limit(26)),
+        ('search books by author', search.book_search_statement(author='author').limit(26)),
+        ('books by author', select(Book).where(Book.author_id == 1).order_by(Book.book_id)),
+        ('author by name', select(Author).where(Author.name_key == 'first|last')),
+        ('open loans of a student', select(Loan).where((Loan.student_id == 1) & open_loan)),
+        ('open loans of a device', select(Loan).where((Loan.device_id == 1) & open_loan)),
+        ('open loan count', select(func.count()).select_from(Loan).where((Loan.student_id == 1) & open_loan)),
+        ('batch open loan counts', select(Loan.student_id, func.count())
+            .where(Loan.student_id.in_([1, 2]) & open_loan).group_by(Loan.student_id)),
+        ('batch open loans', select(Loan).where(Loan.device_id.in_([1, 2]) & open_loan).order_by(Loan.loan_id)),
+        ('loans of a student', select(Loan).where(Loan.student_id == 1)),
+        ('loans of a device', select(Loan).where(Loan.device_id == 1)),
+        ('all loans', select(Loan).order_by(Loan.loan_id).limit(51)),
+        ('active loans', select(Loan).where(open_loan).order_by(Loan.loan_id).limit(51)),
+        ('active loans, next page', select(Loan).where(open_loan & (Loan.loan_id > 1)).order_by(Loan.loan_id).limit(51)),
+        ('reserve a device', update(Device).where((Device.device_id == 1) & (Device.device_quantity > 0))
+            .values(device_quantity=Device.device_quantity - 1).returning(Device.loan_period)),
+        ('copy by barcode', select(Copy).where(Copy.barcode == 'barcode')),
+        ('take a copy', update(Copy).where(Copy.copy_id.in_(
+            select(Copy.copy_id).where((Copy.device_id == 1) & Copy.on_loan.is_(False)).order_by(Copy.copy_id).limit(1)))
+            .values(on_loan=True).returning(Copy.copy_id)),
+        ('open loan of a copy', select(Loan).where((Loan.copy_id == 1) & open_loan)),
+        ('hand a returned device to its hold queue', checkout.hand_over('device_id', 1, 1, datetime.now())),
+        ('hand a returned book to its hold queue', checkout.hand_over('book_id', 1, 1, datetime.now())),
+        ('ready hold of a student', select(Hold).where((Hold.student_id == 1) & (Hold.book_id == 1) & (Hold.status == 'ready'))),
+        ('place in a hold queue', select(func.count()).select_from(Hold)
+            .where((Hold.book_id == 1) & (Hold.status == 'waiting') & (Hold.hold_id <= 1))),
+        ('expired holds', select(Hold).where((Hold.status == 'ready') & (Hold.expires < datetime.now()))
+            .order_by(Hold.expires).limit(1000)),
+        ('ready holds', select(Hold, Copy.barcode).join(Copy, Copy.copy_id == Hold.copy_id)
+            .where(Hold.status == 'ready').order_by(Hold.expires)),
+        ('device loans due soon', notifications.due_loans('device_id', 'due soon', datetime.now(), datetime.now(),
+                                                          (datetime.now(), 0), 500)),
+        ('book loans due soon', notifications.due_loans('book_id', 'due soon', datetime.now(), datetime.now(),
+                                                        (datetime.now(), 0), 500)),
+        ('last overdue notification', notifications.last_overdue('book overdue')),
+        ('claim notifications to send', notifications.claim(500, datetime.now())),
+        ('device loans of a student with the archive', archive.loan_history('device_id', 'student_id', 1)),
+        ('book loans of a student with the archive', archive.loan_history('book_id', 'student_id', 1)),
+        ('device loan history with the archive', archive.loan_history('device_id', 'device_id', 1)),
+        ('loans to archive', archive.archivable('device_id', datetime.now(), 0, 1000)),
+        ('open book loans of a student', select(BookLoan).where((BookLoan.student_id == 1) & open_book_loan)),
+        ('open book loans of a book', select(BookLoan).where((BookLoan.book_id == 1) & open_book_loan)),
+        ('open book loan count', select(func.count()).select_from(BookLoan).where((BookLoan.student_id == 1) & open_book_loan)),
+        ('book loans of a student', select(BookLoan).where(BookLoan.student_id == 1)),
+        ('book loans of a book', select(BookLoan).where(BookLoan.book_id == 1)),
+        ('book loan records', select(BookLoan).order_by(BookLoan.loan_id).limit(51)),
+        ('reserve a book', update(Book).where((Book.book_id == 1) & (Book.quantity > 0))
+            .values(quantity=Book.quantity - 1).returning(Book.loan_period)),
+        ('remove book loan records', delete(BookLoan).where(BookLoan.student_id == 1)),
+    ]
+
+
+def check_hot_queries():
+
+    # returns (name, [(statement, plan, full scans)]) for every hot query. they run inside a
+    # transaction that is rolled back, so the updates and deletes in the list change nothing
+    results = []
+    with db.engine.connect() as connection:
+        transaction = connection.begin()
+        try:
+            for name, statement in hot_queries():
+                g.query_plans = []
+                connection.execute(statement).close()
+                results.append((name, g.pop('query_plans')))
+        finally:
+            g.pop('query_plans', None)
+            transaction.rollback()
+    return results
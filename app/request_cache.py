@@ -0,0 +1,85 @@
+from flask import g
+
+from app import app, db
+from app.models import Student, Device, Book, Loan, BookLoan, Copy, Hold
+
+
+# request-scoped cache of the rows the forms and views both need. a form validator that loads a
+# student, device or open loan leaves it here, and the view handling the same request reuses it
+# instead of querying again. the cache lives on flask.g, so it is thrown away after every request
+
+@app.before_request
+def reset_entity_cache():
+    g.entity_cache = {}
+
+
+def cached(key, loader):
+    cache = g.setdefault('entity_cache', {})
+    if key not in cache:
+        cache[key] = loader()
+    return cache[key]
+
+
+def forget(key):
+    g.get('entity_cache', {}).pop(key, None)
+
+
+def get_student(student_id):
+    return cached(('student', int(student_id)), lambda: db.session.get(Student, int(student_id)))
+
+
+def get_device(device_id):
+    return cached(('device', int(device_id)), lambda: db.session.get(Device, int(device_id)))
+
+
+def get_book(book_id):
+    return cached(('book', int(book_id)), lambda: db.session.get(Book, int(book_id)))
+
+
+def get_copy(barcode):
+    return cached(('copy', barcode), lambda: Copy.query.filter_by(barcode=barcode).first())
+
+
+def open_loan_of_copy(loan_model, copy_id):
+    return cached(('open loan of copy', loan_model.__tablename__, copy_id), lambda: loan_model.query.filter(
+        (loan_model.copy_id == copy_id) & (loan_model.returndatetime.is_(None))).first())
+
+
+def open_device_loans(device_id):
+
+    # all loans of this device that have not been returned yet
+    return cached(('open device loans', int(device_id)), lambda: Loan.query.filter(
+        (Loan.device_id == int(device_id)) & (Loan.returndatetime.is_(None))).all())
+
+
+def open_book_loans(book_id):
+    return cached(('open book loans', int(book_id)), lambda: BookLoan.query.filter(
+        (BookLoan.book_id == int(book_id)) & (BookLoan.returndatetime.is_(None))).all())
+
+
+def student_open_device_loan(student_id):
+    return cached(('student open device loan', int(student_id)), lambda: Loan.query.filter(
+        (Loan.student_id == int(student_id)) & (Loan.returndatetime.is_(None))).first())
+
+
+def student_open_book_loan_count(student_id):
+    return cached(('student open book loans', int(student_id)), lambda: BookLoan.query.filter(
+        (BookLoan.student_id == int(student_id)) & (BookLoan.returndatetime.is_(None))).count())
+
+
+def get_hold(hold_id):
+    return cached(('hold', int(hold_id)), lambda: db.session.get(Hold, int(hold_id)))
+
+
+def student_hold(student_id, key, item_id):
+
+    # the student's waiting or ready hold on a device or book, if they are queueing for it
+    return cached(('student hold', int(student_id), key, int(item_id)), lambda: Hold.query.filter(
+        (Hold.student_id == int(student_id)) & (getattr(Hold, key) == int(item_id))
+        & Hold.status.in_(['waiting', 'ready'])).first())
+
+
+def loan_for_student(loans, student_id):
+
+    # pick the loan belonging to the given student out of a device's or book's open loans
+    return next((loan for loan in loans if loan.student_id == int(student_id)), None)
@@ -0,0 +1,188 @@
+import json
+from datetime import timezone
+
+from flask import Response, request, url_for
+from sqlalchemy import select
+
+from app import db
+from app.models import Student, Device, Book, Author, Copy, Hold, Loan, BookLoan, FineTransaction, Notification
+from app.pagination import page_args
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# read-only json resources for the kiosks and the campus portal. each resource is a list of plain
+# columns (of one table, or of the join in source=); a client can ask for only some of them
+# (fields=), pages through the rows by their id (after= and limit=, as on the listing pages) and
+# filters on the resource's id columns and flags.
+# every response has an etag over its body, so a client polling with If-None-Match gets a 304 with
+# no body when nothing it asked for has changed. resources with a time that only moves forward
+# (the fine ledger) also send Last-Modified. bodies are serialised with orjson when it is installed
+
+RESOURCES = {
+    'students': dict(columns=[Student.student_id, Student.username, Student.firstname, Student.lastname,
+                              Student.email, Student.active, Student.fines],
+                     filters=dict(),
+                     flags=dict(active=Student.active.is_(True), owing=Student.fines > 0)),
+    'devices': dict(columns=[Device.device_id, Device.device_name, Device.device_quantity, Device.loan_period],
+                    filters=dict(),
+                    flags=dict(available=Device.device_quantity >= 1)),
+    'books': dict(columns=[Book.book_id, Book.book_title, Book.author_id, Author.author_firstname,
+                           Author.author_lastname, Book.genre, Book.number_of_pages, Book.quantity, Book.loan_period],
+                  source=Book.__table__.join(Author.__table__),
+                  filters=dict(author_id=Book.author_id),
+                  flags=dict(available=Book.quantity > 0)),
+    'authors': dict(columns=[Author.author_id, Author.author_firstname, Author.author_lastname],
+                    filters=dict(),
+                    flags=dict()),
+    'copies': dict(columns=[Copy.copy_id, Copy.barcode, Copy.device_id, Copy.book_id, Copy.on_loan],
+                   filters=dict(device_id=Copy.device_id, book_id=Copy.book_id),
+                   flags=dict(on_loan=Copy.on_loan.is_(True))),
+    'holds': dict(columns=[Hold.hold_id, Hold.student_id, Hold.device_id, Hold.book_id, Hold.placed, Hold.status,
+                           Hold.copy_id, Hold.expires],
+                  filters=dict(student_id=Hold.student_id, device_id=Hold.device_id, book_id=Hold.book_id),
+                  flags=dict(waiting=Hold.status == 'waiting', ready=Hold.status == 'ready')),
+    'loans': dict(columns=[Loan.loan_id, Loan.device_id, Loan.student_id, Loan.borrowdatetime, Loan.duedatetime,
+                           Loan.returndatetime, Loan.fine, Loan.copy_id],
+                  filters=dict(student_id=Loan.student_id, device_id=Loan.device_id, copy_id=Loan.copy_id),
+                  flags=dict(open=Loan.returndatetime.is_(None))),
+    'book-loans': dict(columns=[BookLoan.loan_id, BookLoan.book_id, BookLoan.student_id, BookLoan.borrowdatetime,
+                                BookLoan.duedatetime, BookLoan.returndatetime, BookLoan.fine_amount, BookLoan.copy_id],
+                       filters=dict(student_id=BookLoan.student_id, book_id=BookLoan.book_id, copy_id=BookLoan.copy_id),
+                       flags=dict(open=BookLoan.returndatetime.is_(None))),
+    'fines': dict(columns=[FineTransaction.transaction_id, FineTransaction.student_id, FineTransaction.amount,
+                           FineTransaction.reason, FineTransaction.loan_id, FineTransaction.book_loan_id,
+                           FineTransaction.created],
+                  filters=dict(student_id=FineTransaction.student_id),
+                  flags=dict(),
+                  modified=FineTransaction.created),
+    'notifications': dict(columns=[Notification.notification_id, Notification.idempotency_key, Notification.kind,
+                                   Notification.student_id, Notification.loan_id, Notification.book_loan_id,
+                                   Notification.due, Notification.status, Notification.attempts,
+                                   Notification.next_attempt, Notification.sent, Notification.last_error],
+                          filters=dict(student_id=Notification.student_id),
+                          flags=dict(pending=Notification.status == 'pending', sent=Notification.status == 'sent',
+                                     failed=Notification.status == 'failed')),
+}
+
+
+def dumps(payload):
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, separators=(',', ':'), default=lambda value: value.isoformat()).encode()
+
+
+def selected_columns(resource, args):
+
+    # returns the columns named in fields= (all of them when it is missing) and an error message,
+    # one of them None. the id column is always included, as the next page starts after it
+    columns = {column.key: column for column in resource['columns']}
+    if 'fields' not in args:
+        return resource['columns'], None
+
+    names = [name.strip() for name in args['fields'].split(',') if name.strip()]
+    if not names or any(name not in columns for name in names):
+        return None, f'fields must be a comma separated list of {", ".join(columns)}'
+    key = resource['columns'][0]
+    return [key] + [columns[name] for name in dict.fromkeys(names) if name != key.key], None
+
+
+def list_statement(name, args):
+
+    # returns the statement for the resource's rows, the columns shown and an error message. the
+    # statement also selects the resource's modified column, for Last-Modified, when it is not shown
+    resource = RESOURCES[name]
+    columns, error = selected_columns(resource, args)
+    if error:
+        return None, None, error
+    modified = resource.get('modified')
+    shown = {column.key for column in columns}
+    statement = select(*columns, *([modified] if modified is not None and modified.key not in shown else []))
+    if resource.get('source') is not None:
+        statement = statement.select_from(resource['source'])
+
+    for key, column in resource['filters'].items():
+        if key in args:
+            value = args.get(key, type=int)
+            if value is None:
+                return None, None, f'{key} must be an integer'
+            statement = statement.where(column == value)
+
+    for key, condition in resource['flags'].items():
+        if key in args:
+            if args[key] not in ('0', '1'):
+                return None, None, f'{key} must be 0 or 1'
+            statement = statement.where(condition if args[key] == '1' else ~condition)
+
+    return statement, columns, None
+
+
+def _last_modified(name, rows):
+
+    # the newest modified time among the rows, as an aware datetime (the app stores local times)
+    column = RESOURCES[name].get('modified')
+    times = [row._mapping[column.key] for row in rows] if column is not None else []
+    return max(times).astimezone(timezone.utc) if times else None
+
+
+def conditional(payload, last_modified=None):
+
+    # the etag is a hash of the body. werkzeug answers 304 with no body when it matches If-None-Match,
+    # or, for a client that only sends If-Modified-Since, when nothing is newer than that
+    response = Response(dumps(payload), mimetype='application/json')
+    response.add_etag()
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
+
+def page_statement(name, statement, after, limit):
+
+    # one extra row is fetched to find out whether there is another page
+    key = RESOURCES[name]['columns'][0]
+    if after is not None:
+        statement = statement.where(key > after)
+    return statement.order_by(key).limit(limit + 1)
+
+
+def page_payload(name, rows, columns, limit):
+
+    # returns the body of a page of rows fetched with page_statement and its Last-Modified time
+    next_after = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_after = rows[-1]._mapping[RESOURCES[name]['columns'][0].key]
+
+    names = [column.key for column in columns]
+    return dict(data=[dict(zip(names, row)) for row in rows], next_after=next_after), _last_modified(name, rows)
+
+
+def item_payload(name, row, columns):
+    return dict(data=dict(zip([column.key for column in columns], row))), _last_modified(name, [row])
+
+
+def item_statement(name, statement, item_id):
+    return statement.where(RESOURCES[name]['columns'][0] == item_id)
+
+
+def resource_page(name, statement, columns):
+    after, limit = page_args()
+    rows = db.session.execute(page_statement(name, statement, after, limit)).all()
+    payload, last_modified = page_payload(name, rows, columns, limit)
+
+    response = conditional(payload, last_modified)
+    if payload['next_after'] is not None:
+        url = url_for(request.endpoint, **request.view_args, **(request.args.to_dict() | {'after': payload['next_after']}))
+        response.headers['Link'] = f'<{url}>; rel="next"'
+    return response
+
+
+def resource_item(name, item_id, statement, columns):
+    row = db.session.execute(item_statement(name, statement, item_id)).first()
+    if row is None:
+        return None
+    return conditional(*item_payload(name, row, columns))
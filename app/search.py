@@ -0,0 +1,215 @@
+import re
+
+from sqlalchemy import event, func, or_, select, table, column, text, union_all
+from sqlalchemy.orm import contains_eager
+
+from app.models import Author, Book, Student
+
+
+# full-text indexes for books, authors and students. they are external content fts5 tables, so the text
+# itself stays in the books and students tables and the index is kept in sync by triggers
+BOOKS_FTS_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(
+        book_title, genre,
+        content='books', content_rowid='book_id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3')""",
+    # while a row exists in books_fts_paused the insert trigger is skipped. the bulk importer uses it
+    # inside its own transaction to index a whole batch with one INSERT ... SELECT instead of row by row
+    """CREATE TABLE IF NOT EXISTS books_fts_paused (paused INTEGER)""",
+    """CREATE TRIGGER IF NOT EXISTS books_fts_insert AFTER INSERT ON books
+        WHEN NOT EXISTS (SELECT 1 FROM books_fts_paused) BEGIN
+        INSERT INTO books_fts(rowid, book_title, genre) VALUES (new.book_id, new.book_title, new.genre);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS books_fts_delete AFTER DELETE ON books BEGIN
+        INSERT INTO books_fts(books_fts, rowid, book_title, genre) VALUES ('delete', old.book_id, old.book_title, old.genre);
+    END""",
+    # only fires when an indexed column changes, so quantity updates on borrow/return do not touch the index
+    """CREATE TRIGGER IF NOT EXISTS books_fts_update AFTER UPDATE OF book_title, genre ON books BEGIN
+        INSERT INTO books_fts(books_fts, rowid, book_title, genre) VALUES ('delete', old.book_id, old.book_title, old.genre);
+        INSERT INTO books_fts(rowid, book_title, genre) VALUES (new.book_id, new.book_title, new.genre);
+    END""",
+]
+
+# authors have their own index. an author search matches the few author rows and reaches their
+# books through the books.author_id index, rather than every book carrying a copy of the names
+AUTHORS_FTS_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS authors_fts USING fts5(
+        author_firstname, author_lastname,
+        content='authors', content_rowid='author_id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3')""",
+    """CREATE TRIGGER IF NOT EXISTS authors_fts_insert AFTER INSERT ON authors BEGIN
+        INSERT INTO authors_fts(rowid, author_firstname, author_lastname)
+        VALUES (new.author_id, new.author_firstname, new.author_lastname);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS authors_fts_delete AFTER DELETE ON authors BEGIN
+        INSERT INTO authors_fts(authors_fts, rowid, author_firstname, author_lastname)
+        VALUES ('delete', old.author_id, old.author_firstname, old.author_lastname);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS authors_fts_update AFTER UPDATE OF author_firstname, author_lastname ON authors BEGIN
+        INSERT INTO authors_fts(authors_fts, rowid, author_firstname, author_lastname)
+        VALUES ('delete', old.author_id, old.author_firstname, old.author_lastname);
+        INSERT INTO authors_fts(rowid, author_firstname, author_lastname)
+        VALUES (new.author_id, new.author_firstname, new.author_lastname);
+    END""",
+]
+
+STUDENTS_FTS_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS students_fts USING fts5(
+        username, firstname, lastname,
+        content='students', content_rowid='student_id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3')""",
+    """CREATE TRIGGER IF NOT EXISTS students_fts_insert AFTER INSERT ON students BEGIN
+        INSERT INTO students_fts(rowid, username, firstname, lastname)
+        VALUES (new.student_id, new.username, new.firstname, new.lastname);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS students_fts_delete AFTER DELETE ON students BEGIN
+        INSERT INTO students_fts(students_fts, rowid, username, firstname, lastname)
+        VALUES ('delete', old.student_id, old.username, old.firstname, old.lastname);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS students_fts_update AFTER UPDATE OF username, firstname, lastname ON students BEGIN
+        INSERT INTO students_fts(students_fts, rowid, username, firstname, lastname)
+        VALUES ('delete', old.student_id, old.username, old.firstname, old.lastname);
+        INSERT INTO students_fts(rowid, username, firstname, lastname)
+        VALUES (new.student_id, new.username, new.firstname, new.lastname);
+    END""",
+]
+
+books_fts = table('books_fts', column('rowid'), column('rank'))
+authors_fts = table('authors_fts', column('rowid'), column('rank'))
+students_fts = table('students_fts', column('rowid'), column('rank'))
+
+
+def _run(connection, statements):
+    if connection.dialect.name == 'sqlite':
+        for statement in statements:
+            connection.exec_driver_sql(statement)
+
+
+def create_search_index(connection):
+    _run(connection, BOOKS_FTS_DDL + AUTHORS_FTS_DDL + STUDENTS_FTS_DDL)
+
+
+def drop_catalogue_index(connection):
+
+    # the book and author indexes with their triggers, for a migration that rebuilds those tables
+    _run(connection, [f'DROP TRIGGER IF EXISTS {table}_fts_{action}' for table in ('books', 'authors')
+                      for action in ('insert', 'delete', 'update')]
+                     + ['DROP TABLE IF EXISTS books_fts', 'DROP TABLE IF EXISTS authors_fts'])
+
+
+def rebuild_search_index(connection):
+
+    # repopulate the indexes from their content tables, used when an existing database is migrated
+    _run(connection, ["INSERT INTO books_fts(books_fts) VALUES ('rebuild')",
+                      "INSERT INTO authors_fts(authors_fts) VALUES ('rebuild')",
+                      "INSERT INTO students_fts(students_fts) VALUES ('rebuild')"])
+
+
+# the indexes are created and dropped along with the tables they cover, so db.create_all() and
+# db.drop_all() (used by the clear tables view) leave them in sync
+event.listen(Book.__table__, 'after_create', lambda target, connection, **kw: _run(connection, BOOKS_FTS_DDL))
+event.listen(Author.__table__, 'after_create', lambda target, connection, **kw: _run(connection, AUTHORS_FTS_DDL))
+event.listen(Student.__table__, 'after_create', lambda target, connection, **kw: _run(connection, STUDENTS_FTS_DDL))
+event.listen(Book.__table__, 'before_drop', lambda target, connection, **kw: _run(
+    connection, ['DROP TABLE IF EXISTS books_fts', 'DROP TABLE IF EXISTS books_fts_paused']))
+event.listen(Author.__table__, 'before_drop', lambda target, connection, **kw: _run(connection, ['DROP TABLE IF EXISTS authors_fts']))
+event.listen(Student.__table__, 'before_drop', lambda target, connection, **kw: _run(connection, ['DROP TABLE IF EXISTS students_fts']))
+
+
+def pause_book_index(connection):
+    _run(connection, ['INSERT INTO books_fts_paused (paused) VALUES (1)'])
+
+
+def resume_book_index(connection, after_book_id):
+
+    # index every book added since the index was paused, then turn the trigger back on
+    if connection.dialect.name == 'sqlite':
+        connection.exec_driver_sql(
+            """INSERT INTO books_fts(rowid, book_title, genre)
+               SELECT book_id, book_title, genre FROM books WHERE book_id > ?""",
+            (after_book_id,))
+        connection.exec_driver_sql('DELETE FROM books_fts_paused')
+
+
+def match_terms(search_text):
+
+    # turn free text into an fts5 expression where every word is a quoted prefix term,
+    # so punctuation in the search box can never be parsed as query syntax
+    return ' '.join(f'"{word}"*' for word in re.findall(r'\w+', search_text or ''))
+
+
+def book_search_statement(title=None, author=None, genre=None, dialect='sqlite'):
+
+    # each filled in field searches its own columns and a book matching any of them is returned,
+    # the same as the old search, but in a single ranked query. the author comes with each book
+    if dialect != 'sqlite':
+        filters = []
+        if title:
+            filters.append(Book.book_title.ilike(f'%{title}%'))
+        if author:
+            filters.append(Author.author_firstname.ilike(f'%{author}%') | Author.author_lastname.ilike(f'%{author}%'))
+        if genre:
+            filters.append(Book.genre.ilike(f'%{genre}%'))
+        if not filters:
+            return None
+        return (select(Book).join(Book.author).options(contains_eager(Book.author))
+                .where(or_(*filters)).order_by(Book.book_title, Book.book_id))
+
+    # title and genre are matched in books_fts, the author in authors_fts and joined to the author's
+    # books on books.author_id. a book found both ways is listed once, at its better rank
+    matches = []
+    clauses = []
+    if match_terms(title):
+        clauses.append(f'book_title : ({match_terms(title)})')
+    if match_terms(genre):
+        clauses.append(f'genre : ({match_terms(genre)})')
+    if clauses:
+        matches.append(select(books_fts.c.rowid.label('book_id'), books_fts.c.rank.label('rank'))
+                       .where(text('books_fts MATCH :book_query').bindparams(book_query=' OR '.join(clauses))))
+    if match_terms(author):
+        matches.append(select(Book.book_id, authors_fts.c.rank.label('rank'))
+                       .select_from(authors_fts).join(Book, Book.author_id == authors_fts.c.rowid)
+                       .where(text('authors_fts MATCH :author_query').bindparams(author_query=match_terms(author))))
+    if not matches:
+        return None
+
+    matched = matches[0].subquery()
+    if len(matches) > 1:
+        both = union_all(*matches).subquery()
+        matched = select(both.c.book_id, func.min(both.c.rank).label('rank')).group_by(both.c.book_id).subquery()
+
+    return (select(Book)
+            .join(matched, matched.c.book_id == Book.book_id)
+            .join(Book.author).options(contains_eager(Book.author))
+            .order_by(matched.c.rank, Book.book_id))
+
+
+def student_search_statement(search_text, dialect='sqlite'):
+    if dialect != 'sqlite':
+        pattern = f'%{search_text}%'
+        return (select(Student)
+                .where(Student.username.ilike(pattern) | Student.firstname.ilike(pattern) | Student.lastname.ilike(pattern))
+                .order_by(Student.student_id))
+
+    terms = match_terms(search_text)
+    if not terms:
+        return None
+
+    return (select(Student)
+            .join(students_fts, students_fts.c.rowid == Student.student_id)
+            .where(text('students_fts MATCH :query').bindparams(query=terms))
+            .order_by(students_fts.c.rank, Student.student_id))
+
+
+def run_search(session, statement, page=1, per_page=25):
+
+    # returns one page of results and the number of the next page (None on the last page)
+    if statement is None:
+        return [], None
+
+    page = max(page, 1)
+    rows = session.scalars(statement.limit(per_page + 1).offset((page - 1) * per_page)).all()
+
+    if len(rows) > per_page:
+        return rows[:per_page], page + 1
+    return rows, None
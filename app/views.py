@@ -1,31 +1,26 @@
+import os
+
 from flask import render_template, redirect, url_for, flash, request, current_app
 from app import app, db
-from datetime import datetime, timedelta
+from datetime import datetime
 from app.forms import (LoginForm, RegistrationForm, AddStudentForm, BorrowForm,
                        DeactivateStudentForm, AddDeviceForm, ReturnForm, PayFineForm,
                        SearchStudentForm, DeleteStudentForm, StudentLoanReportForm,
                        DeviceLoanReportForm, RemoveStudentLoansForm, ActivateStudent, AddBookForm,
-                       BorrowBookForm, BookReturnForm, BookSearchForm, RemoveBookForm, RemoveBookLoanForm)
-from app.models import Student, Loan, User, Device, Book, BookLoan, Author
+                       BorrowBookForm, BookReturnForm, BookSearchForm, RemoveBookForm, RemoveBookLoanForm,
+                       HoldForm, BookHoldForm, CancelHoldForm)
+from app.models import Student, Loan, User, Device, Book, BookLoan, Author, Copy, Hold
 from flask_login import current_user, login_user, logout_user, login_required
 from urllib.parse import urlsplit
-from werkzeug.security import generate_password_hash
-
-
-
-def calculate_fine(due_time, return_time, fine_per_second=0.50):
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import joinedload, selectinload
+from app.pagination import page_args, keyset_page, stream_listing
+from app import search, importer, checkout, passwords, inventory, holds, admin, archive
+from app.availability import availability, render_listing
+from app.fines import to_pence, format_pounds
+from app.request_cache import (get_student, get_device, get_book, get_copy, open_device_loans, open_book_loans,
+                               open_loan_of_copy, loan_for_student, get_hold)
 
-    # used seconds instead of days for testing purposes
-    # calculate how late the device/book has been returned
-    seconds_late = (return_time - due_time).seconds
-
-    # multiply the number of seconds late by the fine rate
-    fine_amount = fine_per_second * seconds_late
-
-    if fine_amount > 50:
-        fine_amount = 50
-
-    return str(fine_amount)
 
 
 @app.route('/')
@@ -38,8 +33,11 @@ def index():
 @app.route('/listStudents')
 @login_required
 def listStudents():
-    students = Student.query.all()
-    return render_template('listStudents.html', title='List Students', students=students)
+    if request.args.get('stream'):
+        return stream_listing('listStudents.html', 'students', Student.query, Student.student_id, title='List Students')
+
+    students, next_after = keyset_page(Student.query, Student.student_id, *page_args())
+    return render_template('listStudents.html', title='List Students', students=students, next_after=next_after)
 
 
 @app.route('/login', methods=['GET', 'POST'])
@@ -52,6 +50,9 @@ def login():
         if user is None or not user.check_password(form.password.data):
             flash('Invalid username or password', 'danger')
             return redirect(url_for('login'))
+        if passwords.needs_rehash(user.password_hash):
+            user.set_password(form.password.data)
+            db.session.commit()
         login_user(user, remember=form.remember_me.data)
         flash(f'Login for {form.username.data}', 'success')
         next_page = request.args.get('next')
@@ -70,8 +71,8 @@ def logout():
 def register():
     form = RegistrationForm()
     if form.validate_on_submit():
-        new_user = User(username=form.username.data, email=form.email.data,
-                        password_hash=generate_password_hash(form.password.data, salt_length=32))
+        new_user = User(username=form.username.data, email=form.email.data)
+        new_user.set_password(form.password.data)
         db.session.add(new_user)
 
         try:
@@ -79,7 +80,8 @@ def register():
             flash(f'Registration for {form.username.data} received', 'success')
             return redirect(url_for('index'))
 
-        except:
+        except SQLAlchemyError:
+            app.logger.exception('registering user %s failed', form.username.data)
             db.session.rollback()
             flash('error', 'danger')
             return redirect(url_for('index'))
@@ -100,7 +102,8 @@ def add_student():
             flash(f'New Student added: {form.username.data} received', 'success')
             return redirect(url_for('index'))
 
-        except:
+        except SQLAlchemyError:
+            app.logger.exception('adding student %s failed', form.username.data)
             db.session.rollback()
             if Student.query.filter_by(username=form.username.data).first():
                 form.username.errors.append('This username is already taken. Please choose another')
@@ -116,23 +119,21 @@ def borrow():
     if form.validate_on_submit():
 
         # find the device associated with the entered device ID
-        device = Device.query.filter_by(device_id=form.device_id.data).first()
+        device = get_device(form.device_id.data)
 
-        # decrement the quantity of the device being borrowed
+        # reserve one of the devices and create the loan in a single transaction
         if device:
-            device.device_quantity -= 1
-            new_loan = Loan(device_id=form.device_id.data,
-                            student_id=form.student_id.data,
-                            borrowdatetime=datetime.now(), duedatetime=datetime.now() + timedelta(seconds=device.loan_period))
-
-            db.session.add(new_loan)
+            loan_period = device.loan_period or checkout.DEFAULT_LOAN_PERIOD
 
             try:
-                db.session.commit()
-                flash(f'New Loan added. You must return this device within {device.loan_period} seconds to avoid a fine', 'success')
+                checkout.checkout_device(int(form.student_id.data), device.device_id, barcode=form.barcode.data or None)
+                flash(f'New Loan added. You must return this device within {loan_period} seconds to avoid a fine', 'success')
                 return redirect(url_for('index'))
-            except:
-                db.session.rollback()
+            except checkout.CheckoutError as e:
+                flash(str(e), 'danger')
+                return redirect(url_for('index'))
+            except SQLAlchemyError:
+                app.logger.exception('checking out device %s failed', device.device_id)
                 flash('unsuccessful', 'danger')
                 return redirect((url_for('index')))
 
@@ -151,22 +152,22 @@ def borrow():
 def deactivateStudent():
     form = DeactivateStudentForm()
     if form.validate_on_submit():
-        student = Student.query.get(form.student_id.data)
+        student = get_student(form.student_id.data)
         student.active = False
         db.session.add(student)
         try:
             db.session.commit()
             flash(f'student {student.student_id} deactivated', 'success')
             return redirect(url_for('index'))
-        except:
+        except SQLAlchemyError:
+            app.logger.exception('deactivating student %s failed', student.student_id)
             db.session.rollback()
     return render_template('deactivateStudent.html', title='Deactivate Student', form=form)
 
 @app.route('/see_available_devices', methods=['GET', 'POST'])
 @login_required
 def see_available_devices():
-    device_table = Device.query.filter(Device.device_quantity >= 1).all()
-    return render_template('see_available_devices.html', device_table=device_table)
+    return render_listing('devices', 'see_available_devices.html', 'device_table')
 
 
 @app.route('/add_device', methods=['GET', 'POST'])
@@ -179,32 +180,45 @@ def add_device():
         # see if there is already a device with the entered device name
         existing_device = Device.query.filter_by(device_name=form.device_name.data).first()
 
-        if existing_device:
+        barcodes = [form.barcode.data] if form.barcode.data else None
 
-            # if the device being added already exists increment quantity
-            existing_device.device_quantity += 1
+        if existing_device:
 
+            # if the device being added already exists add another copy, which increments its quantity
+            # unless a student is queueing for the device, who gets it set aside for them instead
             try:
+                barcode, = inventory.add_copies(db.session, 'device_id', existing_device.device_id, barcodes=barcodes)
+                held_for = holds.serve_queue(db.session, 'device_id', existing_device.device_id, 1)
                 db.session.commit()
+                availability.invalidate('devices')
                 flash('this device already exists in the devices table.'
-                    ' Its quantity has been incremented','success')
+                    f' Its quantity has been incremented (new copy {barcode})','success')
+                for student_id in held_for.values():
+                    flash(f'the new copy has been set aside for student {student_id}, who is next in the hold queue', 'info')
                 return redirect(url_for('index'))
-            except:
+            except SQLAlchemyError:
+                app.logger.exception('incrementing device %s failed', form.device_name.data)
                 db.session.rollback()
                 flash('there was an error adding this device', 'danger')
                 return redirect(url_for('index'))
 
-        # if the device does not already exist in the table set the loan_period to whatever is entered in the form
+        # if the device does not already exist in the table set the loan_period to whatever is entered in the form.
+        # its first copy sets the quantity to 1
         elif not existing_device:
-            device_to_be_added = Device(device_name=form.device_name.data, loan_period=form.loan_period.data)
+            device_to_be_added = Device(device_name=form.device_name.data, loan_period=form.loan_period.data,
+                                        device_quantity=0)
             db.session.add(device_to_be_added)
 
         try:
+            db.session.flush()
+            inventory.add_copies(db.session, 'device_id', device_to_be_added.device_id, barcodes=barcodes)
             db.session.commit()
+            availability.invalidate('devices')
             flash('device successfully added', 'success')
             return redirect(url_for('index'))
 
-        except:
+        except SQLAlchemyError:
+            app.logger.exception('adding device %s failed', form.device_name.data)
             db.session.rollback()
             flash('unsuccessful', 'danger')
             return redirect(url_for('index'))
@@ -218,56 +232,43 @@ def return_device():
     form = ReturnForm()
     if form.validate_on_submit():
 
-        # find the relevant loan record and device record
-        loan_record = Loan.query.filter(
-            (Loan.device_id==form.device_id.data)
-            &
-            (Loan.student_id==form.student_id.data)
-            &
-            (Loan.returndatetime).is_(None)).first()
-
-        device_record = Device.query.filter_by(device_id=form.device_id.data).first()
-
-        # set the returndatetime of the relevant loan record to the current time
-        if loan_record:
-            loan_record.returndatetime = datetime.now()
-
-        # increase the quantity of the relevant device by 1
-        if device_record:
-            device_record.device_quantity += 1
+        # find the relevant loan record and device record. with a barcode the loan is the one of that
+        # copy, otherwise the student's loan of this device
+        if form.barcode.data:
+            loan_record = open_loan_of_copy(Loan, get_copy(form.barcode.data).copy_id)
+        else:
+            loan_record = loan_for_student(open_device_loans(form.device_id.data), form.student_id.data)
 
-        # if the device is returned late, calculate a fine based on how late the device was returned
-        if loan_record.returndatetime > loan_record.duedatetime:
-            fine = calculate_fine(loan_record.duedatetime, loan_record.returndatetime)
+        device_record = get_device(form.device_id.data)
 
-            # find the relevant student to fine and update their fines attribute
-            student_to_fine = Student.query.filter_by(student_id=form.student_id.data).first()
-            student_to_fine.fines = str(float(student_to_fine.fines) + float(fine))
-            loan_record.fine = str(fine)
+        device_name = device_record.device_name
 
-            try:
-                db.session.commit()
-                flash(f'you have returned this device({device_record.device_name}) {(loan_record.returndatetime - loan_record.duedatetime).seconds} seconds late'
-                      f' and will be fined £{fine}', 'danger')
+        # close the loan, put the device back in stock and fine the student if it is late, all in one transaction
+        try:
+            fine, late_by, held_for = checkout.return_device(loan_record)
+        except checkout.CheckoutError as e:
+            flash(str(e), 'danger')
+            return redirect(url_for('index'))
+        except SQLAlchemyError:
+            app.logger.exception('returning device loan %s failed', loan_record.loan_id)
+            flash(f'the device could not be returned', 'danger')
+            return redirect(url_for('index'))
 
-                return redirect(url_for('index'))
-            except:
-                db.session.rollback()
-                flash('the student could not be fined', 'danger')
-                return redirect(url_for('index'))
+        # if the device is returned late, tell the student how late it was and how much they have been fined
+        if fine:
+            flash(f'you have returned this device({device_name}) {int(late_by.total_seconds())} seconds late'
+                  f' and will be fined £{format_pounds(fine)}', 'danger')
 
         # if the device is returned on time
         else:
-            try:
-                db.session.commit()
-                flash(f'you have successfully returned this device ({device_record.device_name})'
-                      f' on time and you will receive no fine', 'success')
+            flash(f'you have successfully returned this device ({device_name})'
+                  f' on time and you will receive no fine', 'success')
 
-                return redirect(url_for('index'))
-            except:
-                db.session.rollback()
-                flash(f'the device could not be returned')
-                return redirect(url_for('index'))
+        # the next student in the device's hold queue gets this copy
+        if held_for:
+            flash(f'this device has been set aside for student {held_for}, who is next in the hold queue', 'info')
+
+        return redirect(url_for('index'))
 
     return render_template('return_device.html', form=form)
 
@@ -277,7 +278,7 @@ def return_device():
 @login_required
 def show_outstanding_fines():
 
-    outstanding_fines = Student.query.filter(Student.fines != '0.0').all()
+    outstanding_fines = Student.query.filter(Student.fines > 0).order_by(Student.student_id).all()
 
     return render_template('show_outstanding_fines.html', outstanding_fines=outstanding_fines)
 
@@ -290,27 +291,29 @@ def pay_fine():
     if form.validate_on_submit():
 
         # find the student associated with the entered student ID
-        student = Student.query.filter_by(student_id=form.student_id.data).first()
+        student = get_student(form.student_id.data)
 
-        # find out how much this student owes
-        remaining_fine_to_be_payed = float(student.fines)
+        # find out how much this student owes (in pence)
+        remaining_fine_to_be_payed = student.fines
+        amount = to_pence(form.amount.data)
 
         # calculate how much they owe after paying (they don't have to pay their entire fine in one go)
-        fine_after_pay = remaining_fine_to_be_payed - float(form.amount.data)
+        fine_after_pay = remaining_fine_to_be_payed - amount
 
-        # update their fine in the table
-        student.fines = str(fine_after_pay)
+        # record the payment in the ledger and update their fine in the table
+        student.pay_fine(amount)
 
         try:
             db.session.commit()
-            flash(f'you have successfully payed £{form.amount.data} out of the £{remaining_fine_to_be_payed}'
-                  f' that you owe. You now owe £{fine_after_pay}', 'success')
+            flash(f'you have successfully payed £{format_pounds(amount)} out of the £{format_pounds(remaining_fine_to_be_payed)}'
+                  f' that you owe. You now owe £{format_pounds(fine_after_pay)}', 'success')
 
             return redirect(url_for('index'))
 
-        except Exception as e:
+        except SQLAlchemyError:
+            app.logger.exception('recording a payment from student %s failed', student.student_id)
             db.session.rollback()
-            flash(f'{e}')
+            flash('the payment could not be recorded', 'danger')
             return redirect(url_for('index'))
 
     return render_template('pay_fine.html', form=form)
@@ -325,14 +328,16 @@ def search_students():
         # Get the search query from the form
         search_query = form.query.data
 
-        # case-insensitive search for students whose username or name matches the search
-        search_results = Student.query.filter(
-                (Student.username.ilike(f'%{search_query}%')) |
-                (Student.firstname.ilike(f'%{search_query}%')) |
-                (Student.lastname.ilike(f'%{search_query}%'))
-            ).all()
+        # ranked, case-insensitive prefix search over username, firstname and lastname
+        # the open loans shown for each student are loaded for the whole page in one extra query
+        statement = search.student_search_statement(search_query, db.engine.dialect.name)
+        if statement is not None:
+            statement = statement.options(selectinload(Student.active_loans))
+        search_results, next_page = search.run_search(db.session, statement, request.form.get('page', 1, type=int),
+                                                      app.config['SEARCH_PAGE_SIZE'])
 
-        return render_template('search_students.html', form=form, search_results=search_results, search_query=search_query)
+        return render_template('search_students.html', form=form, search_results=search_results,
+                               search_query=search_query, next_page=next_page)
 
     # If form is not submitted or validation fails, return an empty list of results
     search_results = []
@@ -347,18 +352,21 @@ def delete_student():
 
     if form.validate_on_submit():
         student_id = form.student_id.data
-        student_to_delete = Student.query.filter_by(student_id=student_id).one_or_none()
-        if Loan.query.filter_by(student_id=student_id).first():
+        student_to_delete = get_student(student_id)
+        if archive.has_loans('device_id', 'student_id', student_id):
             flash('This Student could not be deleted because they have active loans.'
                   ' Please clear their loan records and try again', 'danger')
             return redirect(url_for('index'))
 
         if student_to_delete:
             try:
+                holds.remove_student_holds(db.session, [student_to_delete.student_id])
                 db.session.delete(student_to_delete)
                 db.session.commit()
+                availability.invalidate()
                 flash('Student successfully deleted', 'success')
-            except:
+            except SQLAlchemyError:
+                app.logger.exception('deleting student %s failed', student_to_delete.student_id)
                 db.session.rollback()
                 flash('student cannot be deleted', 'danger')
         else:
@@ -374,8 +382,9 @@ def student_loan_report():
     form = StudentLoanReportForm()
 
     if form.validate_on_submit():
-        student_loans = Loan.query.filter_by(student_id=form.student_id.data)
-        student_book_loans = BookLoan.query.filter_by(student_id=form.student_id.data)
+        # archived loans are included, read with the hot ones in one statement per loan table
+        student_loans = db.session.execute(archive.loan_history('device_id', 'student_id', form.student_id.data)).all()
+        student_book_loans = db.session.execute(archive.loan_history('book_id', 'student_id', form.student_id.data)).all()
         return render_template('student_loan_report.html', form=form,
                                student_loans=student_loans, student_book_loans=student_book_loans)
 
@@ -384,14 +393,13 @@ def student_loan_report():
 
 @app.route('/clear tables')
 def clear_tables():
-    db.drop_all()
-    db.create_all()
     try:
-        db.session.commit()
+        admin.clear_tables()
         flash('all tables have been cleared', 'success')
         return redirect(url_for('index'))
 
-    except:
+    except SQLAlchemyError:
+        app.logger.exception('clearing the tables failed')
         db.session.rollback()
         flash('error clearing tables', 'danger')
         return redirect(url_for('index'))
@@ -403,7 +411,7 @@ def device_loan_history():
     form = DeviceLoanReportForm()
 
     if form.validate_on_submit():
-        device_loans = Loan.query.filter_by(device_id=form.device_id.data).all()
+        device_loans = db.session.execute(archive.loan_history('device_id', 'device_id', form.device_id.data)).all()
 
         return render_template('device_loan_report.html', form=form, device_loans=device_loans)
 
@@ -413,9 +421,12 @@ def device_loan_history():
 @app.route('/all_loans')
 @login_required
 def all_loans():
-    loans = Loan.query.all()
+    if request.args.get('stream'):
+        return stream_listing('all_loans.html', 'loans', Loan.query, Loan.loan_id)
 
-    return render_template('all_loans.html', loans=loans)
+    loans, next_after = keyset_page(Loan.query, Loan.loan_id, *page_args())
+
+    return render_template('all_loans.html', loans=loans, next_after=next_after)
 
 
 @app.route('/remove_student_loan_records', methods=['GET', 'POST'])
@@ -425,18 +436,16 @@ def remove_student_loan_records():
 
     if form.validate_on_submit():
 
-        loans_to_be_deleted = Loan.query.filter_by(student_id=form.student_id.data).all()
-        BookLoan.query.filter_by(student_id=form.student_id.data).delete()
-
-        for loan in loans_to_be_deleted:
-            db.session.delete(loan)
-
+        # one delete per loan table, which leaves any loans still out
         try:
-            db.session.commit()
+            removed = admin.run_bulk(admin.remove_student_loan_records, [form.student_id.data])
             flash('Loan records successfully deleted', 'success')
+            if removed['still out']:
+                flash(f'{removed["still out"]} loan(s) still out were kept. Return them first to remove them', 'warning')
             return redirect(url_for('index'))
 
-        except:
+        except SQLAlchemyError:
+            app.logger.exception('removing the loan records of student %s failed', form.student_id.data)
             db.session.rollback()
             flash('there was an error', 'danger')
             return redirect(url_for('index'))
@@ -449,8 +458,7 @@ def activate_student():
     form = ActivateStudent()
 
     if form.validate_on_submit():
-        student_to_be_edited = Student.query.get(form.student_id.data)
-        print(student_to_be_edited)
+        student_to_be_edited = get_student(form.student_id.data)
         if student_to_be_edited:
             student_to_be_edited.active = True
 
@@ -459,7 +467,8 @@ def activate_student():
                 flash(f'successful activation of student {form.student_id.data}', 'success')
                 return redirect(url_for('index'))
 
-            except:
+            except SQLAlchemyError:
+                app.logger.exception('activating student %s failed', form.student_id.data)
                 db.session.rollback()
                 if Student.query.filter_by(student_id=form.student_id.data).first():
                     form.student_id.errors.append('this student doesnt exist')
@@ -476,9 +485,14 @@ def activate_student():
 @login_required
 def active_loans():
 
-    all_active_loans = Loan.query.filter(Loan.returndatetime.is_(None)).all()
+    query = Loan.query.filter(Loan.returndatetime.is_(None))
 
-    return render_template('active_loans.html', all_active_loans=all_active_loans)
+    if request.args.get('stream'):
+        return stream_listing('active_loans.html', 'all_active_loans', query, Loan.loan_id)
+
+    all_active_loans, next_after = keyset_page(query, Loan.loan_id, *page_args())
+
+    return render_template('active_loans.html', all_active_loans=all_active_loans, next_after=next_after)
 
 
 @app.route('/add_book', methods=['GET', 'POST'])
@@ -492,34 +506,46 @@ def add_book():
                 (Book.book_title == form.book_title.data)
         ).first()
 
+        barcodes = [form.barcode.data] if form.barcode.data else None
+
         if existing_book:
-            existing_book.quantity += 1
-            flash('This book is already in the database. Its quantity has been increased by 1', 'success')
-            db.session.commit()
-            return redirect(url_for('index'))
+
+            # another copy of a book already in the catalogue, set aside if a student is queueing for it
+            try:
+                inventory.add_copies(db.session, 'book_id', existing_book.book_id, barcodes=barcodes)
+                held_for = holds.serve_queue(db.session, 'book_id', existing_book.book_id, 1)
+                db.session.commit()
+                availability.invalidate('books')
+                flash('This book is already in the database. Its quantity has been increased by 1', 'success')
+                for student_id in held_for.values():
+                    flash(f'the new copy has been set aside for student {student_id}, who is next in the hold queue', 'info')
+                return redirect(url_for('index'))
+            except SQLAlchemyError:
+                app.logger.exception('adding a copy of book %s failed', form.book_title.data)
+                db.session.rollback()
+                flash('there was an error adding a copy of this book', 'danger')
+                return redirect(url_for('index'))
 
         else:
 
+            # the author is shared by all their books, and added the first time one of them is
             new_book = Book(
                 book_title=form.book_title.data,
-                author_firstname=form.author_firstname.data,
-                author_lastname=form.author_lastname.data,
+                author=Author.get_or_add(db.session, form.author_firstname.data, form.author_lastname.data),
                 number_of_pages=form.number_of_pages.data,
-                quantity=1
-            )
-
-            new_author = Author(
-                author_firstname=form.author_firstname.data,
-                author_lastname=form.author_lastname.data
+                quantity=0
             )
             db.session.add(new_book)
-            db.session.add(new_author)
 
         try:
+            db.session.flush()
+            inventory.add_copies(db.session, 'book_id', new_book.book_id, barcodes=barcodes)
             db.session.commit()
+            availability.invalidate('books')
             flash('Book successfully added', 'success')
             return redirect(url_for('index'))
-        except:
+        except SQLAlchemyError:
+            app.logger.exception('adding book %s failed', form.book_title.data)
             db.session.rollback()
             flash('There was an error', 'danger')
             return redirect(url_for('index'))
@@ -532,11 +558,7 @@ def add_book():
 @login_required
 def available_books():
 
-    all_available_books = Book.query.filter(
-        (Book.quantity > 0)
-    ).all()
-
-    return render_template('available_books.html', all_available_books=all_available_books)
+    return render_listing('books', 'available_books.html', 'all_available_books')
 
 @app.route('/borrow_book', methods=['GET', 'POST'])
 @login_required
@@ -545,23 +567,19 @@ def borrow_book():
     if form.validate_on_submit():
 
         # find the book associated with the entered device ID
-        book = Book.query.filter_by(book_id=form.book_id.data).first()
+        book = get_book(form.book_id.data)
 
-        # decrement the quantity of the book being borrowed
+        # reserve one of the copies and create the loan in a single transaction
         if book:
-            book.quantity -= 1
-            new_loan = BookLoan(book_id=form.book_id.data,
-                            student_id=form.student_id.data,
-                            borrowdatetime=datetime.now(), duedatetime=datetime.now() + timedelta(seconds=book.loan_period))
-
-            db.session.add(new_loan)
-
             try:
-                db.session.commit()
+                checkout.checkout_book(int(form.student_id.data), book.book_id, barcode=form.barcode.data or None)
                 flash(f'New Loan added', 'success')
                 return redirect(url_for('index'))
-            except:
-                db.session.rollback()
+            except checkout.CheckoutError as e:
+                flash(str(e), 'danger')
+                return redirect(url_for('index'))
+            except SQLAlchemyError:
+                app.logger.exception('checking out book %s failed', book.book_id)
                 flash('unsuccessful', 'danger')
                 return redirect((url_for('index')))
 
@@ -578,110 +596,124 @@ def borrow_book():
 @login_required
 def populate_books_db():
 
-    if len(Book.query.all()) > 5:
+    # only a handful of books may exist already, fetching the sixth id is enough to tell
+    if db.session.query(Book.book_id).offset(5).first():
         flash("Book table is already populated with data", "danger")
         return redirect(url_for('index'))
 
-    with open('app/data/books.txt', 'r') as file:
-        book_info = file.read().split('\n\n')
+    try:
+        books_added, _ = importer.import_books(os.path.join(app.root_path, 'data', 'books.txt'))
+        flash(f"Database successfully populated with book data ({books_added} books)", "success")
+    except Exception as e:
+        current_app.logger.exception('Error populating database')
+        flash(f"Error populating database: {e}", "danger")
 
-        for book in book_info:
-            lines = book.split('\n')
-            title = lines[0].split(': ')[1]
-            author_full_name = lines[1].split(': ')[1].strip()
-            author_names = author_full_name.split()
-            if len(author_names) == 2:
-                author_first_name, author_last_name = author_names
-            else:
-                author_first_name = author_full_name
-                author_last_name = ""
+    return redirect(url_for('index'))
 
-            genre = lines[2].split(': ')[1]
-            pages = int(lines[3].split(': ')[1])
 
-            new_book = Book(
-                book_title=title,
-                author_firstname=author_first_name,
-                author_lastname=author_last_name,
-                number_of_pages=pages,
-                genre=genre,
-                quantity=1
-            )
+@app.route('/return_book', methods=['GET', 'POST'])
+@login_required
+def return_book():
+    form = BookReturnForm()
+    if form.validate_on_submit():
 
-            existing_author = Author.query.filter_by(author_firstname=author_first_name, author_lastname=author_last_name).first()
-            if not existing_author:
-                new_author = Author(author_firstname=author_first_name, author_lastname=author_last_name)
-                db.session.add(new_author)
+        if form.barcode.data:
+            loan_record = open_loan_of_copy(BookLoan, get_copy(form.barcode.data).copy_id)
+        else:
+            loan_record = loan_for_student(open_book_loans(form.book_id.data), form.student_id.data)
 
-            db.session.add(new_book)
+        book_record = get_book(form.book_id.data)
+
+        book_title = book_record.book_title
 
+        # close the loan, put the copy back in stock and fine the student if it is late, all in one transaction
         try:
-            db.session.commit()
-            flash("Database successfully populated with book data", "success")
-        except Exception as e:
-            db.session.rollback()
-            print(f"Error populating database: {e}")
+            fine, late_by, held_for = checkout.return_book(loan_record)
+        except checkout.CheckoutError as e:
+            flash(str(e), 'danger')
+            return redirect(url_for('index'))
+        except SQLAlchemyError:
+            app.logger.exception('returning book loan %s failed', loan_record.loan_id)
+            flash(f'the book could not be returned', 'danger')
+            return redirect(url_for('index'))
 
-    return redirect(url_for('index'))
+        if fine:
+            flash(f'you have returned this book({book_title}) {int(late_by.total_seconds())} seconds late'
+                  f' and will be fined £{format_pounds(fine)}', 'danger')
 
+        else:
+            flash(f'you have successfully returned {book_title}'
+                  f' on time and you will receive no fine', 'success')
 
-@app.route('/return_book', methods=['GET', 'POST'])
-@login_required
-def return_book():
-    form = BookReturnForm()
-    if form.validate_on_submit():
+        if held_for:
+            flash(f'this copy of {book_title} has been set aside for student {held_for}, who is next in the hold queue', 'info')
 
-        loan_record = BookLoan.query.filter(
-            (BookLoan.book_id==form.book_id.data)
-            &
-            (BookLoan.student_id==form.student_id.data)
-            &
-            (BookLoan.returndatetime).is_(None)).first()
+        return redirect(url_for('index'))
 
-        book_record = Book.query.filter_by(book_id=form.book_id.data).first()
+    return render_template('return_book.html', form=form)
 
-        # set the returndatetime of the relevant loan record to the current time
-        if loan_record:
-            loan_record.returndatetime = datetime.now()
 
-        # increase the quantity of the relevant device by 1
-        if book_record:
-            book_record.quantity += 1
+def _place_hold(form, key, item_name):
 
-        # if the device is returned late, calculate a fine based on how late the device was returned
-        if loan_record.returndatetime > loan_record.duedatetime:
-            fine = calculate_fine(loan_record.duedatetime, loan_record.returndatetime)
+    # join the item's queue and say how far along it the student is
+    try:
+        hold = holds.place_hold(form.student_id.data, key, getattr(form, key).data)
+        flash(f'hold {hold.hold_id} placed. The student is number {holds.queue_position(hold)} in the queue for this {item_name}'
+              f' and will have {app.config["HOLD_PICKUP_PERIOD"]} seconds to collect it once one is set aside', 'success')
+    except holds.HoldError as e:
+        flash(str(e), 'danger')
+    except SQLAlchemyError:
+        app.logger.exception('placing a hold on %s %s failed', item_name, getattr(form, key).data)
+        flash('the hold could not be placed', 'danger')
+    return redirect(url_for('index'))
 
-            # find the relevant student to fine and update their fines attribute
-            student_to_fine = Student.query.filter_by(student_id=form.student_id.data).first()
-            student_to_fine.fines = str(float(student_to_fine.fines) + float(fine))
-            loan_record.fine_amount = str(fine)
 
-            try:
-                db.session.commit()
-                flash(f'you have returned this book({book_record.book_title}) {(loan_record.returndatetime - loan_record.duedatetime).seconds} seconds late'
-                      f' and will be fined £{fine}', 'danger')
+@app.route('/hold_device', methods=['GET', 'POST'])
+@login_required
+def hold_device():
+    form = HoldForm()
+    if form.validate_on_submit():
+        return _place_hold(form, 'device_id', 'device')
+    return render_template('hold_device.html', title='Place Hold', form=form)
 
-                return redirect(url_for('index'))
-            except:
-                db.session.rollback()
-                flash('the student could not be fined', 'danger')
-                return redirect(url_for('index'))
 
+@app.route('/hold_book', methods=['GET', 'POST'])
+@login_required
+def hold_book():
+    form = BookHoldForm()
+    if form.validate_on_submit():
+        return _place_hold(form, 'book_id', 'book')
+    return render_template('hold_book.html', title='Place Hold', form=form)
 
-        else:
-            try:
-                db.session.commit()
-                flash(f'you have successfully returned {book_record.book_title}'
-                      f' on time and you will receive no fine', 'success')
 
-                return redirect(url_for('index'))
-            except:
-                db.session.rollback()
-                flash(f'the book could not be returned')
-                return redirect(url_for('index'))
+@app.route('/cancel_hold', methods=['GET', 'POST'])
+@login_required
+def cancel_hold():
+    form = CancelHoldForm()
+    if form.validate_on_submit():
 
-    return render_template('return_book.html', form=form)
+        # a copy set aside for the hold goes to the next student in the queue
+        try:
+            holds.cancel_hold(get_hold(form.hold_id.data))
+            flash(f'hold {form.hold_id.data} cancelled', 'success')
+        except holds.HoldError as e:
+            flash(str(e), 'danger')
+        except SQLAlchemyError:
+            app.logger.exception('cancelling hold %s failed', form.hold_id.data)
+            flash('the hold could not be cancelled', 'danger')
+        return redirect(url_for('index'))
+    return render_template('cancel_hold.html', title='Cancel Hold', form=form)
+
+
+@app.route('/ready_holds')
+@login_required
+def ready_holds():
+
+    # the hold shelf: every copy set aside and waiting to be collected, the soonest to expire first
+    ready = db.session.execute(
+        db.select(Hold, Copy.barcode).join(Copy, Copy.copy_id == Hold.copy_id)
+        .where(Hold.status == 'ready').order_by(Hold.expires)).all()
+    return render_template('ready_holds.html', title='Holds Ready for Collection', ready=ready)
 
 
 @app.route('/search_books', methods=['GET', 'POST'])
@@ -689,25 +721,17 @@ def return_book():
 def search_books():
     form = BookSearchForm()
     books = []
+    next_page = None
 
     if form.validate_on_submit():
 
-        title = form.title.data
-        author = form.author.data
-        genre = form.genre.data
-
-        if title:
-            books += Book.query.filter(Book.book_title.ilike(f'%{title}%')).all()
-        if author:
-            books += Book.query.filter(
-                (Book.author_firstname.ilike(f'%{author}%')) | (Book.author_lastname.ilike(f'%{author}%'))
-            ).all()
-        if genre:
-            books += Book.query.filter(Book.genre.ilike(f'%{genre}%')).all()
-
-        books = list(set(books))
+        # one ranked full-text query covers the title, author and genre fields
+        statement = search.book_search_statement(form.title.data, form.author.data, form.genre.data,
+                                                 db.engine.dialect.name)
+        books, next_page = search.run_search(db.session, statement, request.form.get('page', 1, type=int),
+                                             app.config['SEARCH_PAGE_SIZE'])
 
-    return render_template('search_books.html', form=form, books=books)
+    return render_template('search_books.html', form=form, books=books, next_page=next_page)
 
 
 @app.route('/remove_book', methods=['GET', 'POST'])
@@ -715,20 +739,24 @@ def search_books():
 def remove_book():
     form = RemoveBookForm()
     if form.validate_on_submit():
-        book_to_delete = Book.query.filter_by(book_id=form.book_id.data).first()
+        book_to_delete = get_book(form.book_id.data)
 
-        if BookLoan.query.filter_by(book_id=form.book_id.data).first():
+        if archive.has_loans('book_id', 'book_id', form.book_id.data):
             flash('this book cannot be deleted from the database until all of its loan records are removed', 'danger')
             return redirect(url_for('index'))
 
         else:
+            Hold.query.filter_by(book_id=book_to_delete.book_id).delete()
+            Copy.query.filter_by(book_id=book_to_delete.book_id).delete()
             db.session.delete(book_to_delete)
 
             try:
                 db.session.commit()
+                availability.invalidate('books')
                 flash('book successfully deleted', 'success')
                 return redirect(url_for('index'))
-            except:
+            except SQLAlchemyError:
+                app.logger.exception('deleting book %s failed', form.book_id.data)
                 db.session.rollback()
                 flash('there was an error deleting the specified book', 'danger')
                 return redirect(url_for('index'))
@@ -741,20 +769,18 @@ def remove_book_loan_records():
     form = RemoveBookLoanForm()
 
     if form.validate_on_submit():
-        loans_to_remove = BookLoan.query.filter_by(book_id=form.book_id.data).all()
-
-        for loan in loans_to_remove:
-            db.session.delete(loan)
-
         try:
-            db.session.commit()
+            removed = admin.run_bulk(admin.remove_book_loan_records, [form.book_id.data])
             flash('book records successfully deleted', 'success')
+            if removed['still out']:
+                flash(f'{removed["still out"]} loan(s) still out were kept. Return them first to remove them', 'warning')
             return redirect(url_for('index'))
 
-        except:
-             db.session.rollback()
-             flash('there was an error removing the book loan records', 'danger')
-             return redirect(url_for('index'))
+        except SQLAlchemyError:
+            app.logger.exception('removing the loan records of book %s failed', form.book_id.data)
+            db.session.rollback()
+            flash('there was an error removing the book loan records', 'danger')
+            return redirect(url_for('index'))
 
     return render_template('remove_book_loan_record.html', form=form)
 
@@ -763,9 +789,15 @@ def remove_book_loan_records():
 @app.route('/book_loan_records')
 @login_required
 def all_book_loan_records():
-    all_loans = BookLoan.query.all()
+    # the student's name is shown on every row, so students are joined into the same query
+    query = BookLoan.query.options(joinedload(BookLoan.student))
+
+    if request.args.get('stream'):
+        return stream_listing('book_loan_records.html', 'all_loans', query, BookLoan.loan_id)
+
+    all_loans, next_after = keyset_page(query, BookLoan.loan_id, *page_args())
 
-    return render_template("book_loan_records.html", all_loans=all_loans)
+    return render_template("book_loan_records.html", all_loans=all_loans, next_after=next_after)
 
 @app.route('/fine_information')
 def fine_information():
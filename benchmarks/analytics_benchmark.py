@@ -0,0 +1,72 @@
+"""Time the loan analytics report over a large synthetic loan history.
+
+    python benchmarks/analytics_benchmark.py --loans 10000000
+
+A throwaway SQLite file is filled with device and book loans spread over two
+years, then the report is run once and the time and peak memory are printed.
+"""
+import argparse
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sqlalchemy import create_engine, insert
+
+from app import app, db
+from app.analytics import loan_analytics
+from app.models import Loan, BookLoan
+
+
+def populate(engine, count, students, seed=1, batch=100000):
+    rng = random.Random(seed)
+    start = datetime.now() - timedelta(days=730)
+    db.metadata.create_all(engine)
+
+    with engine.begin() as connection:
+        for model, item_column, items in ((Loan, 'device_id', 50), (BookLoan, 'book_id', 100000)):
+            for first in range(0, count // 2, batch):
+                rows = []
+                for _ in range(first, min(first + batch, count // 2)):
+                    borrowed = start + timedelta(seconds=rng.randint(0, 730 * 86400), microseconds=rng.randint(0, 999999))
+                    due = borrowed + timedelta(seconds=30)
+                    returned = borrowed + timedelta(seconds=rng.randint(5, 120)) if rng.random() > 0.02 else None
+                    rows.append({item_column: rng.randint(1, items), 'student_id': rng.randint(1, students),
+                                 'borrowdatetime': borrowed, 'duedatetime': due, 'returndatetime': returned})
+                connection.execute(insert(model), rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--loans', type=int, default=10000000)
+    parser.add_argument('--students', type=int, default=20000)
+    parser.add_argument('--chunk-size', type=int, default=100000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine('sqlite:///' + os.path.join(directory, 'analytics.sqlite'))
+
+        start = time.perf_counter()
+        populate(engine, args.loans, args.students)
+        print(f'populated {args.loans} loans in {time.perf_counter() - start:.1f}s')
+
+        memory_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        with app.app_context(), engine.connect() as connection:
+            start = time.perf_counter()
+            report = loan_analytics(connection, chunk_size=args.chunk_size)
+            elapsed = time.perf_counter() - start
+        memory_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        print(f'report over {args.loans} loans in {elapsed:.2f}s ({args.loans / elapsed:,.0f} loans/s), '
+              f'{len(report["fines_by_month"])} months, {len(report["devices"])} devices, {len(report["students"])} students')
+        print(f'peak memory grew by {(memory_after - memory_before) / 1024:.0f} MiB while the report ran')
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+"""Requests/s and latency of the async read server against the Flask views.
+
+    python benchmarks/async_read_load.py --concurrency 200 --seconds 15
+
+A throwaway SQLite file is filled with students, devices, books and loans, then
+each server is started on it in its own process: "wsgi" is the Flask app on
+werkzeug's threaded server (a thread per request, LOGIN_DISABLED and no CSRF so
+the client needs no session), and "asgi" is app/asgi.py on uvicorn. Many client
+connections then poll a mix of availability, search and loan-status requests
+for a fixed time, the HTML views on wsgi and the JSON endpoints on asgi, and the
+requests per second, p50 and p99 latency and errors are printed per server.
+Needs starlette, uvicorn, aiosqlite and httpx.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import httpx
+from sqlalchemy import create_engine, insert
+
+from app import app, db
+from app.models import Author, Book, Device, Loan, Student, author_key
+
+
+SERVERS = ('wsgi', 'asgi')
+TOKEN = 'load-test'
+WORDS = ['river', 'night', 'garden', 'stone', 'winter', 'letters', 'house', 'song', 'glass', 'empire']
+
+
+def populate(path, students, books, devices, seed=1):
+    rng = random.Random(seed)
+    engine = create_engine('sqlite:///' + path)
+    db.metadata.create_all(engine)
+    now = datetime.now()
+    with engine.begin() as connection:
+        connection.execute(insert(Student), [dict(username=f's{i}', firstname=rng.choice(WORDS).title(), lastname='Student',
+                                                  email=f's{i}@example.com') for i in range(1, students + 1)])
+        connection.execute(insert(Device), [dict(device_name=f'device {i}', device_quantity=rng.randint(0, 5))
+                                            for i in range(1, devices + 1)])
+        connection.execute(insert(Author), [dict(author_firstname='A', author_lastname=word.title(), name_key=author_key('A', word))
+                                            for word in WORDS])
+        connection.execute(insert(Book), [dict(book_title=' '.join(rng.sample(WORDS, 3)), author_id=rng.randint(1, len(WORDS)),
+                                               number_of_pages=200, quantity=rng.randint(0, 3), genre='fiction')
+                                          for _ in range(books)])
+        connection.execute(insert(Loan), [dict(device_id=rng.randint(1, devices), student_id=i,
+                                               borrowdatetime=now, duedatetime=now + timedelta(days=1))
+                                          for i in range(1, students + 1, 3)])
+    engine.dispose()
+
+
+def requests_for(server, rng, students):
+
+    # (method, path, form data) of one poll: availability, a search or a student's loans
+    student_id, word = rng.randint(1, students), rng.choice(WORDS)
+    if server == 'wsgi':
+        return rng.choice([('GET', '/see_available_devices', None),
+                           ('GET', '/available_books', None),
+                           ('POST', '/search_books', dict(title=word)),
+                           ('POST', '/search_students', dict(query=f's{student_id}')),
+                           ('POST', '/student_loan_report', dict(student_id=student_id))])
+    return rng.choice([('GET', '/api/v1/devices?available=1', None),
+                       ('GET', '/api/v1/books?available=1', None),
+                       ('GET', f'/api/v1/search/books?title={word}', None),
+                       ('GET', f'/api/v1/search/students?q=s{student_id}', None),
+                       ('GET', f'/api/v1/loans?student_id={student_id}', None)])
+
+
+def serve(server, port):
+
+    # runs in the server process, which gets the database from DATABASE_URL
+    if server == 'wsgi':
+        from werkzeug.serving import make_server
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        app.config.update(LOGIN_DISABLED=True, WTF_CSRF_ENABLED=False)
+        make_server('127.0.0.1', port, app, threaded=True).serve_forever()
+    else:
+        import uvicorn
+        from app.asgi import create_app
+        uvicorn.run(create_app(), host='127.0.0.1', port=port, log_level='warning')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def wait_until_up(url, timeout=30):
+    deadline = time.perf_counter() + timeout
+    async with httpx.AsyncClient() as client:
+        while True:
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                if time.perf_counter() > deadline:
+                    raise
+                await asyncio.sleep(0.2)
+
+
+async def load(server, base_url, args):
+    rng = random.Random(args.seed)
+    latencies, errors = [], 0
+    limits = httpx.Limits(max_connections=args.concurrency)
+    headers = {'Authorization': f'Bearer {TOKEN}'}
+
+    async def poll(client, deadline):
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            method, path, data = requests_for(server, rng, args.students)
+            start = time.perf_counter()
+            try:
+                response = await client.request(method, path, data=data)
+                if response.status_code != 200:
+                    errors += 1
+                    continue
+            except httpx.HTTPError:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, headers=headers, timeout=60) as client:
+        deadline = time.perf_counter() + args.seconds
+        await asyncio.gather(*(poll(client, deadline) for _ in range(args.concurrency)))
+
+    latencies.sort()
+    percentile = lambda p: latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000 if latencies else 0
+    print(f'{server:6} {len(latencies) / args.seconds:10.0f} {percentile(0.5):10.1f} {percentile(0.99):10.1f} {errors:8}')
+
+
+def run(server, path, args):
+    port = free_port()
+    env = dict(os.environ, DATABASE_URL='sqlite:///' + path, ASYNC_API_TOKEN=TOKEN)
+    process = subprocess.Popen([sys.executable, __file__, '--serve', server, '--port', str(port)], env=env)
+    try:
+        base_url = f'http://127.0.0.1:{port}'
+        asyncio.run(wait_until_up(base_url + '/api/v1/devices'))
+        asyncio.run(load(server, base_url, args))
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--concurrency', type=int, default=200, help='client connections polling at once')
+    parser.add_argument('--seconds', type=float, default=15)
+    parser.add_argument('--students', type=int, default=5000)
+    parser.add_argument('--books', type=int, default=5000)
+    parser.add_argument('--devices', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--server', choices=SERVERS, action='append', help='run only this server (repeatable)')
+    parser.add_argument('--serve', choices=SERVERS, help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        return serve(args.serve, args.port)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'load.sqlite')
+        populate(path, args.students, args.books, args.devices)
+
+        print(f'{args.concurrency} connections, {args.seconds:.0f}s per server')
+        print(f'{"server":6} {"req/s":>10} {"p50 ms":>10} {"p99 ms":>10} {"errors":>8}')
+        for server in args.server or SERVERS:
+            run(server, path, args)
+
+
+if __name__ == '__main__':
+    main()
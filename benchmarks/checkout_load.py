@@ -0,0 +1,93 @@
+"""Concurrent checkout load test.
+
+    python benchmarks/checkout_load.py --workers 8 --students 4000 --stock 1000
+
+Several worker processes (like gunicorn workers) check devices out of the same
+small pool at once. The run fails if more loans were created than there was
+stock, or if the stored quantities and the loans disagree.
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sqlalchemy import create_engine, func, insert, select
+from sqlalchemy.orm import Session
+
+from app import app, db
+from app import inventory
+from app.models import Device, Loan, Student
+from app.checkout import CheckoutError, checkout_device
+
+
+def worker(database, student_ids, device_count):
+    engine = create_engine('sqlite:///' + database, connect_args={'timeout': 30})
+    checked_out = out_of_stock = 0
+
+    with app.app_context(), Session(engine) as session:
+        for student_id in student_ids:
+            try:
+                checkout_device(student_id, student_id % device_count + 1, session=session)
+                checked_out += 1
+            except CheckoutError:
+                out_of_stock += 1
+
+    engine.dispose()
+    return checked_out, out_of_stock
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--students', type=int, default=4000)
+    parser.add_argument('--devices', type=int, default=10)
+    parser.add_argument('--stock', type=int, default=1000, help='total copies across all devices')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        database = os.path.join(directory, 'checkout.sqlite')
+        engine = create_engine('sqlite:///' + database)
+        db.metadata.create_all(engine)
+        with engine.begin() as connection:
+            connection.execute(insert(Student), [dict(username=f's{i}', lastname='Student', email=f's{i}@example.com')
+                                                 for i in range(1, args.students + 1)])
+            connection.execute(insert(Device), [dict(device_name=f'device {i}', loan_period=3600,
+                                                     device_quantity=args.stock // args.devices)
+                                                for i in range(1, args.devices + 1)])
+            inventory.add_missing_copies(connection)
+
+        students = list(range(1, args.students + 1))
+        shares = [students[i::args.workers] for i in range(args.workers)]
+
+        start = time.perf_counter()
+        with multiprocessing.get_context('fork').Pool(args.workers) as pool:
+            results = pool.starmap(worker, [(database, share, args.devices) for share in shares])
+        elapsed = time.perf_counter() - start
+
+        checked_out = sum(result[0] for result in results)
+        attempts = args.students
+
+        with engine.connect() as connection:
+            loans = connection.scalar(select(func.count()).select_from(Loan))
+            remaining = connection.scalar(select(func.sum(Device.device_quantity)))
+            negative = connection.scalar(select(func.count()).select_from(Device).where(Device.device_quantity < 0))
+        engine.dispose()
+
+        stock = args.stock // args.devices * args.devices
+        print(f'{attempts} checkout attempts by {args.workers} workers in {elapsed:.2f}s '
+              f'({attempts / elapsed:.0f} attempts/s, {checked_out / elapsed:.0f} checkouts/s)')
+        print(f'stock {stock}, loans created {loans}, copies left {remaining}')
+
+        if loans > stock or negative or loans + remaining != stock or loans != checked_out:
+            sys.exit('FAILED: stock was oversold or counters disagree with the loans table')
+        if checked_out == 0 and stock > 0:
+            sys.exit('FAILED: nothing was checked out although there was stock')
+        print('OK: no stock oversold')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+"""Fill a SQLite database with a synthetic library of a given size.
+
+    python benchmarks/generate.py --scale medium --output /tmp/library.sqlite
+
+The same scale and seed always give the same rows. The scales run from "tiny"
+(about 1k rows per table) to "large" (10M device loans and 10M book loans), and
+any table size can be set on its own, e.g. --scale small --book-loans 2000000.
+Loans are spread over the last two years with the app's loan rules: a student
+has at most one device loan out, late returns carry the fine the return pages
+would have charged, and every fine is in the ledger and the student's balance.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sqlalchemy import bindparam, create_engine, func, insert, select, update
+
+from app import db
+from app import inventory
+from app import search
+from app.checkout import DEFAULT_LOAN_PERIOD, ITEM_KINDS
+from app.fines import calculate_fine
+from app.models import Author, Book, Device, FineTransaction, Student, author_key
+
+
+SCALES = {
+    'tiny': dict(students=1000, devices=20, authors=200, books=1000, loans=1000, book_loans=1000),
+    'small': dict(students=10000, devices=50, authors=2000, books=10000, loans=100000, book_loans=100000),
+    'medium': dict(students=50000, devices=100, authors=10000, books=100000, loans=1000000, book_loans=1000000),
+    'large': dict(students=200000, devices=200, authors=50000, books=1000000, loans=10000000, book_loans=10000000),
+}
+
+FIRST_NAMES = ['Ada', 'Alan', 'Grace', 'Edsger', 'Barbara', 'Donald', 'Margaret', 'Ken', 'Frances', 'Dennis',
+               'Radia', 'Niklaus', 'Sophie', 'Tim', 'Katherine', 'John', 'Shafi', 'Leslie', 'Mary', 'Guido']
+LAST_NAMES = ['Lovelace', 'Turing', 'Hopper', 'Dijkstra', 'Liskov', 'Knuth', 'Hamilton', 'Thompson', 'Allen',
+              'Ritchie', 'Perlman', 'Wirth', 'Wilson', 'Berners-Lee', 'Johnson', 'Backus', 'Goldwasser',
+              'Lamport', 'Keller', 'van Rossum']
+WORDS = ['river', 'night', 'garden', 'stone', 'winter', 'letters', 'house', 'song', 'glass', 'empire', 'shadow',
+         'harbour', 'silver', 'forest', 'machine', 'island', 'summer', 'crown', 'signal', 'mountain', 'paper',
+         'orchard', 'lantern', 'tide', 'engine', 'castle', 'thread', 'mirror', 'valley', 'storm']
+GENRES = ['fiction', 'history', 'science', 'poetry', 'biography', 'fantasy', 'mystery', 'travel', None]
+
+# share of loans still out, and of returned loans that came back late
+OPEN_SHARE = 0.02
+LATE_SHARE = 0.1
+
+
+def _insert_batches(engine, model, rows, batch, pause_book_index=False):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= batch:
+            _insert(engine, model, chunk, pause_book_index)
+            chunk = []
+    if chunk:
+        _insert(engine, model, chunk, pause_book_index)
+
+
+def _insert(engine, model, rows, pause_book_index):
+    with engine.begin() as connection:
+
+        # books are added to the search index with one statement per batch, as the importer does
+        if pause_book_index:
+            search.pause_book_index(connection)
+            last_book_id = connection.scalar(select(func.coalesce(func.max(Book.book_id), 0)))
+        connection.execute(insert(model), rows)
+        if pause_book_index:
+            search.resume_book_index(connection, last_book_id)
+
+
+def _loans(rng, count, item_column, kind, items, students, loan_periods, now, fines):
+
+    # loan rows in borrow order, numbered from 1 as they are in a new table. no student has more loans
+    # out than the kind's limit. fines collects (student, fine, loan id, return time) of late returns
+    start = now - timedelta(days=730)
+    step = timedelta(days=730) / max(count, 1)
+    out = {}
+    for number in range(count):
+        item_id = rng.randint(1, items)
+        student_id = rng.randint(1, students)
+        borrowed = start + step * number + timedelta(microseconds=rng.randint(0, 999999))
+        due = borrowed + timedelta(seconds=loan_periods[item_id])
+
+        returned, fine = None, 0
+        still_out = number >= count - count * OPEN_SHARE and rng.random() < 0.5
+        if still_out and out.get(student_id, 0) < kind['limit']:
+            out[student_id] = out.get(student_id, 0) + 1
+        else:
+            late = rng.random() < LATE_SHARE
+            returned = due + timedelta(seconds=rng.randint(1, 600)) if late else borrowed + (due - borrowed) * rng.random()
+            fine = calculate_fine(due, returned)
+
+        if fine:
+            fines.append((student_id, fine, number + 1, returned))
+        yield {item_column: item_id, 'student_id': student_id, 'borrowdatetime': borrowed, 'duedatetime': due,
+               'returndatetime': returned, kind['fine_column']: fine}
+
+
+def _fine_transactions(fines, kind):
+    for student_id, fine, loan_id, returned in fines:
+        yield {'student_id': student_id, 'amount': fine, 'reason': kind['reason'], 'created': returned,
+               kind['ledger_column']: loan_id}
+
+
+def generate(engine, students, devices, authors, books, loans, book_loans, seed=1, batch=50000, progress=None):
+
+    # fills an empty database created with db.metadata.create_all(engine)
+    rng = random.Random(seed)
+    now = datetime.now().replace(microsecond=0)
+    say = progress or (lambda message: None)
+
+    _insert_batches(engine, Student, ({'username': f'student{i}', 'firstname': rng.choice(FIRST_NAMES),
+                                       'lastname': rng.choice(LAST_NAMES), 'email': f'student{i}@example.com',
+                                       'active': rng.random() > 0.05} for i in range(1, students + 1)), batch)
+    say(f'{students} students')
+
+    device_periods = {i: rng.choice([30, 60, 3600, 86400]) for i in range(1, devices + 1)}
+    _insert_batches(engine, Device, ({'device_name': f'device {i}', 'device_quantity': rng.randint(0, 40),
+                                      'loan_period': device_periods[i]} for i in range(1, devices + 1)), batch)
+    say(f'{devices} devices')
+
+    names = [(rng.choice(FIRST_NAMES), f'{rng.choice(LAST_NAMES)} {i}') for i in range(1, authors + 1)]
+    _insert_batches(engine, Author, ({'author_firstname': first, 'author_lastname': last, 'name_key': author_key(first, last)}
+                                     for first, last in names), batch)
+    book_periods = {i: rng.choice([DEFAULT_LOAN_PERIOD, 604800, 1209600]) for i in range(1, books + 1)}
+    _insert_batches(engine, Book, (dict(author_id=rng.randint(1, authors),
+                                        book_title=' '.join(rng.sample(WORDS, rng.randint(2, 4))).capitalize(),
+                                        number_of_pages=rng.randint(40, 900), quantity=rng.randint(0, 5),
+                                        loan_period=book_periods[i], genre=rng.choice(GENRES))
+                                   for i in range(1, books + 1)), batch, pause_book_index=True)
+    say(f'{authors} authors and {books} books')
+
+    balances = {}
+    for item_column, items, periods, count in (('device_id', devices, device_periods, loans),
+                                               ('book_id', books, book_periods, book_loans)):
+        kind, fines = ITEM_KINDS[item_column], []
+        _insert_batches(engine, kind['loan_model'], _loans(rng, count, item_column, kind, items, students, periods, now, fines), batch)
+        _insert_batches(engine, FineTransaction, _fine_transactions(fines, kind), batch)
+        for student_id, fine, _, _ in fines:
+            balances[student_id] = balances.get(student_id, 0) + fine
+        say(f'{count} {kind["loan_model"].__tablename__}')
+
+    owing = [{'owing_student_id': student_id, 'balance': fine} for student_id, fine in balances.items() if fine]
+    students_table = Student.__table__
+    with engine.begin() as connection:
+        for first in range(0, len(owing), batch):
+            connection.execute(update(students_table).where(students_table.c.student_id == bindparam('owing_student_id'))
+                               .values(fines=bindparam('balance')), owing[first:first + batch])
+
+    # the copies: one per unit in stock and one per open loan, which is linked to it
+    with engine.begin() as connection:
+        inventory.add_missing_copies(connection)
+    say('copies')
+
+
+def scale_arguments(parser):
+    parser.add_argument('--scale', choices=SCALES, default='small')
+    for table in SCALES['tiny']:
+        parser.add_argument(f'--{table.replace("_", "-")}', type=int, help=f'number of {table.replace("_", " ")} (overrides the scale)')
+    parser.add_argument('--seed', type=int, default=1)
+
+
+def table_sizes(args):
+    return {table: getattr(args, table) or size for table, size in SCALES[args.scale].items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--output', required=True, help='SQLite file to create')
+    scale_arguments(parser)
+    args = parser.parse_args()
+
+    if os.path.exists(args.output):
+        parser.error(f'{args.output} already exists')
+
+    engine = create_engine('sqlite:///' + args.output)
+    db.metadata.create_all(engine)
+    start = time.perf_counter()
+    generate(engine, seed=args.seed, progress=lambda message: print(f'{time.perf_counter() - start:7.1f}s {message}'),
+             **table_sizes(args))
+    engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
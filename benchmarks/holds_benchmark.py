@@ -0,0 +1,99 @@
+"""Time returns and collections of a title with a long hold queue.
+
+    python benchmarks/holds_benchmark.py --queues 100,10000,100000
+
+For each queue length a throwaway SQLite file gets one popular book with all
+its copies out on loan and that many students queueing for it, plus holds
+spread over other books. Each round returns a copy, which sets it aside for the
+next student in line, and that student collects it. The median time of the
+return and of the collection is printed per queue length, and should not grow
+with the queue.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sqlalchemy import create_engine, insert, select
+from sqlalchemy.orm import Session
+
+from app import app, db
+from app import inventory
+from app.checkout import checkout_book, return_book
+from app.models import Author, Book, BookLoan, Hold, Student
+
+
+def populate(engine, queue, copies, other_books, other_holds, seed=1, batch=50000):
+
+    # book 1 has every copy out, lent to the first students, and the next queue students waiting
+    rng = random.Random(seed)
+    students = copies + queue + other_holds
+    now = datetime.now()
+    db.metadata.create_all(engine)
+    with engine.begin() as connection:
+        for start in range(1, students + 1, batch):
+            connection.execute(insert(Student), [dict(username=f's{i}', lastname='Student', email=f's{i}@example.com')
+                                                 for i in range(start, min(start + batch, students + 1))])
+        connection.execute(insert(Author), [dict(author_firstname='Ada', author_lastname='Lovelace', name_key='ada|lovelace')])
+        connection.execute(insert(Book), [dict(book_title=f'book {i}', author_id=1, number_of_pages=100, quantity=0)
+                                          for i in range(1, other_books + 2)])
+        connection.execute(insert(BookLoan), [dict(book_id=1, student_id=i, borrowdatetime=now,
+                                                   duedatetime=now + timedelta(days=14)) for i in range(1, copies + 1)])
+        inventory.add_missing_copies(connection, 'book_id')
+
+        holds = [dict(book_id=1, student_id=copies + i, placed=now) for i in range(1, queue + 1)]
+        holds += [dict(book_id=rng.randint(2, other_books + 1), student_id=copies + queue + i, placed=now)
+                  for i in range(1, other_holds + 1)]
+        for start in range(0, len(holds), batch):
+            connection.execute(insert(Hold), holds[start:start + batch])
+
+
+def rounds(session, count):
+
+    # returns the return and collection times in ms
+    returns, collections = [], []
+    for _ in range(count):
+        loan = session.scalars(select(BookLoan).where((BookLoan.book_id == 1) & BookLoan.returndatetime.is_(None))
+                               .order_by(BookLoan.loan_id).limit(1)).one()
+        start = time.perf_counter()
+        _, _, held_for = return_book(loan, session=session)
+        middle = time.perf_counter()
+        checkout_book(held_for, 1, session=session)
+        returns.append((middle - start) * 1000)
+        collections.append((time.perf_counter() - middle) * 1000)
+        session.expunge_all()
+    return returns, collections
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--queues', default='100,10000,100000', help='comma separated queue lengths to time')
+    parser.add_argument('--copies', type=int, default=10)
+    parser.add_argument('--other-books', type=int, default=10000)
+    parser.add_argument('--other-holds', type=int, default=100000, help='holds on other books')
+    parser.add_argument('--rounds', type=int, default=200)
+    args = parser.parse_args()
+
+    print(f'{"queue":>8} {"return ms":>10} {"collect ms":>11}')
+    for queue in [int(length) for length in args.queues.split(',')]:
+        if queue < args.rounds:
+            parser.error(f'every queue needs at least --rounds ({args.rounds}) students')
+
+        with tempfile.TemporaryDirectory() as directory:
+            engine = create_engine('sqlite:///' + os.path.join(directory, 'holds.sqlite'))
+            populate(engine, queue, args.copies, args.other_books, args.other_holds)
+            with app.app_context(), Session(engine) as session:
+                returns, collections = rounds(session, args.rounds)
+            engine.dispose()
+
+        print(f'{queue:8} {statistics.median(returns):10.2f} {statistics.median(collections):11.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""Time a notification sweep over a large number of due loans.
+
+    python benchmarks/notifications_benchmark.py --loans 100000 --workers 4
+
+A throwaway SQLite file gets --loans open book loans due back within the next
+day (and as many returned ones), then the outbox is filled by one scan and
+drained by the worker pool into a directory of .eml files. While both run a
+probe thread keeps writing a row at a time, as checkouts would, and the time
+each of its writes waited is recorded. The scan and drain times, the messages
+per second and the probe's median and worst wait are printed.
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+# the app binds its engine to DATABASE_URL when it is first imported, so the database file is chosen
+# before anything from the app is imported
+WORK_DIRECTORY = tempfile.TemporaryDirectory()
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(WORK_DIRECTORY.name, 'notifications.sqlite')
+
+from sqlalchemy import insert, update
+
+from app import app, db
+from app import notifications
+from app.models import Author, Book, BookLoan, Student
+
+
+def populate(engine, loans, students, books, batch=50000):
+    now = datetime.now()
+    db.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(insert(Student), [dict(username=f's{i}', firstname='Ada', lastname='Student',
+                                                  email=f's{i}@example.com') for i in range(1, students + 1)])
+        connection.execute(insert(Author), [dict(author_firstname='Ada', author_lastname='Lovelace', name_key='ada|lovelace')])
+        connection.execute(insert(Book), [dict(book_title=f'book {i}', author_id=1, number_of_pages=100, quantity=1)
+                                          for i in range(1, books + 1)])
+
+    # half the loans are returned, so the scan has to skip rows that are not out
+    rows = ({'book_id': i % books + 1, 'student_id': i % students + 1, 'borrowdatetime': now - timedelta(days=13),
+             'duedatetime': now + timedelta(seconds=60 + i * 80000 // (loans * 2)),
+             'returndatetime': now if i % 2 else None} for i in range(loans * 2))
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= batch:
+            with engine.begin() as connection:
+                connection.execute(insert(BookLoan), chunk)
+            chunk = []
+    if chunk:
+        with engine.begin() as connection:
+            connection.execute(insert(BookLoan), chunk)
+
+
+class Probe:
+
+    # one small write transaction every interval seconds, timing how long each one took
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.waits = []
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        with app.app_context():
+            while not self.stopped.wait(self.interval):
+                start = time.perf_counter()
+                db.session.execute(update(Student).where(Student.student_id == 1).values(active=True))
+                db.session.commit()
+                self.waits.append((time.perf_counter() - start) * 1000)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--loans', type=int, default=100000, help='open loans due within the day')
+    parser.add_argument('--students', type=int, default=20000)
+    parser.add_argument('--books', type=int, default=10000)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args()
+
+    app.config['NOTIFICATION_DIR'] = os.path.join(WORK_DIRECTORY.name, 'outbox')
+    with app.app_context():
+        populate(db.engine, args.loans, args.students, args.books)
+
+        with Probe() as probe:
+            start = time.perf_counter()
+            queued = notifications.scan_notifications(batch_size=args.batch_size)
+            scanned = time.perf_counter()
+            sent = notifications.send_notifications(args.workers, args.batch_size, notifications.get_sender('file'))
+            drained = time.perf_counter()
+
+    scan_seconds, drain_seconds = scanned - start, drained - scanned
+    print(f'scan   {sum(queued.values()):8} queued in {scan_seconds:6.2f}s ({sum(queued.values()) / scan_seconds:8.0f}/s)')
+    print(f'drain  {sent["sent"]:8} sent   in {drain_seconds:6.2f}s ({sent["sent"] / drain_seconds:8.0f}/s), '
+          f'{sent["retried"]} to retry, {sent["failed"]} failed')
+    print(f'probe  {len(probe.waits):8} writes, median {statistics.median(probe.waits):.1f} ms, '
+          f'worst {max(probe.waits):.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
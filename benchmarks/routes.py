@@ -0,0 +1,204 @@
+"""Time the main routes on a synthetic library and compare with a baseline.
+
+    python benchmarks/routes.py --scale small --output results.json
+    python benchmarks/routes.py --scale small --baseline results.json
+    python benchmarks/routes.py --output benchmarks/baseline.json
+
+A database of the given scale is generated (see generate.py, or pass --database
+to reuse one), then every case is requested through the Flask test client,
+--warmup times and then --repeat times, logged out checks and CSRF tokens
+aside. For each case the median, mean, p95 and fastest time and the number of
+SQL statements are printed and written as JSON to --output. The medians are
+compared with an earlier results file, --baseline (benchmarks/baseline.json,
+taken at the small scale with seed 1, unless --baseline '' turns it off), and
+the run exits with status 1 when a case got more than --threshold slower or ran
+more queries. A baseline taken at another scale or seed is not compared.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+# the app binds its engine to DATABASE_URL when it is first imported, so the database file is taken
+# from the command line before anything from the app is imported
+WORK_DIRECTORY = tempfile.TemporaryDirectory()
+_database_argument = argparse.ArgumentParser(add_help=False)
+_database_argument.add_argument('--database')
+DATABASE = _database_argument.parse_known_args()[0].database or os.path.join(WORK_DIRECTORY.name, 'routes.sqlite')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.abspath(DATABASE)
+
+from sqlalchemy import func, select
+
+from app import app, db
+from app import inventory
+from app.models import Student, Book, Loan, BookLoan
+from benchmarks.generate import WORDS, generate, scale_arguments, table_sizes
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+
+def fixtures():
+
+    # ids the cases use: the busiest student and device, a book in stock, and students with no
+    # loans out, who can each borrow and return once per run
+    busiest_student = db.session.scalar(select(Loan.student_id).group_by(Loan.student_id).order_by(func.count().desc()).limit(1))
+    busiest_device = db.session.scalar(select(Loan.device_id).group_by(Loan.device_id).order_by(func.count().desc()).limit(1))
+    free = (select(Student.student_id).where(Student.active.is_(True))
+            .where(~select(Loan.loan_id).where((Loan.student_id == Student.student_id) & Loan.returndatetime.is_(None)).exists())
+            .where(~select(BookLoan.loan_id).where((BookLoan.student_id == Student.student_id) & BookLoan.returndatetime.is_(None)).exists()))
+
+    # the borrowed device and book get a spare copy, which every borrow and return case takes and puts back
+    book = db.session.scalar(select(Book).order_by(Book.book_id).limit(1))
+    inventory.add_copies(db.session, 'device_id', busiest_device)
+    inventory.add_copies(db.session, 'book_id', book.book_id)
+    db.session.commit()
+    return dict(student_id=busiest_student, device_id=busiest_device, book_id=book.book_id,
+                username=db.session.scalar(select(Student.username).where(Student.student_id == busiest_student)),
+                free_students=db.session.scalars(free.order_by(Student.student_id)).all())
+
+
+def borrow_and_return(item):
+    def case(client, ids, rng):
+        student_id = ids['free_students'].pop()
+        form = {'student_id': student_id, f'{item}_id': ids[f'{item}_id']}
+        borrow = client.post('/borrow' if item == 'device' else '/borrow_book', data=form)
+        returned = client.post('/return_device' if item == 'device' else '/return_book', data=form)
+        return [borrow, returned]
+    return case
+
+
+def get(path):
+    return lambda client, ids, rng: [client.get(path.format(**ids))]
+
+
+def post(path, **form):
+    return lambda client, ids, rng: [client.post(path, data={key: value.format(word=rng.choice(WORDS), **ids)
+                                                             for key, value in form.items()})]
+
+
+CASES = {
+    'index': get('/index'),
+    'list students': get('/listStudents'),
+    'list students, later page': get('/listStudents?after={student_id}'),
+    'all loans': get('/all_loans'),
+    'active loans': get('/active_loans'),
+    'book loan records': get('/book_loan_records'),
+    'outstanding fines': get('/show_outstanding_fines'),
+    'available devices': get('/see_available_devices'),
+    'available books': get('/available_books'),
+    'search books': post('/search_books', title='{word}'),
+    'search students': post('/search_students', query='{username}'),
+    'student loan report': post('/student_loan_report', student_id='{student_id}'),
+    'device loan history': post('/device_loan_history', device_id='{device_id}'),
+    'api loans': get('/api/v1/loans?student_id={student_id}'),
+    'api books by author': get('/api/v1/books?author_id=1'),
+    'borrow and return device': borrow_and_return('device'),
+    'borrow and return book': borrow_and_return('book'),
+}
+
+
+def run_case(client, case, ids, rng, warmup, repeat):
+    timings, queries = [], 0
+    for run in range(warmup + repeat):
+        start = time.perf_counter()
+        responses = case(client, ids, rng)
+        elapsed = time.perf_counter() - start
+        for response in responses:
+            if response.status_code >= 400:
+                raise RuntimeError(f'{response.request.path} answered {response.status_code}')
+        if run >= warmup:
+            timings.append(elapsed * 1000)
+            queries = sum(int(response.headers.get('X-Query-Count', 0)) for response in responses)
+
+    timings.sort()
+    return dict(median_ms=round(statistics.median(timings), 3), mean_ms=round(statistics.fmean(timings), 3),
+                p95_ms=round(timings[min(int(len(timings) * 0.95), len(timings) - 1)], 3),
+                min_ms=round(timings[0], 3), queries=queries, runs=repeat)
+
+
+def compare(results, baseline, threshold):
+
+    # returns the names of the cases that regressed, after printing the comparison
+    regressions = []
+    print(f'\n{"case":28} {"median":>10} {"baseline":>10} {"change":>8}  queries')
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            print(f'{name:28} {result["median_ms"]:10.2f} {"-":>10} {"new":>8}  {result["queries"]}')
+            continue
+        change = result['median_ms'] / before['median_ms'] - 1 if before['median_ms'] else 0
+        slower = change > threshold or result['queries'] > before['queries']
+        print(f'{name:28} {result["median_ms"]:10.2f} {before["median_ms"]:10.2f} {change:+8.0%}  '
+              f'{before["queries"]} -> {result["queries"]}{"  REGRESSION" if slower else ""}')
+        if slower:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    scale_arguments(parser)
+    parser.add_argument('--database', help='use this SQLite file (it is changed) instead of generating one')
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--case', action='append', choices=CASES, help='run only this case (repeatable)')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', default=BASELINE, help='compare with this results file (empty for none)')
+    parser.add_argument('--threshold', type=float, default=0.2, help='slowdown of the median counted as a regression')
+    args = parser.parse_args()
+
+    sizes = table_sizes(args)
+    with app.app_context():
+        if not args.database:
+            db.create_all()
+            start = time.perf_counter()
+            generate(db.engine, seed=args.seed, **sizes)
+            print(f'generated the {args.scale} library in {time.perf_counter() - start:.1f}s')
+        ids = fixtures()
+
+    cases = {name: CASES[name] for name in args.case or CASES}
+    borrowing = sum(name.startswith('borrow') for name in cases) * (args.warmup + args.repeat)
+    if len(ids['free_students']) < borrowing:
+        parser.error(f'the borrow cases need {borrowing} students without loans, lower --repeat')
+
+    app.config.update(LOGIN_DISABLED=True, WTF_CSRF_ENABLED=False)
+    client = app.test_client()
+    rng = random.Random(args.seed)
+    results = {}
+    print(f'{"case":28} {"median ms":>10} {"p95 ms":>10} {"queries":>8}')
+    for name, case in cases.items():
+        results[name] = run_case(client, case, ids, rng, args.warmup, args.repeat)
+        print(f'{name:28} {results[name]["median_ms"]:10.2f} {results[name]["p95_ms"]:10.2f} {results[name]["queries"]:8}')
+
+    report = dict(generated=datetime.now().isoformat(timespec='seconds'),
+                  scale=args.scale if not args.database else None, sizes=sizes if not args.database else None,
+                  seed=args.seed, python=platform.python_version(), sqlite=sqlite3.sqlite_version,
+                  machine=platform.machine(), results=results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if (baseline['scale'], baseline['sizes'], baseline['seed']) != (report['scale'], report['sizes'], report['seed']):
+            print(f'\n{args.baseline} was taken at scale {baseline["scale"]} with seed {baseline["seed"]}, not compared')
+        else:
+            regressions = compare(results, baseline['results'], args.threshold)
+    if regressions:
+        print(f'\n{len(regressions)} cases regressed: {", ".join(regressions)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
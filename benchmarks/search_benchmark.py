@@ -0,0 +1,105 @@
+"""Compare the old LIKE based book search with the FTS5 index.
+
+    python benchmarks/search_benchmark.py --books 1000000
+
+A throwaway SQLite file is filled with synthetic books, then each search is run
+against both implementations and the mean time per search is printed.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sqlalchemy import create_engine, insert, or_, select
+from sqlalchemy.orm import Session
+
+from app import db
+from app.models import Author, Book, author_key
+from app.search import book_search_statement, run_search
+
+
+WORDS = ('river night garden silent empire winter glass shadow crown letter island machine '
+         'storm paper orchard harbour signal mirror forest ember lantern atlas echo meadow').split()
+NAMES = ('Austen Orwell Tolkien Atwood Morrison Ishiguro Achebe Rowling Woolf Dickens Bronte '
+         'Murakami Lee Fitzgerald Tolstoy Hardy Eliot Shelley Adichie Smith').split()
+GENRES = ['Classic', 'Fiction', 'Drama', 'Romance', 'Fantasy', 'Science fiction', 'Mystery', 'Poetry']
+
+SEARCHES = [
+    dict(title='winter'),
+    dict(title='glass crown'),
+    dict(author='ishig'),
+    dict(genre='fantasy'),
+    dict(title='storm', author='woolf', genre='poetry'),
+]
+
+
+def populate(engine, count, seed=1, batch=50000):
+    rng = random.Random(seed)
+    db.metadata.create_all(engine)
+    authors = [(first, last) for first in NAMES for last in NAMES]
+    with engine.begin() as connection:
+        connection.execute(insert(Author), [dict(author_firstname=first, author_lastname=last, name_key=author_key(first, last))
+                                            for first, last in authors])
+        for start in range(0, count, batch):
+            connection.execute(insert(Book), [
+                dict(book_title=' '.join(rng.sample(WORDS, 3)).title(), author_id=rng.randint(1, len(authors)),
+                     number_of_pages=rng.randint(80, 900), genre=rng.choice(GENRES), quantity=1)
+                for _ in range(start, min(start + batch, count))
+            ])
+
+
+def like_search(session, title=None, author=None, genre=None):
+
+    # the search view before the full-text index: one LIKE scan per field, merged in python
+    books = []
+    if title:
+        books += session.scalars(select(Book).where(Book.book_title.ilike(f'%{title}%'))).all()
+    if author:
+        books += session.scalars(select(Book).join(Book.author).where(
+            or_(Author.author_firstname.ilike(f'%{author}%'), Author.author_lastname.ilike(f'%{author}%')))).all()
+    if genre:
+        books += session.scalars(select(Book).where(Book.genre.ilike(f'%{genre}%'))).all()
+    return list(set(books))[:25]
+
+
+def fts_search(session, **fields):
+    return run_search(session, book_search_statement(**fields), 1, 25)[0]
+
+
+def timed(function, session, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for fields in SEARCHES:
+            function(session, **fields)
+            session.expunge_all()
+    return (time.perf_counter() - start) / (repeat * len(SEARCHES))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--books', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine('sqlite:///' + os.path.join(directory, 'search.sqlite'))
+
+        start = time.perf_counter()
+        populate(engine, args.books)
+        print(f'populated {args.books} books in {time.perf_counter() - start:.1f}s')
+
+        with Session(engine) as session:
+            like = timed(like_search, session, args.repeat)
+            fts = timed(fts_search, session, args.repeat)
+
+        print(f'LIKE search: {like * 1000:9.2f} ms per search')
+        print(f'FTS5 search: {fts * 1000:9.2f} ms per search ({like / fts:.0f}x faster)')
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
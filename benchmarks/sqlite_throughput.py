@@ -0,0 +1,117 @@
+"""Read/write throughput with the default and the tuned SQLite settings.
+
+    python benchmarks/sqlite_throughput.py --workers 8 --seconds 10
+
+Each profile gets a fresh SQLite file. Several worker processes then run a
+mix of page reads (available devices, a student's open loans, a page of the
+loans listing) and checkout + return pairs for a fixed time. "default" is a
+plain engine, as the app used before app/database.py, and "tuned" applies the
+pragmas from the app config (WAL, synchronous=NORMAL, busy_timeout, mmap and
+cache size). Reads/s, writes/s and failed operations are printed per profile.
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sqlalchemy import create_engine, insert, select
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+from app import app, db
+from app import database
+from app import inventory
+from app.availability import AVAILABLE_DEVICES
+from app.checkout import CheckoutError, checkout_device, return_device
+from app.models import Device, Loan, Student
+
+
+PROFILES = ('default', 'tuned')
+
+
+def make_engine(path, profile):
+    engine = create_engine('sqlite:///' + path)
+    if profile == 'tuned':
+        database.apply_pragmas(engine, database.sqlite_pragmas(app.config))
+    return engine
+
+
+def read(session, student_id, rng):
+    session.execute(AVAILABLE_DEVICES).all()
+    session.scalars(select(Loan).where((Loan.student_id == student_id) & Loan.returndatetime.is_(None))).all()
+    session.scalars(select(Loan).where(Loan.loan_id > rng.randint(0, 1000)).order_by(Loan.loan_id).limit(50)).all()
+    session.rollback()
+
+
+def worker(path, profile, student_ids, device_count, seconds, write_ratio, seed):
+    rng = random.Random(seed)
+    engine = make_engine(path, profile)
+    reads = writes = failed = 0
+
+    with app.app_context(), Session(engine) as session:
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            student_id = rng.choice(student_ids)
+            try:
+                if rng.random() < write_ratio:
+                    loan = checkout_device(student_id, rng.randint(1, device_count), session=session)
+                    return_device(loan, session=session)
+                    writes += 1
+                else:
+                    read(session, student_id, rng)
+                    reads += 1
+            except (OperationalError, CheckoutError):
+                session.rollback()
+                failed += 1
+
+    engine.dispose()
+    return reads, writes, failed
+
+
+def run(profile, args):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'throughput.sqlite')
+        engine = make_engine(path, profile)
+        db.metadata.create_all(engine)
+        with engine.begin() as connection:
+            connection.execute(insert(Student), [dict(username=f's{i}', lastname='Student', email=f's{i}@example.com')
+                                                 for i in range(1, args.students + 1)])
+            connection.execute(insert(Device), [dict(device_name=f'device {i}', device_quantity=args.students)
+                                                for i in range(1, args.devices + 1)])
+            inventory.add_missing_copies(connection)
+        engine.dispose()
+
+        # every worker has its own students, so a student never has two loans open at once
+        students = list(range(1, args.students + 1))
+        jobs = [(path, profile, students[i::args.workers], args.devices, args.seconds, args.write_ratio, i)
+                for i in range(args.workers)]
+        with multiprocessing.get_context('fork').Pool(args.workers) as pool:
+            results = pool.starmap(worker, jobs)
+
+    reads, writes, failed = (sum(column) for column in zip(*results))
+    print(f'{profile:8} {reads / args.seconds:10.0f} {writes / args.seconds:10.0f} {failed:8}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--write-ratio', type=float, default=0.2, help='share of operations that are a checkout and return')
+    parser.add_argument('--students', type=int, default=2000)
+    parser.add_argument('--devices', type=int, default=20)
+    parser.add_argument('--profile', choices=PROFILES, action='append', help='run only this profile (repeatable)')
+    args = parser.parse_args()
+
+    print(f'{args.workers} workers, {args.seconds:.0f}s per profile, {args.write_ratio:.0%} writes')
+    print(f'{"profile":8} {"reads/s":>10} {"writes/s":>10} {"failed":>8}')
+    for profile in args.profile or PROFILES:
+        run(profile, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+import contextlib
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+# the app binds its engine to DATABASE_URL when it is first imported, so the tests get a database
+# file of their own before anything from the app is imported
+DATABASE_DIRECTORY = tempfile.TemporaryDirectory()
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(DATABASE_DIRECTORY.name, 'tests.sqlite')
+
+from sqlalchemy import event, insert
+
+from app import app as flask_app, db
+from app import inventory
+from app.models import Author, Book, BookLoan, Device, Loan, Student
+
+STUDENTS = 5
+LOANS_PER_STUDENT = 4
+
+
+@pytest.fixture
+def app():
+
+    # an empty schema for every test, with logins and csrf tokens turned off
+    settings = {key: flask_app.config.get(key) for key in ('LOGIN_DISABLED', 'WTF_CSRF_ENABLED')}
+    flask_app.config.update(LOGIN_DISABLED=True, WTF_CSRF_ENABLED=False)
+    with flask_app.app_context():
+        db.drop_all()
+        db.create_all()
+        yield flask_app
+        db.session.remove()
+    flask_app.config.update(settings)
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def library(app):
+
+    # a few students, each with one open and some returned device and book loans, so a view loading
+    # a relationship row by row runs more queries than one that does not
+    now = datetime.now()
+    students, devices, books, loans_per_student = STUDENTS, 3, 3, LOANS_PER_STUDENT
+    with db.engine.begin() as connection:
+        connection.execute(insert(Student), [dict(username=f's{i}', firstname='Ada', lastname='Student',
+                                                  email=f's{i}@example.com') for i in range(1, students + 1)])
+        connection.execute(insert(Device), [dict(device_name=f'device {i}', device_quantity=loans_per_student * students)
+                                            for i in range(1, devices + 1)])
+        connection.execute(insert(Author), [dict(author_firstname='Ada', author_lastname='Lovelace', name_key='ada|lovelace')])
+        connection.execute(insert(Book), [dict(book_title=f'book {i}', author_id=1, number_of_pages=100,
+                                               quantity=loans_per_student * students) for i in range(1, books + 1)])
+        for model, key, count in ((Loan, 'device_id', devices), (BookLoan, 'book_id', books)):
+            connection.execute(insert(model), [
+                {key: loan % count + 1, 'student_id': student_id, 'borrowdatetime': now - timedelta(days=10),
+                 'duedatetime': now - timedelta(days=5), 'returndatetime': None if loan == 0 else now}
+                for student_id in range(1, students + 1) for loan in range(loans_per_student)])
+        inventory.add_missing_copies(connection)
+
+
+@pytest.fixture
+def max_queries(app):
+
+    # with max_queries(2): ... fails the test if the block runs more than two statements. they are
+    # counted on the engine's before_cursor_execute event, and listed in the failure message
+    @contextlib.contextmanager
+    def check(limit):
+        statements = []
+
+        def count(connection, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            yield statements
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+        assert len(statements) <= limit, (f'{len(statements)} queries, more than {limit}:\n'
+                                          + '\n'.join(statements))
+
+    return check
@@ -0,0 +1,18 @@
+from app import db, forms
+from app.models import Book, Copy
+
+
+# a copy whose barcode was taken after the form checked it is refused with a message, not a 500
+
+def test_add_copy_with_taken_barcode(client, library, monkeypatch):
+    taken = db.session.scalars(db.select(Copy.barcode).where(Copy.book_id == 1)).first()
+    quantity = db.session.get(Book, 1).quantity
+
+    # the copy is added by another request between the form's check and the insert
+    monkeypatch.setattr(forms, 'get_copy', lambda barcode: None)
+    response = client.post('/add_book', data={'book_title': 'book 1', 'author_firstname': 'Ada', 'author_lastname': 'Lovelace',
+                                              'number_of_pages': '100', 'barcode': taken}, follow_redirects=True)
+    assert response.status_code == 200
+    assert b'there was an error adding a copy of this book' in response.get_data()
+    db.session.expire_all()
+    assert db.session.get(Book, 1).quantity == quantity
@@ -0,0 +1,17 @@
+import pytest
+
+from app import db
+from app.models import Student
+
+
+# a payment that is not a finite amount is turned away by the form rather than failing the request
+
+@pytest.mark.parametrize('amount', ['inf', '-inf', 'nan'])
+def test_pay_fine_rejects_non_finite_amount(client, library, amount):
+    db.session.get(Student, 1).fines = 500
+    db.session.commit()
+    response = client.post('/pay_fine', data={'student_id': '1', 'amount': amount})
+    assert response.status_code == 200
+    assert b'the amount must be a number' in response.get_data()
+    db.session.expire_all()
+    assert db.session.get(Student, 1).fines == 500
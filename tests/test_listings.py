@@ -0,0 +1,29 @@
+import pytest
+
+
+# the listing pages, paged and streamed, show their rows or their "no records" message
+
+LISTINGS = [
+    ('/listStudents', b'No students found.'),
+    ('/all_loans', b'There are no loan records'),
+    ('/active_loans', b'There are no active loans'),
+    ('/book_loan_records', b'There are no loan records'),
+]
+
+
+@pytest.mark.parametrize('stream', ['', '?stream=1'])
+@pytest.mark.parametrize('path, empty_message', LISTINGS)
+def test_empty_listing(client, path, empty_message, stream):
+    response = client.get(path + stream)
+    assert response.status_code == 200
+    assert b'<tr>' not in response.get_data()
+    assert empty_message in response.get_data()
+
+
+@pytest.mark.parametrize('stream', ['', '?stream=1'])
+@pytest.mark.parametrize('path, empty_message', LISTINGS)
+def test_listing_with_rows(client, library, path, empty_message, stream):
+    response = client.get(path + stream)
+    assert response.status_code == 200
+    assert b'<tr>' in response.get_data()
+    assert empty_message not in response.get_data()
@@ -0,0 +1,44 @@
+from conftest import LOANS_PER_STUDENT, STUDENTS
+
+from app import db
+from app.instrumentation import QUERY_BUDGETS
+
+
+# the listing and report views run the same number of queries however many rows they show, so each
+# is held to its budget in QUERY_BUDGETS on a library with loans from several students
+
+def rows(response):
+    return response.get_data().count(b'<tr>') - 1
+
+
+def request(client, method, path, **kwargs):
+
+    # a fresh session for every request, so nothing is served from the identity map
+    db.session.remove()
+    response = client.open(path, method=method, **kwargs)
+    assert response.status_code == 200
+    return response
+
+
+def test_all_loans(client, library, max_queries):
+    with max_queries(QUERY_BUDGETS['all_loans']):
+        response = request(client, 'GET', '/all_loans')
+    assert rows(response) == STUDENTS * LOANS_PER_STUDENT
+
+
+def test_all_loans_streamed(client, library, max_queries):
+    with max_queries(QUERY_BUDGETS['all_loans']):
+        response = request(client, 'GET', '/all_loans?stream=1')
+        assert rows(response) == STUDENTS * LOANS_PER_STUDENT
+
+
+def test_active_loans(client, library, max_queries):
+    with max_queries(QUERY_BUDGETS['active_loans']):
+        response = request(client, 'GET', '/active_loans')
+    assert rows(response) == STUDENTS
+
+
+def test_student_loan_report(client, library, max_queries):
+    with max_queries(QUERY_BUDGETS['student_loan_report']):
+        response = request(client, 'POST', '/student_loan_report', data=dict(student_id=1))
+    assert response.get_data().count(b'<tr>') == 2 * (LOANS_PER_STUDENT + 1)
@@ -0,0 +1,12 @@
+from app import query_plans
+
+
+# every statement behind the busiest views is answered from an index on a freshly created schema,
+# the same check as flask library check-query-plans
+
+def test_hot_queries_do_not_scan_whole_tables(app):
+    results = query_plans.check_hot_queries()
+    assert len(results) == len(query_plans.hot_queries())
+
+    scans = [f'{name}: {", ".join(scans)}' for name, plans in results for statement, plan, scans in plans if scans]
+    assert not scans, 'full table scans:\n' + '\n'.join(scans)